@@ -1,42 +1,212 @@
-from transformers import AutoProcessor, MusicgenForConditionalGeneration
-import os, scipy
-from gtts import gTTS
+from orchestration.profiling import span
+import os, gc, wave
 
 # use musicgen-small,medium
+MUSICGEN_MODEL_ID = "facebook/musicgen-small"
+# musicgen tokens generated per second of audio
+TOKENS_PER_SECOND = 51.2
 
 
-def generate_audio(index, prompt, length=10, story_name="default") -> str:
+class MusicGenSession:
   """
-  Generates an audioclip using a transformer
-  
+  Keeps the MusicGen processor and model resident so every sentence of a story (and every story of a batch)
+  reuses the same weights.
+  """
+  def __init__(self, model_id=MUSICGEN_MODEL_ID, device=None):
+    self.model_id = model_id
+    # device None picks cuda when it is available
+    self.device = device
+    self.processor = None
+    self.model = None
+
+  def load(self):
+    """Loads the processor and model if they are not already loaded."""
+    if self.model is None:
+      import torch
+      from transformers import AutoProcessor, MusicgenForConditionalGeneration
+      self.device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+      with span("load " + self.model_id, "model"):
+        self.processor = AutoProcessor.from_pretrained(self.model_id)
+        self.model = MusicgenForConditionalGeneration.from_pretrained(self.model_id).to(self.device)
+    return self.model
+
+  def unload(self):
+    """Releases the model and frees its memory."""
+    import torch
+    self.processor, self.model = None, None
+    gc.collect()
+    torch.cuda.empty_cache()
+
+  def is_loaded(self) -> bool:
+    """Returns whether the model is currently resident."""
+    return self.model is not None
+
+  @property
+  def sampling_rate(self) -> int:
+    return self.load().config.audio_encoder.sampling_rate
+
+  def generate(self, prompts, lengths, batch_size=8) -> list:
+    """
+    Generates one clip per prompt. Each batch is padded to its longest clip and every output is trimmed
+    back to its own length.
+
+    Args:
+      prompts (list): the prompts given to the model.
+      lengths (list): the length of each audioclip in seconds.
+      batch_size (int): the number of prompts generated together.
+
+    Returns:
+      A list of mono numpy arrays, one per prompt.
+    """
+    import torch
+    model = self.load()
+    clips = []
+    for start in range(0, len(prompts), batch_size):
+      batch_prompts = prompts[start:start + batch_size]
+      batch_tokens = [round(length * TOKENS_PER_SECOND) for length in lengths[start:start + batch_size]]
+      inputs = self.processor(
+          text=batch_prompts,
+          padding=True,
+          return_tensors="pt",
+      ).to(self.device)
+
+      for prompt in batch_prompts:
+        print("Generating music for \"" + prompt + "\"")
+      with torch.no_grad(), span("musicgen generate", "generate", clips=len(batch_prompts), tokens=max(batch_tokens)):
+        audio_values = model.generate(**inputs, max_new_tokens=max(batch_tokens)).cpu()
+      print(f"Done generating music for {len(batch_prompts)} sentences")
+
+      total_samples = audio_values.shape[-1]
+      for i, tokens in enumerate(batch_tokens):
+        clips.append(audio_values[i, 0, :round(total_samples * tokens / max(batch_tokens))].numpy())
+    return clips
+
+
+_session = MusicGenSession()
+
+def get_music_session() -> MusicGenSession:
+  """Returns the process-wide MusicGen session."""
+  return _session
+
+def generate_audio_batch(prompts, lengths, story_name="default", start_index=0, indices=None) -> list:
+  """
+  Generates the background audio of many sentences in batches with the shared MusicGen session.
+
   Args:
-    prompt (str): the prompt given to the model.
-    length (int): the length of the audioclip in seconds.
+    prompts (list): the prompt of each sentence.
+    lengths (list): the length of each audioclip in seconds.
+    story_name (str): the name of the story (used for saving location).
+    start_index (int): the sentence index of the first prompt.
+    indices (list): the sentence index of each prompt, overrides `start_index`.
 
   Returns:
-    The path to the audio file
+    The path to each audio file, in input order.
   """
-  
-  processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
-  model = MusicgenForConditionalGeneration.from_pretrained("facebook/musicgen-small")
-  inputs = processor(
-      text=[prompt],
-      padding=True,
-      return_tensors="pt",
-  )
+  if indices is None:
+    indices = range(start_index, start_index + len(prompts))
+  import scipy.io.wavfile
+  clips = _session.generate(prompts, lengths)
+  paths = []
+  for index, clip in zip(indices, clips):
+    path = os.path.join(os.getcwd(), "audio", "generated_audio", story_name, "background" + str(index) + ".wav")
+    scipy.io.wavfile.write(path, rate=_session.sampling_rate, data=clip)
+    paths.append(path)
+  return paths
 
-  print("Generating music for \"" + prompt + "\"")
-  audio_values = model.generate(**inputs, max_new_tokens = round(length*51.2))
-  print("Done generating music for \"" + prompt + "\"")
+def generate_score(prompts, lengths, story_name="default", context_seconds=5, path=None, context_path=None) -> str:
+  """
+  Generates one continuous background score for the whole story. Each sentence's prompt continues the
+  music generated so far (the last `context_seconds` are fed back as the audio prompt) and every new
+  segment is appended to a single wav file as soon as it is generated.
 
-  sampling_rate = model.config.audio_encoder.sampling_rate
+  Args:
+    prompts (list): the prompt of each sentence.
+    lengths (list): the length of each sentence in seconds.
+    story_name (str): the name of the story (used for saving location).
+    context_seconds (float): how much previous audio conditions the next segment.
+    path (str): where the score is written, `background_score.wav` in the story's audio folder by default.
+    context_path (str): a previously generated part of the score this one continues.
 
-  path = os.path.join(os.getcwd(), "audio", "generated_audio", story_name, "background" + str(index) + ".wav")
+  Returns:
+    The path to the score
+  """
+  import torch
+  import numpy as np
+  model = _session.load()
+  processor = _session.processor
+  sampling_rate = _session.sampling_rate
+  path = path or os.path.join(os.getcwd(), "audio", "generated_audio", story_name, "background_score.wav")
+
+  context = None
+  if context_path:
+    context = _read_tail(context_path, context_seconds)
+  with wave.open(path, "wb") as score:
+    score.setnchannels(1)
+    score.setsampwidth(2)
+    score.setframerate(sampling_rate)
+
+    for prompt, length in zip(prompts, lengths):
+      print("Generating music for \"" + prompt + "\"")
+      if context is None:
+        inputs = processor(text=[prompt], padding=True, return_tensors="pt")
+      else:
+        inputs = processor(audio=context, sampling_rate=sampling_rate, text=[prompt], padding=True, return_tensors="pt")
+      with torch.no_grad(), span("musicgen generate score", "generate", seconds=length):
+        audio_values = model.generate(**inputs.to(_session.device), max_new_tokens=round(length * TOKENS_PER_SECOND)).cpu()
+
+      # the output starts with the audio prompt, only the continuation is new
+      audio = audio_values[0, 0].numpy()
+      segment = audio if context is None else audio[len(context):]
+      score.writeframes((np.clip(segment, -1, 1) * 32767).astype(np.int16).tobytes())
+
+      context = audio[-int(context_seconds * sampling_rate):]
+  print("Done generating the background score")
+  return path
 
-  scipy.io.wavfile.write(path, rate=sampling_rate, data=audio_values[0, 0].numpy())
+def _read_tail(path : str, seconds : float):
+  """Reads the last seconds of a 16 bit mono wav as floats between -1 and 1."""
+  import numpy as np
+  with wave.open(path, "rb") as f:
+    frames = min(f.getnframes(), int(seconds * f.getframerate()))
+    f.setpos(f.getnframes() - frames)
+    return np.frombuffer(f.readframes(frames), dtype=np.int16).astype(np.float32) / 32767
 
+def join_scores(paths, path) -> str:
+  """
+  Concatenates parts of a score that were generated separately into one wav file.
+
+  Args:
+    paths (list): the wav files, in order.
+    path (str): where the joined score is written.
+
+  Returns:
+    The path to the joined score
+  """
+  with wave.open(path, "wb") as score:
+    for i, part_path in enumerate(paths):
+      with wave.open(part_path, "rb") as part:
+        if i == 0:
+          score.setparams(part.getparams())
+        while True:
+          frames = part.readframes(1 << 16)
+          if not frames:
+            break
+          score.writeframes(frames)
   return path
 
+def generate_audio(index, prompt, length=10, story_name="default") -> str:
+  """
+  Generates an audioclip using a transformer
+  
+  Args:
+    prompt (str): the prompt given to the model.
+    length (int): the length of the audioclip in seconds.
+
+  Returns:
+    The path to the audio file
+  """
+  return generate_audio_batch([prompt], [length], story_name, start_index=index)[0]
+
 def generate_voiceove2(index=int, sentence=str, story_name=str) -> str:
   """
   Generates an audio clip narrating the given sentence.
@@ -78,8 +248,10 @@ def generate_voiceover(index=int, sentence=str, story_name=str) -> str:
   Returns:
     The path to the generated audio.
   """
+  from gtts import gTTS
   print("Generating voiceover...")
   tts = gTTS(text=sentence, lang='en')
   path = os.path.join(os.getcwd(),  "audio", "generated_audio", story_name, "speech" + str(index) + ".mp3") 
-  tts.save(path)
+  with span("gtts voiceover", "network"):
+    tts.save(path)
   return path
@@ -1,14 +1,25 @@
-from rendering.start_render import render
-from nlp.nlp_manager import *
-from texture_generation.stable import generate_image
-from audio.audio_generation import generate_audio, generate_voiceover
-from rendering.momask_utils import *
+from rendering.start_render import render, render_distributed
+from nlp.nlp_manager import (estimate_sentence_length, get_animation_prompt, get_animation_prompts, get_audio_prompts,
+                             get_background_prompt, get_floor_prompt, get_ceiling_prompt, story_context)
+from nlp.prompt_cache import get_prompt_cache, configure_prompt_cache
+from nlp.zero_shot import get_zero_shot_classifier
+from nlp.llm_registry import get_registry
+from nlp.character_index import CharacterIndex
+from nlp.position_planner import get_position_planner, configure_position_planner
+from texture_generation.stable import generate_images, get_texture_pipeline
+from audio.audio_generation import generate_audio_batch, generate_score, join_scores, generate_voiceover, get_music_session
+from rendering.momask_utils import IDLE_PROMPT, generate_motions, link_motion, motion_filename, get_worker
+from rendering.timeline import validate_timeline, TimelineJournal, assemble_timeline
 
-from spacy import load
-from transformers import pipeline
-import json, torch, os
+from orchestration.scheduler import StageGraph, GpuModel, IO_LANE, GPU_LANE, detect_gpu_memory_budget
+from orchestration.manifest import Manifest, file_hash
+from orchestration.profiling import get_profiler, span
 
-def set_idle_animation(character_dict : dict, character_positions : dict, character : str, length: int, story_name : str, index : int):
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import json, os, sys, argparse, traceback
+
+def set_idle_animation(character_dict : dict, character_positions : dict, character : str, length: int, story_name : str, index : int, pending_motions : list):
     """
     Sets a character's animation data to the idle values
     
@@ -16,12 +27,14 @@ def set_idle_animation(character_dict : dict, character_positions : dict, charac
         character_dict (dict): the dictionary containing all current characters in the story
         character_positions (dict): the dictionary containing all end positions at specific sentences for the story
         character (str): The name of the character (lowercase)
+        pending_motions (list): the motions that still need to be generated, the idle motion is added to it
     """
     last_position = character_positions.get(character, [(len(character_positions), 0, 0)])[-1]
-    character_dict[character] = {'animation': create_idle(length, story_name=story_name, index=index), 'sequence_end_position': last_position}
+    character_dict[character] = {'animation': None, 'sequence_end_position': last_position}
+    pending_motions.append((character_dict[character], IDLE_PROMPT, length, IDLE_PROMPT + str(index)))
     character_positions.setdefault(character, []).append(last_position)
     
-def set_generated_animation(story: str, character_dict : dict, character_positions : dict, sentence : str, character : str, sequence_length : int, story_name: str):
+def set_generated_animation(story: str, character_dict : dict, character_positions : dict, sentence : str, character : str, sequence_length : int, story_name: str, pending_motions : list, animation_prompt : str = None, context : str = None):
     """
     Sets a character's animation data its generated values
     
@@ -32,14 +45,31 @@ def set_generated_animation(story: str, character_dict : dict, character_positio
         sentence (str): the current sentence
         character (str): The name of the character (lowercase)
         sequence_length (int): the estimated number of frames in the current sentence
+        pending_motions (list): the motions that still need to be generated, the character's motion is added to it
+        animation_prompt (str): the pre-generated animation prompt, generated here if not given
+        context (str): the `story_context` of the sentence's chunk, given to the position planner
     """
-    animation_prompt = get_animation_prompt(sentence, character, story)
-    position = get_next_movement(sentence, character, story, character_positions, animation_prompt)
-    animation_path = create_animation(prompt=animation_prompt, length=sequence_length, story_name=story_name)
-    character_dict[character] = {'animation': animation_path, 'sequence_end_position': position}
+    if animation_prompt is None:
+        animation_prompt = get_animation_prompt(sentence, character, story)
+    position = get_position_planner().plan(sentence, character, story, character_positions, animation_prompt, context=context)
+    character_dict[character] = {'animation': None, 'sequence_end_position': position}
+    # the same prompt can be planned for sentences of different lengths, each needs its own clip
+    pending_motions.append((character_dict[character], animation_prompt, sequence_length, motion_filename(animation_prompt, sequence_length * 32)))
     character_positions.setdefault(character, [(len(character_positions), 0, 0)]).append((position[0], position[1], 0))
     print(f"Sequence length: {sequence_length}")
 
+def resolve_motions(pending_motions : list, story_name : str):
+    """
+    Generates every pending motion of the story in one batched MoMask pass and fills in the animation paths.
+
+    Args:
+        pending_motions (list): (character data, prompt, length in seconds, file name) tuples
+        story_name (str): the given name of the story.
+    """
+    motion_paths = generate_motions([(prompt, length * 32) for _, prompt, length, _ in pending_motions])
+    for character_data, prompt, length, filename in pending_motions:
+        character_data['animation'] = link_motion(motion_paths[(prompt, length * 32)], story_name, filename)
+
 def create_directories(story_name):
     """Creates all the directories for the specific story.
     
@@ -52,44 +82,10 @@ def create_directories(story_name):
     os.makedirs(os.path.join(os.getcwd(), "output", story_name), exist_ok=True)
     
 
-story_name = input("Please enter your story's name: ")
-story = input("Please enter your story (End with a period): ")
-quality = input("What would you like the quality of your render to be? (low, med, high, best) ")
-save_file = True if input("Would you like to save the .blend file? (Y/n) ").strip().lower() == "y" else False
-nlp = load("en_core_web_sm")
-doc = nlp(story)
-
-create_directories(story_name)
-
-#sentence container
-sentences = []
-# current sentence
-current = []
-
-# organize sentences
-for token in doc:
-    if str(token) == ".":
-        sentences.append(current)
-        current = []
-    else:
-        current.append(token)
-
-
 # the threshold (between 0 and 1) which determines whether an action should be preformed
 ACTION_THRESHOLD = 0.75
-CHARACTER_THRESHOLD = 0.9
-
-# vars for json
-timeline = {}
-next_frame = 1
-all_characters = []
-
-torch.cuda.empty_cache()
-
-from nlp.nlp_manager import *
-from texture_generation.stable import generate_image
-import os
 
+# texture timeline keys, the renderer reads them in this order
 file_paths = {
     "setting_image_path": "background.png",
     "floor_image_path": "floor.png",
@@ -103,76 +99,537 @@ prompts_functions = {
     "ceiling_image_path": get_ceiling_prompt
 }
 
-# generate and save images
-for key, filename in file_paths.items():
-    image_path = os.path.join(os.getcwd(), "texture_generation", "generated_images", story_name, filename)
-    generate_image(prompts_functions[key](story), image_path, width=1536 if filename == 'background.png' else 512, story_name=story_name)
-    timeline[key] = image_path
+# rough GPU memory (MB) each model stage needs while it runs
+STAGE_GPU_MEMORY = {
+    "analysis": 2000,
+    "texture_prompts": 8000,
+    "sentence_prompts": 8000,
+    "textures": 4000,
+    "music": 3000,
+    "motion": 8000,
+}
+# rough GPU memory (MB) each resident model holds between the stages that use it
+MODEL_GPU_MEMORY = {
+    "llm": 7600,
+    "momask": 3000,
+    "stable_diffusion": 3000,
+    "musicgen": 2000,
+    "zero_shot": 1600,
+}
+# the models each GPU stage uses
+STAGE_MODELS = {
+    "analysis": ("zero_shot",),
+    "texture_prompts": ("llm",),
+    "sentence_prompts": ("llm",),
+    "textures": ("stable_diffusion",),
+    "music": ("musicgen",),
+    "motion": ("momask",),
+}
 
-# determines if an animation is needed or not
-classifier = pipeline("zero-shot-classification", device="cuda" if torch.cuda.is_available() else "cpu", model="facebook/bart-large-mnli")
+# where --action-library keeps the retargeted animation clips when no path is given
+DEFAULT_ACTION_LIBRARY = os.path.join("rendering", "animations", "action_library.blend")
 
+# sentences processed together, this bounds memory on book-length stories
+CHUNK_SIZE = 32
+# tokens that end a sentence, they are not part of the sentence text
+SENTENCE_END = (".", "!", "?")
 
-character_positions = {}
-idle_index = 0
-for i, sentence_tokens in enumerate(sentences):
-    # get setence (without period)
-    sentence = ' '.join([str(token) for token in sentence_tokens])
-    print("Working on:", sentence)
-    # estimates sentence length based on an equation
-    sequence_length = estimate_sentence_length(sentence)
-    
-    #generate background and speech audio based on the sentence
-    audio_prompt = get_audio_prompt(sentence, story)
-    background_audio_path = generate_audio(i, audio_prompt, sequence_length, story_name)
-    tts_audio_path = generate_voiceover(i, sentence, story_name)
-    
-    # uses a transformer to estimate sentence similarity
-    action_score = classifier(str(sentence), ["physical action"])["scores"][0]
-    actions = [str(token.lemma_) for token in sentence_tokens if token.pos_ == "VERB" and action_score > ACTION_THRESHOLD]
-    currrent_characters = [str(token).lower() for token in sentence_tokens if token.pos_ == "PROPN" and classifier(str(token), ["character"])["scores"][0] > CHARACTER_THRESHOLD]
-
-    character_dict = {}
-    if currrent_characters:
-        for index, character in enumerate(currrent_characters):
-            if character not in all_characters:
-                all_characters.append(character)
-            else: # if the character has already been mentioned, move to most recent in the list
-                all_characters.remove(character)
-                all_characters.append(character)
-
-            if actions and index < len(actions):
-                set_generated_animation(story, character_dict, character_positions, sentence, character, sequence_length, story_name)
+def gpu_models() -> dict:
+    """Returns the models that stay on the GPU between stages, so the scheduler can unload idle ones."""
+    classifier, registry, pipeline, session, worker = get_zero_shot_classifier(), get_registry(), get_texture_pipeline(), get_music_session(), get_worker()
+    return {
+        "llm": GpuModel(MODEL_GPU_MEMORY["llm"], registry.is_loaded, registry.unload),
+        "momask": GpuModel(MODEL_GPU_MEMORY["momask"], worker.is_running, worker.close),
+        "stable_diffusion": GpuModel(MODEL_GPU_MEMORY["stable_diffusion"], pipeline.is_loaded, pipeline.unload),
+        "musicgen": GpuModel(MODEL_GPU_MEMORY["musicgen"], session.is_loaded, session.unload),
+        "zero_shot": GpuModel(MODEL_GPU_MEMORY["zero_shot"], classifier.is_loaded, classifier.unload),
+    }
+
+@lru_cache(maxsize=None)
+def get_spacy():
+    """Loads the spaCy model once per process."""
+    from spacy import load
+    return load("en_core_web_sm")
+
+def iter_sentences(story : str):
+    """
+    Parses a story paragraph by paragraph and yields its sentences as soon as spaCy segments them.
+
+    Args:
+        story (str): the entire story, paragraphs are separated by line breaks
+
+    Yields:
+        (text, span) of each sentence, the text is its tokens joined without the closing punctuation.
+    """
+    paragraphs = (paragraph for paragraph in story.splitlines() if paragraph.strip())
+    for doc in get_spacy().pipe(paragraphs):
+        for sentence in doc.sents:
+            tokens = [token for token in sentence if not token.is_space]
+            while tokens and str(tokens[-1]) in SENTENCE_END:
+                tokens.pop()
+            if tokens:
+                yield ' '.join(str(token) for token in tokens), sentence
+
+def chunked(iterable, size : int):
+    """Yields lists of up to `size` items, pulling items only as each list is needed."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class StoryState:
+    """Everything carried from one chunk of a story to the next."""
+    def __init__(self):
+        self.characters = CharacterIndex()
+        self.character_positions = {}
+        self.idle_index = 0
+        self.next_frame = 1
+        self.score_parts = []
+
+def analyse_sentences(chunk : list, state : StoryState, manifest : Manifest) -> list:
+    """
+    Decides which characters act or idle in each sentence of a chunk so every later stage can be batched.
+
+    Args:
+        chunk (list): the (text, span) of each sentence
+        state (StoryState): the story so far, its characters are updated
+        manifest (Manifest): the story's artifact manifest
+
+    Returns:
+        A list of plans, one per sentence, with the sentence, its index in the story, its estimated length and its (character, is_generated) pairs.
+    """
+    sentence_texts = [sentence for sentence, _ in chunk]
+    # determines if an animation is needed or not, every sentence of the chunk is classified in batches
+    first_index = len(state.characters.sentence_characters)
+    action_scores = manifest.cached(f"actions:{first_index}", {'sentences': sentence_texts, 'label': "physical action"},
+                                    lambda: get_zero_shot_classifier().classify(sentence_texts, "physical action"))
+
+    plans = []
+    for sentence, span in chunk:
+        # the characters of the sentence, with "he"/"she"/"they" resolved to the character they refer to
+        i = state.characters.add(span)
+        # uses a transformer to estimate sentence similarity
+        action_score = action_scores[sentence]
+        actions = [str(token.lemma_) for token in span if token.pos_ == "VERB" and action_score > ACTION_THRESHOLD]
+        currrent_characters = state.characters.characters_in(i)
+
+        # (character, is_generated) in the order they are written to the timeline
+        plan_characters = []
+        if currrent_characters:
+            for index, character in enumerate(currrent_characters):
+                plan_characters.append((character, bool(actions) and index < len(actions)))
+
+        elif actions and state.characters.most_recent(i): # this gives the last action to the most recent character to be metioned if no characters were metioned in this sentence
+            plan_characters.append((state.characters.most_recent(i), True))
+
+        # if characters are not mentioned in the current sentence, set their animation to idle
+        planned = [character for character, _ in plan_characters]
+        for character in state.characters.known_characters(i):
+            if character not in planned:
+                plan_characters.append((character, False))
+
+        plans.append({'sentence': sentence, 'index': i, 'sequence_length': estimate_sentence_length(sentence), 'characters': plan_characters})
+
+    return plans
+
+def generate_texture_prompts(story : str) -> dict:
+    """Returns the image prompt of every texture, keyed by its timeline key."""
+    return {key: prompts_functions[key](story) for key in file_paths}
+
+def generate_textures(story_name : str, texture_prompts : dict, manifest : Manifest) -> dict:
+    """
+    Generates and saves the textures with one pipeline, batching the ones that share a size.
+
+    Returns:
+        The image path of every texture, keyed by its timeline key.
+    """
+    image_paths = {}
+    image_requests = []
+    for key, filename in file_paths.items():
+        image_paths[key] = os.path.join(os.getcwd(), "texture_generation", "generated_images", story_name, filename)
+        request = {'prompt': texture_prompts[key], 'path': image_paths[key], 'width': 1536 if filename == 'background.png' else 512}
+        if not manifest.lookup("texture:" + key, request)[0]:
+            image_requests.append((key, request))
+
+    generate_images([request for _, request in image_requests])
+    for key, request in image_requests:
+        manifest.record("texture:" + key, request, request['path'], [request['path']])
+    return image_paths
+
+def generate_sentence_prompts(story : str, plans : list) -> dict:
+    """
+    Generates every per-sentence prompt in a few padded batches.
+
+    Returns:
+        A dictionary with the music prompt of each sentence and the animation prompts keyed by sentence then character.
+    """
+    # one context for the whole chunk, so every prompt of the chunk shares its attention cache
+    context = story_context(story, [plan['sentence'] for plan in plans])
+    audio_prompts = get_audio_prompts([plan['sentence'] for plan in plans], story, context=context)
+    animation_pairs = list(dict.fromkeys((plan['sentence'], character) for plan in plans for character, generated in plan['characters'] if generated))
+    animation_prompts = {}
+    for (sentence, character), prompt in zip(animation_pairs, get_animation_prompts(animation_pairs, story)):
+        animation_prompts.setdefault(sentence, {})[character] = prompt
+    return {'audio': audio_prompts, 'animation': animation_prompts}
+
+def generate_music(story_name : str, plans : list, sentence_prompts : dict, manifest : Manifest, state : StoryState, continuous_score : bool = False) -> dict:
+    """
+    Generates the background music of every sentence with one resident MusicGen model.
+    Clips already recorded in the manifest are not generated again.
+
+    Args:
+        state (StoryState): the story so far, a continuous score continues its last part
+        continuous_score (bool): generate one continuous background score instead of a clip per sentence
+
+    Returns:
+        The path of this chunk's part of the continuous score and the background clip path of each sentence.
+    """
+    lengths = [plan['sequence_length'] for plan in plans]
+    if continuous_score:
+        first_index = plans[0]['index']
+        path = os.path.join(os.getcwd(), "audio", "generated_audio", story_name, f"background_score{first_index}.wav")
+        context_path = state.score_parts[-1] if state.score_parts else None
+        params = {'prompts': sentence_prompts['audio'], 'lengths': lengths, 'continues': context_path and file_hash(context_path)}
+        score = manifest.cached(f"music:score:{first_index}", params,
+                                lambda: generate_score(sentence_prompts['audio'], lengths, story_name, path=path, context_path=context_path), lambda path: [path])
+        state.score_parts.append(score)
+        return {'score': score, 'clips': [None] * len(plans)}
+
+    clips = [None] * len(plans)
+    missing = []
+    for i, (plan, prompt, length) in enumerate(zip(plans, sentence_prompts['audio'], lengths)):
+        found, path = manifest.lookup(f"music:{plan['index']}", {'prompt': prompt, 'length': length})
+        if found:
+            clips[i] = path
+        else:
+            missing.append(i)
+
+    if missing:
+        paths = generate_audio_batch([sentence_prompts['audio'][i] for i in missing], [lengths[i] for i in missing], story_name, indices=[plans[i]['index'] for i in missing])
+        for i, path in zip(missing, paths):
+            clips[i] = manifest.record(f"music:{plans[i]['index']}", {'prompt': sentence_prompts['audio'][i], 'length': lengths[i]}, path, [path])
+    return {'score': "", 'clips': clips}
+
+def generate_voiceovers(story_name : str, plans : list, manifest : Manifest) -> list:
+    """
+    Generates the narration of every sentence. gTTS is network bound, so the sentences are requested concurrently.
+
+    Returns:
+        The speech path of each sentence.
+    """
+    def voiceover(plan):
+        i = plan['index']
+        return manifest.cached(f"voiceover:{i}", {'sentence': plan['sentence']}, lambda: generate_voiceover(i, plan['sentence'], story_name), lambda path: [path])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(voiceover, plans))
+
+def generate_motion(story : str, story_name : str, plans : list, sentence_prompts : dict, character_positions : dict, idle_index : int) -> dict:
+    """
+    Plans every character's position and animation, then generates all motions of the chunk in one batched MoMask pass.
+
+    Args:
+        character_positions (dict): every character's positions so far, it is updated
+        idle_index (int): the index of the next idle animation
+
+    Returns:
+        The character dictionary of each sentence, the updated positions and the next idle index.
+    """
+    pending_motions = []
+    character_dicts = []
+    context = story_context(story, [plan['sentence'] for plan in plans]) if get_position_planner().use_llm else None
+    for plan in plans:
+        sentence, sequence_length = plan['sentence'], plan['sequence_length']
+        print("Working on:", sentence)
+
+        character_dict = {}
+        for character, generated in plan['characters']:
+            if generated:
+                set_generated_animation(story, character_dict, character_positions, sentence, character, sequence_length, story_name, pending_motions, sentence_prompts['animation'][sentence][character], context)
             else:
-                set_idle_animation(character_dict, character_positions,character, sequence_length, story_name, idle_index)
+                set_idle_animation(character_dict, character_positions, character, sequence_length, story_name, idle_index, pending_motions)
                 idle_index += 1
+        character_dicts.append(character_dict)
+
+    # every motion of the chunk is planned, so generate them together
+    resolve_motions(pending_motions, story_name)
+    return {'characters': character_dicts, 'positions': character_positions, 'idle_index': idle_index}
+
+def plan_motion(story : str, story_name : str, plans : list, sentence_prompts : dict, manifest : Manifest, state : StoryState) -> list:
+    """
+    Generates the motion of a chunk unless the manifest has it for the same plans and starting positions.
+
+    Returns:
+        The character dictionary of each sentence.
+    """
+    params = {'plans': plans, 'prompts': sentence_prompts['animation'], 'positions': state.character_positions, 'idle_index': state.idle_index,
+              'planner': get_position_planner().settings()}
+    motion = manifest.cached(f"motion:{plans[0]['index']}", params,
+                             lambda: generate_motion(story, story_name, plans, sentence_prompts, {character: list(positions) for character, positions in state.character_positions.items()}, state.idle_index),
+                             lambda motion: motion_files(motion['characters']))
+    state.character_positions = motion['positions']
+    state.idle_index = motion['idle_index']
+    return motion['characters']
+
+def motion_files(character_dicts : list) -> list:
+    """Returns every animation file referenced by the character dictionaries."""
+    return list(dict.fromkeys(data['animation'] for character_dict in character_dicts for data in character_dict.values()))
+
+def append_timeline(journal : TimelineJournal, plans : list, music : dict, voiceovers : list, motion : list, state : StoryState):
+    """Appends the sequences of a chunk to the story's timeline journal."""
+    for plan, background_audio_path, tts_audio_path, character_dict in zip(plans, music['clips'], voiceovers, motion):
+        end_frame = state.next_frame + plan['sequence_length'] * 32
+        # saves the frames
+        journal.add_sequence(state.next_frame, end_frame, {'audio_paths': [background_audio_path, tts_audio_path], 'characters': character_dict})
+        state.next_frame = end_frame
+
+def render_timeline(frame_data_path : str, manifest : Manifest, workers : int = 1) -> str:
+    """Renders the story unless the same frame data was already rendered, with `workers` Blender processes when more than one."""
+    with open(frame_data_path, encoding='utf-8') as f:
+        render_output = json.load(f)['render_output']
+    params = {'frame_data': file_hash(frame_data_path)}
+    if manifest.lookup("render", params)[0]:
+        print("Skipping render, already completed")
+        return render_output
+
+    code = render_distributed(frame_data_path, workers) if workers > 1 else render(frame_data_path)
+    if code:
+        raise RuntimeError(f"Rendering {frame_data_path} failed, Blender exited with {code}")
+    # only a finished video marks the render as complete
+    if os.path.isfile(render_output):
+        manifest.record("render", params, render_output, [render_output])
+    return render_output
+
+def build_chunk_graph(story_name : str, story : str, chunk : list, state : StoryState, manifest : Manifest, journal : TimelineJournal, continuous_score : bool = False) -> StageGraph:
+    """
+    Builds the stage graph of one chunk of a story:
+    text analysis -> prompts -> {textures (first chunk only), music, TTS, motion} -> timeline journal
+
+    Every stage is checked against the manifest first, so a rerun resumes at the first missing artifact.
+
+    Args:
+        story_name (str): the given name of the story.
+        story (str): the entire story, used as context for the prompts
+        chunk (list): the (text, span) of each sentence in the chunk
+        state (StoryState): the story so far
+        manifest (Manifest): the story's artifact manifest
+        journal (TimelineJournal): the story's timeline journal
+        continuous_score (bool): generate one continuous background score instead of a clip per sentence
+
+    Returns:
+        The StageGraph, ready to run.
+    """
+    graph = StageGraph(gpu_memory_budget=detect_gpu_memory_budget(), gpu_models=gpu_models())
+    graph.add("analysis", lambda: analyse_sentences(chunk, state, manifest), lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["analysis"], models=STAGE_MODELS["analysis"])
+    if not state.characters.sentence_characters:
+        # the textures are shared by the whole story
+        graph.add("texture_prompts", lambda: manifest.cached("texture_prompts", {'story': story}, lambda: generate_texture_prompts(story)),
+                  lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["texture_prompts"], models=STAGE_MODELS["texture_prompts"])
+        graph.add("textures", lambda texture_prompts: journal.set(**generate_textures(story_name, texture_prompts, manifest)), ["texture_prompts"],
+                  lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["textures"], models=STAGE_MODELS["textures"])
+    graph.add("sentence_prompts", lambda analysis: manifest.cached(f"sentence_prompts:{analysis[0]['index']}", {'story': story, 'plans': analysis}, lambda: generate_sentence_prompts(story, analysis)), ["analysis"],
+              lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["sentence_prompts"], models=STAGE_MODELS["sentence_prompts"])
+    graph.add("voiceovers", lambda analysis: generate_voiceovers(story_name, analysis, manifest), ["analysis"], lane=IO_LANE)
+    graph.add("music", lambda analysis, sentence_prompts: generate_music(story_name, analysis, sentence_prompts, manifest, state, continuous_score), ["analysis", "sentence_prompts"],
+              lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["music"], models=STAGE_MODELS["music"])
+    # the LLM is only asked for positions with --llm-positions
+    motion_models = STAGE_MODELS["motion"] + (("llm",) if get_position_planner().use_llm else ())
+    graph.add("motion", lambda analysis, sentence_prompts: plan_motion(story, story_name, analysis, sentence_prompts, manifest, state), ["analysis", "sentence_prompts"],
+              lane=GPU_LANE, gpu_memory=STAGE_GPU_MEMORY["motion"], models=motion_models)
+    graph.add("timeline", lambda analysis, music, voiceovers, motion: append_timeline(journal, analysis, music, voiceovers, motion, state),
+              ["analysis", "music", "voiceovers", "motion"])
+    return graph
+
+def run_story(story_name : str, story : str, quality : str, save_file : bool, resume : bool = True, continuous_score : bool = False, chunk_size : int = CHUNK_SIZE, workers : int = 1,
+              action_library : str = "", rig_types : dict = None) -> dict:
+    """
+    Generates and renders one story. The story is streamed through the stages `chunk_size` sentences at a time and
+    each chunk is appended to `output/<story>/<story>_timeline.jsonl` as soon as it is done. Models stay loaded
+    afterwards, so the next story starts warm. The timing and memory of every stage, model load, generate call and
+    subprocess (Blender's included) are written as a Chrome trace to `output/<story>/profile.json`.
+
+    Args:
+        resume (bool): reuse the artifacts recorded in the story's manifest, False starts from scratch
+        continuous_score (bool): generate one continuous background score instead of a clip per sentence
+        chunk_size (int): how many sentences are processed together
+        workers (int): how many Blender processes render frame ranges in parallel
+        action_library (str): a .blend the renderer keeps retargeted animation clips in across stories, none when empty
+        rig_types (dict): character -> rig type, characters of one rig type share their retargeted clips
+
+    Returns:
+        The paths to the frame data and the render.
+    """
+    output_path = os.path.join(os.getcwd(), "output", story_name)
+    render_profile_path = os.path.join(output_path, "render_profile.json")
+    if os.path.isfile(render_profile_path):
+        os.remove(render_profile_path)
+    profiler = get_profiler()
+    profiler.reset()
+    try:
+        with span("story " + story_name, "story"):
+            return generate_story(story_name, story, quality, save_file, resume, continuous_score, chunk_size, workers, action_library, rig_types)
+    finally:
+        profiler.merge(render_profile_path)
+        print("Profile:", profiler.write(os.path.join(output_path, "profile.json")))
+
+def generate_story(story_name : str, story : str, quality : str, save_file : bool, resume : bool, continuous_score : bool, chunk_size : int, workers : int,
+                   action_library : str, rig_types : dict) -> dict:
+    """Runs every stage of `run_story`, see there."""
+    create_directories(story_name)
+    manifest = Manifest(story_name)
+    if not resume:
+        manifest.clear()
+    import torch
+    torch.cuda.empty_cache()
+
+    output_path = os.path.join(os.getcwd(), "output", story_name)
+    journal = TimelineJournal(os.path.join(output_path, story_name.replace(" ", "_") + "_timeline.jsonl"))
+    journal.set(render_quality=quality.lower().strip(), render_output=os.path.join(output_path, story_name + ".mp4"),
+                blender_output=os.path.join(output_path, story_name + ".blend") if save_file else "",
+                action_library=os.path.abspath(action_library) if action_library else "", rig_types=rig_types or {})
+
+    state = StoryState()
+    for chunk in chunked(iter_sentences(story), chunk_size):
+        first_index = len(state.characters.sentence_characters)
+        print(f"Processing sentences {first_index + 1} to {first_index + len(chunk)}")
+        build_chunk_graph(story_name, story, chunk, state, manifest, journal, continuous_score).run()
+
+    if continuous_score and state.score_parts:
+        journal.set(background_score=join_scores(state.score_parts, os.path.join(os.getcwd(), "audio", "generated_audio", story_name, "background_score.wav")))
+    frame_data_path = assemble_timeline(journal.path, os.path.join(output_path, story_name.replace(" ", "_") + "_frame_data.json"))
+    print("Prompt cache:", get_prompt_cache().stats())
+    return {'frame_data': frame_data_path, 'render': render_timeline(frame_data_path, manifest, workers)}
+
+def read_stories(args) -> list:
+    """
+    Collects the stories given on the command line.
+
+    A story file holds one story per non-empty line (like test_stories.txt). A JSONL file holds one
+    {"name", "story", "quality", "save_blend"} object per line, missing fields fall back to the command line options.
+
+    Returns:
+        A list of (story_name, story, quality, save_file) tuples.
+    """
+    stories = []
+    if args.story:
+        stories.append((args.name or "story", args.story, args.quality, args.save_blend))
+
+    if args.story_file:
+        with open(args.story_file, encoding='utf-8') as f:
+            lines = [line.strip() for line in f if line.strip()]
+        base_name = args.name or os.path.splitext(os.path.basename(args.story_file))[0]
+        for i, line in enumerate(lines):
+            stories.append((base_name if len(lines) == 1 else f"{base_name}_{i + 1}", line, args.quality, args.save_blend))
+
+    if args.jsonl:
+        with open(args.jsonl, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                stories.append((data.get('name', f"story_{i + 1}"), data['story'], data.get('quality', args.quality), data.get('save_blend', args.save_blend)))
+    return stories
+
+def run_tool(argv : list) -> int:
+    """
+    Runs the `render` and `validate` subcommands, which work on existing frame data and never import the ML stack.
+
+    Args:
+        argv (list): the subcommand followed by its arguments
+
+    Returns:
+        The exit code.
+    """
+    parser = argparse.ArgumentParser(prog="marta.py " + argv[0])
+    parser.add_argument("frame_data", help="the path to a story's frame data JSON, or its timeline journal (.jsonl) to use the sections generated so far")
+    parser.add_argument("--skip-file-check", action="store_true", help="only check the structure of the timeline")
+    parser.add_argument("--workers", type=int, default=1, help="render frame ranges with this many Blender processes and join them")
+    parser.add_argument("--profile-frames", action="store_true", help="record the render time of every frame in the profile")
+    args = parser.parse_args(argv[1:])
+
+    if args.frame_data.endswith(".jsonl"):
+        args.frame_data = assemble_timeline(args.frame_data, args.frame_data[:-len(".jsonl")] + "_partial_frame_data.json")
+
+    errors = validate_timeline(args.frame_data, check_files=not args.skip_file_check)
+    for error in errors:
+        print(error)
+    if errors:
+        return 1
+    if argv[0] == "validate":
+        print("Timeline is valid")
+        return 0
+    if args.workers > 1:
+        return render_distributed(args.frame_data, args.workers)
+    return render(args.frame_data, profile_frames=args.profile_frames)
+
+TOOLS = ("render", "validate")
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in TOOLS:
+        return run_tool(argv)
 
-    elif actions: # this gives the last action to the most recent character to be metioned if no characters were metioned in this sentence
-        character = all_characters[-1]
-        set_generated_animation(story, character_dict, character_positions, sentence, character, sequence_length, story_name)
-        idle_index += 1
-    else:
-        for character in all_characters:
-            set_idle_animation(character_dict, character_positions, character, sequence_length, story_name, idle_index)
-            idle_index += 1
+    parser = argparse.ArgumentParser(description="Generates and renders animations from text stories. "
+                                     "Use `marta.py render|validate <frame_data>` to rerender or check existing frame data.")
+    parser.add_argument("--name", help="the story name (the base name when a story file holds several stories)")
+    parser.add_argument("--story", help="the story text (end sentences with a period)")
+    parser.add_argument("--story-file", help="a text file with one story per line")
+    parser.add_argument("--jsonl", help="a JSONL file of {\"name\", \"story\", \"quality\", \"save_blend\"} objects")
+    parser.add_argument("--quality", default="med", choices=["low", "med", "high", "best"], help="the render quality")
+    parser.add_argument("--save-blend", action="store_true", help="save the .blend file next to the render")
+    parser.add_argument("--continuous-score", action="store_true", help="generate one background score for the whole story")
+    parser.add_argument("--fresh", action="store_true", help="ignore the artifacts recorded by previous runs")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="sample every LLM prompt again instead of reusing cached outputs, sampled prompts are cached too so a repeated prompt otherwise gets the same output")
+    parser.add_argument("--llm-positions", action="store_true", help="ask the LLM for positions the movement rules do not cover")
+    parser.add_argument("--keep-going", action="store_true", help="continue with the next story when one fails")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="how many sentences are generated together before they are added to the timeline")
+    parser.add_argument("--workers", type=int, default=1, help="render frame ranges with this many Blender processes and join them")
+    parser.add_argument("--action-library", nargs="?", const=DEFAULT_ACTION_LIBRARY, default="",
+                        help=f"keep retargeted animation clips in this .blend for later stories ({DEFAULT_ACTION_LIBRARY} when no path is given)")
+    parser.add_argument("--rig-type", action="append", default=[], metavar="CHARACTER=TYPE",
+                        help="characters given the same rig type share their retargeted clips, can be repeated")
+    args = parser.parse_args(argv)
 
-    # if characters are not mentioned in the current sentence, set their animation to idle
-    for character in set(all_characters) - set(currrent_characters):
-        set_idle_animation(character_dict, character_positions, character, sequence_length, story_name, idle_index)
-        idle_index += 1
+    rig_types = {}
+    for rig_type in args.rig_type:
+        character, _, name = rig_type.partition("=")
+        if not name:
+            parser.error(f"--rig-type expects CHARACTER=TYPE, got '{rig_type}'")
+        rig_types[character.strip().lower()] = name.strip()
 
-    # saves the frames
-    timeline[str(next_frame)] = {'audio_paths': [background_audio_path, tts_audio_path], 'characters': character_dict}
-    next_frame += sequence_length * 32
+    if args.no_prompt_cache:
+        configure_prompt_cache(bypass=True)
+    if args.llm_positions:
+        configure_position_planner(use_llm=True)
 
+    stories = read_stories(args)
+    if not stories:
+        # interactive mode
+        story_name = input("Please enter your story's name: ")
+        story = input("Please enter your story (End with a period): ")
+        quality = input("What would you like the quality of your render to be? (low, med, high, best) ")
+        save_file = True if input("Would you like to save the .blend file? (Y/n) ").strip().lower() == "y" else False
+        stories = [(story_name, story, quality, save_file)]
 
+    failed = []
+    for story_name, story, quality, save_file in stories:
+        print(f"\n=== {story_name} ===")
+        try:
+            run_story(story_name, story, quality, save_file, resume=not args.fresh, continuous_score=args.continuous_score, chunk_size=args.chunk_size, workers=args.workers,
+                      action_library=args.action_library, rig_types=rig_types)
+        except Exception:
+            if not args.keep_going:
+                raise
+            traceback.print_exc()
+            failed.append(story_name)
 
-timeline['render_quality'] = quality.lower().strip()
-timeline['render_output'] = os.path.join(os.getcwd(), "output", story_name, story_name + ".mp4")
-timeline['blender_output'] = os.path.join(os.getcwd(), "output", story_name, story_name + ".blend") if save_file else ""
-timeline['end_frame'] = next_frame
-frame_data_path = os.path.join(os.getcwd(), "output", story_name, story_name.replace(" ", "_") + "_frame_data.json")
-with open(frame_data_path, 'w', encoding='utf-8') as f:
-    json.dump(timeline, f, ensure_ascii=False, indent=4)
-render(frame_data_path)
+    if failed:
+        print("Failed stories: " + ", ".join(failed))
+    return 1 if failed else 0
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+
+# pronoun -> the group a character has to agree with
+PRONOUN_GROUPS = {
+    "he": "masculine", "him": "masculine", "his": "masculine", "himself": "masculine",
+    "she": "feminine", "her": "feminine", "hers": "feminine", "herself": "feminine",
+    "they": "plural", "them": "plural", "their": "plural", "theirs": "plural", "themselves": "plural",
+}
+SUBJECT_DEPENDENCIES = ("nsubj", "nsubjpass")
+# nouns that tie a character to a pronoun group when the story says "a boy named Aiden" or "Aiden was a girl"
+GROUP_NOUNS = {
+    "masculine": {"boy", "man", "king", "prince", "father", "brother", "son", "husband", "gentleman", "guy", "lord", "sir"},
+    "feminine": {"girl", "woman", "queen", "princess", "mother", "sister", "daughter", "wife", "lady", "madam"},
+}
+NOUN_GROUPS = {noun: group for group, nouns in GROUP_NOUNS.items() for noun in nouns}
+
+class CharacterIndex:
+    """
+    Finds the characters of a story from spaCy's named entities and resolves subject pronouns
+    ("he", "she", "they") to them, one sentence at a time so a long story can be streamed through it.
+
+    Pronoun groups are only learned from the text itself: "a boy named Aiden", "Musfira was a girl", or a
+    pronoun used in a sentence that mentions exactly one character.
+    """
+    def __init__(self):
+        self.names = set()
+        self.groups = {}
+        self.sentence_characters = []
+        self.recency = []
+        self.most_recent_before = []
+        self._order = OrderedDict()
+        self._previous_characters = []
+
+    def add(self, sentence) -> int:
+        """
+        Adds the next sentence of the story.
+
+        Args:
+            sentence (spacy.tokens.Span): the parsed sentence
+
+        Returns:
+            The index of the sentence.
+        """
+        person_roots = {ent.root.i for ent in sentence.ents if ent.label_ == "PERSON"}
+        self.names.update(token.text.lower() for token in sentence if token.i in person_roots)
+        self.most_recent_before.append(next(reversed(self._order)) if self._order else None)
+
+        named = list(dict.fromkeys(token.text.lower() for token in sentence if self._is_character(token, person_roots)))
+        self._learn_groups(sentence, named, person_roots)
+
+        characters = list(named)
+        for token in sentence:
+            group = PRONOUN_GROUPS.get(token.text.lower())
+            if group and token.dep_ in SUBJECT_DEPENDENCIES:
+                for character in self._resolve(group):
+                    if character not in characters:
+                        characters.append(character)
+
+        for character in characters:
+            self._order[character] = None
+            self._order.move_to_end(character)
+        if characters:
+            self._previous_characters = characters
+        self.sentence_characters.append(characters)
+        self.recency.append(tuple(self._order))
+        return len(self.sentence_characters) - 1
+
+    def characters_in(self, index : int) -> list:
+        """Returns the characters acting in a sentence, named ones first, in mention order."""
+        return self.sentence_characters[index]
+
+    def most_recent(self, index : int):
+        """Returns the most recently mentioned character before a sentence, or None."""
+        return self.most_recent_before[index]
+
+    def known_characters(self, index : int) -> tuple:
+        """Returns every character mentioned up to and including a sentence, least recent first."""
+        return self.recency[index]
+
+    def _is_character(self, token, person_roots : set) -> bool:
+        if token.i in person_roots:
+            return True
+        if token.pos_ != "PROPN" or token.ent_type_ not in ("", "PERSON"):
+            return False
+        # spaCy does not tag every mention of a name, so reuse names it already tagged and proper noun subjects
+        return token.text.lower() in self.names or token.dep_ in SUBJECT_DEPENDENCIES
+
+    def _learn_groups(self, sentence, named : list, person_roots : set):
+        for token in sentence:
+            if not self._is_character(token, person_roots):
+                continue
+            name = token.text.lower()
+            # "a boy named Aiden"
+            if token.head.lemma_ in ("name", "call") and token.head.head.lemma_.lower() in NOUN_GROUPS:
+                self.groups.setdefault(name, NOUN_GROUPS[token.head.head.lemma_.lower()])
+            # "Aiden was a boy"
+            if token.dep_ in SUBJECT_DEPENDENCIES:
+                for child in token.head.children:
+                    if child.dep_ == "attr" and child.lemma_.lower() in NOUN_GROUPS:
+                        self.groups.setdefault(name, NOUN_GROUPS[child.lemma_.lower()])
+
+        if len(named) == 1:
+            for token in sentence:
+                group = PRONOUN_GROUPS.get(token.text.lower())
+                if group and group != "plural":
+                    self.groups.setdefault(named[0], group)
+
+    def _resolve(self, group : str) -> list:
+        if group == "plural":
+            return list(self._previous_characters)
+        fallback = None
+        for character in reversed(self._order):
+            bound = self.groups.get(character)
+            if bound == group:
+                return [character]
+            if bound is None and fallback is None:
+                fallback = character
+        return [fallback] if fallback else []
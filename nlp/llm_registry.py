@@ -0,0 +1,309 @@
+from nlp.prompt_cache import get_prompt_cache
+from orchestration.profiling import span
+from collections import OrderedDict
+import gc, threading, time
+
+DEFAULT_MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+# how many prompt prefixes keep their attention cache, a story only needs one at a time
+PREFIX_CACHE_SIZE = 2
+
+class ModelRegistry:
+    """
+    Holds a single text-generation model, tokenizer and pipeline for the whole process.
+
+    The model is loaded the first time it is requested and kept resident until `unload` is called
+    or, if `idle_timeout` is set, until it has not been used for that many seconds.
+    """
+    def __init__(self, model_id=DEFAULT_MODEL_ID, device="cuda", torch_dtype="auto", idle_timeout=None):
+        self.model_id = model_id
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.idle_timeout = idle_timeout
+        self.model = None
+        self.tokenizer = None
+        self.pipe = None
+        self.last_used = 0.0
+        self._lock = threading.RLock()
+        self._timer = None
+        self._prefix_cache = OrderedDict()
+        # grammar name -> GrammarLogitsProcessor, which keeps the tokens allowed in each grammar state
+        self._grammar_cache = {}
+
+    def configure(self, model_id=None, device=None, torch_dtype=None, idle_timeout=None):
+        """
+        Changes the registry settings. A loaded model is unloaded if the model, device or dtype changed.
+
+        Args:
+            model_id (str): the huggingface id of the causal language model
+            device (str): the device map used when loading the model (e.g. "cuda", "cpu", "auto")
+            torch_dtype (str | torch.dtype): the dtype used when loading the model
+            idle_timeout (float): seconds of inactivity before the model is unloaded, 0 disables it
+        """
+        with self._lock:
+            changed = False
+            if model_id is not None and model_id != self.model_id:
+                self.model_id, changed = model_id, True
+            if device is not None and device != self.device:
+                self.device, changed = device, True
+            if torch_dtype is not None and torch_dtype != self.torch_dtype:
+                self.torch_dtype, changed = torch_dtype, True
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout or None
+            if changed:
+                self.unload()
+
+    def load(self):
+        """
+        Loads the model, tokenizer and pipeline if they are not already loaded.
+
+        Returns:
+            The text-generation pipeline.
+        """
+        with self._lock:
+            if self.pipe is None:
+                from transformers import AutoModelForCausalLM, pipeline
+                print(f"Loading {self.model_id} on {self.device}")
+                with span("load " + self.model_id, "model"):
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                            self.model_id,
+                            device_map=self.device,
+                            torch_dtype=self.torch_dtype,
+                            trust_remote_code=True,
+                        )
+                    self.load_tokenizer()
+                    self.pipe = pipeline(
+                            "text-generation",
+                            model=self.model,
+                            tokenizer=self.tokenizer,
+                        )
+            self._touch()
+            return self.pipe
+
+    def load_tokenizer(self):
+        """Loads only the tokenizer, which is enough to count tokens."""
+        with self._lock:
+            if self.tokenizer is None:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+            return self.tokenizer
+
+    def count_tokens(self, text : str) -> int:
+        """Returns how many tokens the model reads for a text."""
+        return len(self.load_tokenizer()(text, add_special_tokens=False).input_ids)
+
+    def unload(self):
+        """Releases the model and frees its memory."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._prefix_cache.clear()
+            # the allowed tokens belong to the tokenizer
+            self._grammar_cache.clear()
+            if self.pipe is None:
+                self.tokenizer = None
+                return
+            import torch
+            self.model, self.tokenizer, self.pipe = None, None, None
+            gc.collect()
+            torch.cuda.empty_cache()
+            print(f"Unloaded {self.model_id}")
+
+    def is_loaded(self) -> bool:
+        """Returns whether the model is currently resident."""
+        return self.pipe is not None
+
+    def generate(self, messages, prefix=None, grammar=None, **generation_args):
+        """
+        Runs the shared pipeline on a chat message list. Outputs are looked up in and stored to the
+        prompt cache, so the model is only loaded when a prompt has not been seen before.
+
+        Args:
+            messages (list): the chat messages given to the pipeline
+            prefix (str): text the first message starts with and other prompts share (e.g. the story), its
+                attention cache is computed once and reused by every prompt that starts with it
+            grammar: a grammar from `nlp.structured_output` the output is constrained to
+            generation_args (dict): the keyword arguments given to the pipeline
+
+        Returns:
+            The raw pipeline output.
+        """
+        cache = get_prompt_cache()
+        key = cache.make_key(self.model_id, messages, dict(generation_args, grammar=grammar.name) if grammar else generation_args)
+        output = cache.get(key)
+        if output is not None:
+            return output
+        with self._lock:
+            pipe = self.load()
+            if grammar is not None:
+                generation_args = dict(generation_args, logits_processor=self._grammar_processors(grammar))
+            with span("llm generate", "generate", prefix=bool(prefix), grammar=grammar.name if grammar else None):
+                if prefix:
+                    output = self._generate_from_prefix(messages, prefix, generation_args)
+                else:
+                    output = pipe(messages, **generation_args)
+            self._touch()
+        cache.put(key, output)
+        return output
+
+    def _generate_from_prefix(self, messages, prefix : str, generation_args : dict) -> list:
+        """Generates with the prefix's cached keys and values so only the rest of the prompt is prefilled."""
+        import copy, torch
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        split = text.find(prefix)
+        if split < 0:
+            return self.pipe(messages, **generation_args)
+        split += len(prefix)
+
+        prefix_ids = self.tokenizer(text[:split], add_special_tokens=False, return_tensors="pt").input_ids.to(self.model.device)
+        suffix_ids = self.tokenizer(text[split:], add_special_tokens=False, return_tensors="pt").input_ids.to(self.model.device)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1)
+
+        args = {name: value for name, value in generation_args.items() if name != "return_full_text"}
+        if not args.get("do_sample"):
+            args.pop("temperature", None)
+        with torch.no_grad():
+            output_ids = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                             past_key_values=copy.deepcopy(self._prefix_keys_values(text[:split], prefix_ids)),
+                                             pad_token_id=self._pad_token_id(), **args)
+        # the same format the text-generation pipeline returns without the full text
+        return [{'generated_text': self.tokenizer.decode(output_ids[0, input_ids.shape[-1]:], skip_special_tokens=True)}]
+
+    def _generate_batch_from_prefix(self, messages_list : list, prefix : str, generation_args : dict) -> list:
+        """
+        Generates a batch whose prompts share a prefix. The prefix's cached keys and values are repeated for every row
+        and each row is laid out as [prefix][padding][rest of the prompt], with the padding masked out, so the rows
+        stay aligned with the cache and only the rest of each prompt is prefilled.
+        """
+        import copy, torch
+        texts = [self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in messages_list]
+        splits = [text.find(prefix) for text in texts]
+        if min(splits) < 0 or len({text[:split + len(prefix)] for text, split in zip(texts, splits)}) > 1:
+            # the rows do not start the same way, pad them like the pipeline does
+            return self.pipe(messages_list, batch_size=len(messages_list), **generation_args)
+        split = splits[0] + len(prefix)
+
+        device = self.model.device
+        pad_token_id = self._pad_token_id()
+        prefix_ids = self.tokenizer(texts[0][:split], add_special_tokens=False, return_tensors="pt").input_ids.to(device)
+        suffixes = [self.tokenizer(text[split:], add_special_tokens=False).input_ids for text in texts]
+        width = max(len(suffix) for suffix in suffixes)
+        suffix_ids, suffix_mask = [], []
+        for suffix in suffixes:
+            padding = width - len(suffix)
+            suffix_ids.append([pad_token_id] * padding + suffix)
+            suffix_mask.append([0] * padding + [1] * len(suffix))
+        rows = len(suffixes)
+        input_ids = torch.cat([prefix_ids.expand(rows, -1), torch.tensor(suffix_ids, dtype=torch.long, device=device)], dim=-1)
+        attention_mask = torch.cat([torch.ones((rows, prefix_ids.shape[-1]), dtype=torch.long, device=device),
+                                    torch.tensor(suffix_mask, dtype=torch.long, device=device)], dim=-1)
+
+        keys_values = copy.deepcopy(self._prefix_keys_values(texts[0][:split], prefix_ids))
+        keys_values.batch_repeat_interleave(rows)
+        args = {name: value for name, value in generation_args.items() if name != "return_full_text"}
+        if not args.get("do_sample"):
+            args.pop("temperature", None)
+        with torch.no_grad():
+            output_ids = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, past_key_values=keys_values,
+                                             pad_token_id=pad_token_id, **args)
+        # the same format the text-generation pipeline returns for each prompt without the full text
+        return [[{'generated_text': self.tokenizer.decode(ids[input_ids.shape[-1]:], skip_special_tokens=True)}] for ids in output_ids]
+
+    def _pad_token_id(self) -> int:
+        """The tokenizer's pad token, its end of sequence token when it has none (0 is a valid pad token)."""
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    def _grammar_processors(self, grammar):
+        """Returns the logits processors for a grammar, reusing its processor and allowed tokens across calls."""
+        from transformers import LogitsProcessorList
+        from nlp.structured_output import GrammarLogitsProcessor
+        if grammar.name not in self._grammar_cache:
+            eos_token_ids = self.model.generation_config.eos_token_id
+            if not isinstance(eos_token_ids, (list, tuple)):
+                eos_token_ids = [eos_token_ids]
+            self._grammar_cache[grammar.name] = GrammarLogitsProcessor(grammar, self.tokenizer, list(eos_token_ids) + [self.tokenizer.eos_token_id])
+        processor = self._grammar_cache[grammar.name]
+        processor.reset()
+        return LogitsProcessorList([processor])
+
+    def _prefix_keys_values(self, prefix_text : str, prefix_ids):
+        """Returns the attention cache of a prompt prefix, computing it on first use."""
+        import torch
+        from transformers import DynamicCache
+        if prefix_text in self._prefix_cache:
+            self._prefix_cache.move_to_end(prefix_text)
+            return self._prefix_cache[prefix_text]
+        with torch.no_grad():
+            keys_values = self.model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        self._prefix_cache[prefix_text] = keys_values
+        while len(self._prefix_cache) > PREFIX_CACHE_SIZE:
+            self._prefix_cache.popitem(last=False)
+        return keys_values
+
+    def generate_batch(self, messages_list : list, batch_size : int = 8, prefix=None, **generation_args) -> list:
+        """
+        Runs the shared pipeline on many chat message lists, padding them into batches.
+
+        Args:
+            messages_list (list): one chat message list per prompt
+            batch_size (int): the number of prompts padded together in one forward pass
+            prefix (str): text every first message starts with (e.g. the story context), its attention cache is
+                computed once and expanded across the rows of each batch
+            generation_args (dict): the keyword arguments given to the pipeline
+
+        Returns:
+            A list with the raw pipeline output of each prompt, in input order.
+        """
+        cache = get_prompt_cache()
+        keys = [cache.make_key(self.model_id, messages, generation_args) for messages in messages_list]
+        outputs = [cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if not missing:
+            return outputs
+        with self._lock:
+            pipe = self.load()
+            # decoder-only models must be padded on the left so generation continues from the prompt
+            if pipe.tokenizer.pad_token is None:
+                pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+            pipe.tokenizer.padding_side = "left"
+            with span("llm generate batch", "generate", prompts=len(missing), prefix=bool(prefix)):
+                if prefix:
+                    generated = []
+                    for start in range(0, len(missing), batch_size):
+                        batch = [messages_list[i] for i in missing[start:start + batch_size]]
+                        generated.extend(self._generate_batch_from_prefix(batch, prefix, generation_args))
+                else:
+                    generated = pipe([messages_list[i] for i in missing], batch_size=batch_size, **generation_args)
+            self._touch()
+        for i, output in zip(missing, generated):
+            outputs[i] = output
+            cache.put(keys[i], output)
+        return outputs
+
+    def _touch(self):
+        """Marks the model as used and restarts the idle timer."""
+        self.last_used = time.monotonic()
+        if not self.idle_timeout:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.idle_timeout, self._unload_if_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _unload_if_idle(self):
+        with self._lock:
+            if self.idle_timeout and time.monotonic() - self.last_used >= self.idle_timeout:
+                self.unload()
+
+_registry = ModelRegistry()
+
+def get_registry() -> ModelRegistry:
+    """Returns the process-wide model registry."""
+    return _registry
+
+def configure_registry(**kwargs):
+    """Configures the process-wide model registry, see `ModelRegistry.configure`."""
+    _registry.configure(**kwargs)
@@ -1,6 +1,15 @@
-# Load model directly
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import torch, gc, random
+from nlp.llm_registry import get_registry
+from nlp.structured_output import TupleGrammar, StringListGrammar, parse_tuple, parse_string_list
+from functools import lru_cache
+import itertools, re
+
+# Phi-3 mini reads 4k tokens, the rest of the window is left for the task and the answer
+STORY_TOKEN_BUDGET = 3072
+
+def _reseed():
+    """Reseeds torch so sampled prompts differ between calls (torch is imported on first use)."""
+    import torch
+    torch.random.seed()
 
 def estimate_sentence_length(sentence):
     """
@@ -18,43 +27,114 @@ def estimate_sentence_length(sentence):
 # Code taken from https://huggingface.co/microsoft/Phi-3-mini-4k-instruct #
 ###########################################################################
 
-def get_object_list(story):
+def fit_story(story : str, max_tokens : int = STORY_TOKEN_BUDGET, focus=()) -> str:
     """
-    Uses Microsoft Phi to decide acceptable objects to be generated for the story.
+    Shortens a story that does not fit the token budget. The opening (where the characters and the setting
+    are introduced) is kept, then the sentences around the focus, and the gaps are marked with "...".
 
     Args:
-        story (str): the entire story whose background objects will be interpreted
+        story (str): the entire story
+        max_tokens (int): the most tokens the story may take
+        focus (list): sentences the context should be centred on, e.g. the sentences being prompted
 
     Returns:
-        A python list containing possible objects.
+        The story, or the part of it that fits.
+    """
+    # every token covers at least one character, so short stories never need the tokenizer
+    if len(story) <= max_tokens:
+        return story
+    model_id = get_registry().model_id
+    sentences, compact = _split_story(story)
+    # the sentences are tokenized once, every later context of the story reuses their counts
+    lengths = [_count_tokens(model_id, sentence) + 1 for sentence in sentences]
+    if sum(lengths) <= max_tokens:
+        return story
+    focus_indices = [i for i, sentence in enumerate(compact) if any(''.join(text.split()) in sentence for text in focus)]
+
+    # the opening takes up to a third of the budget, the focus and then the rest of the story fill the remainder
+    opening = []
+    used = 0
+    for i, length in enumerate(lengths):
+        if used + length > max_tokens // 3:
+            break
+        opening.append(i)
+        used += length
+    around_focus = (index + step for offset in range(len(sentences)) for index in focus_indices for step in (-offset, offset))
+    kept = set()
+    used = 0
+    shortest = min(lengths)
+    for i in itertools.chain(opening, around_focus, range(len(sentences))):
+        if used + shortest > max_tokens:
+            break
+        if 0 <= i < len(sentences) and i not in kept and used + lengths[i] <= max_tokens:
+            kept.add(i)
+            used += lengths[i]
+
+    parts = []
+    for i in sorted(kept):
+        if parts and i - 1 not in kept:
+            parts.append("...")
+        parts.append(sentences[i])
+    return " ".join(parts)
+
+@lru_cache(maxsize=4)
+def _split_story(story : str) -> tuple:
+    """Returns the sentences of a story and the same sentences without whitespace, for matching the focus."""
+    sentences = tuple(re.split(r'(?<=[.!?])\s+', story.strip()))
+    return sentences, tuple(''.join(sentence.split()) for sentence in sentences)
+
+@lru_cache(maxsize=65536)
+def _count_tokens(model_id : str, text : str) -> int:
+    return get_registry().count_tokens(text)
+
+def story_context(story : str, focus=()) -> str:
     """
+    The story context prompts start with, shortened around `focus` when the story does not fit the token budget.
 
-    torch.random.seed()
+    Build it once per story or chunk and give it to every prompt of that chunk: prompts that start with the
+    same context share its attention cache.
+
+    Args:
+        story (str): the entire story
+        focus (list): the sentences of the chunk, nothing for prompts about the whole story
 
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
+    Returns:
+        The context, which ends with a blank line.
+    """
+    return "Here is a story: \"" + fit_story(story, focus=focus) + "\"\n\n"
+
+def _clean_output(output) -> str:
+    """Strips the markdown code fences Phi wraps around its answers."""
+    return str(output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip())
+
+OBJECT_LIST_GRAMMAR = StringListGrammar()
+OBJECT_LIST_GENERATION_ARGS = {
+        "max_new_tokens": 64,
+        "return_full_text": False,
+        "do_sample": False,
+    }
+SETTING_GENERATION_ARGS = {
+        "max_new_tokens": 77,
+        "return_full_text": False,
+        "do_sample": False,
+    }
 
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
+def get_object_list(story):
+    """
+    Uses Microsoft Phi to decide acceptable objects to be generated for the story.
 
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    Args:
+        story (str): the entire story whose background objects will be interpreted
 
-    generation_args = {
-            "max_new_tokens": 500,
-            "return_full_text": False,
-            "temperature": 0.0,
-            "do_sample": False,
-        }
+    Returns:
+        A python list containing possible objects.
+    """
+
+    _reseed()
 
-    object_prompt = "What are some very simple background objects which stand on the ground that would make sense for this story: \"" + story + "\" Return the 1-word objects in a python list."
-    background_prompt = "What is a detailed prompt for an AI image generator with the task of generating a background image relating to this story's location: \"" + story + "\" Don't include any characters or objects in the prompt, it should be the setting only. It also has to be less than 77 tokens."
+    prefix = story_context(story)
+    object_prompt = prefix + "What are some very simple background objects which stand on the ground that would make sense for this story? Return the 1-word objects in a JSON list."
+    background_prompt = prefix + "What is a detailed prompt for an AI image generator with the task of generating a background image relating to this story's location? Don't include any characters or objects in the prompt, it should be the setting only. It also has to be less than 77 tokens."
 
     obj_message = [
         {"role": "user", "content" : object_prompt},
@@ -64,23 +144,18 @@ def get_object_list(story):
         {"role": "user", "content" : background_prompt},
     ]
 
-    obj_output = pipe(obj_message, **generation_args)
-    list_string = obj_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
-
-    setting_output = pipe(setting_message, **generation_args)
-    setting = setting_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
+    obj_output = get_registry().generate(obj_message, prefix=prefix, grammar=OBJECT_LIST_GRAMMAR, **OBJECT_LIST_GENERATION_ARGS)
+    list_string = obj_output[0]['generated_text']
 
-    del obj_output, model, tokenizer, pipe, generation_args, setting_output
-    gc.collect()
-    torch.cuda.empty_cache()
+    setting_output = get_registry().generate(setting_message, prefix=prefix, **SETTING_GENERATION_ARGS)
+    setting = _clean_output(setting_output)
 
     try:
-        output = eval(list_string)
-        return [output, str(setting)]
-    except:
-        print("Generated object list was not in the correct format. Run MARTA again.")
+        return [parse_string_list(list_string), setting]
+    except ValueError as e:
+        print(f"Ignoring the generated object list: {e}")
+        return [[], setting]
 
-    
 def get_background_prompt(story):
     """
     Uses Microsoft Phi to decide acceptable objects to be generated for the story.
@@ -91,22 +166,7 @@ def get_background_prompt(story):
     Returns:
         The string prompt for the background image.
     """
-    torch.random.seed()
-
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
-
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
-
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    _reseed()
 
     generation_args = {
             "max_new_tokens": 500,
@@ -114,20 +174,32 @@ def get_background_prompt(story):
             "temperature": 0.1,
             "do_sample": True,
         }
-    background_prompt = "Create a prompt for generating a detailed background image based on the setting described in: \"" + story + "\". The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
+    prefix = story_context(story)
+    background_prompt = prefix + "Create a prompt for generating a detailed background image based on the setting described in the story. The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
     setting_message = [
         {"role": "user", "content" : background_prompt},
     ]
 
-    setting_output = pipe(setting_message, **generation_args)
+    setting_output = get_registry().generate(setting_message, prefix=prefix, **generation_args)
     setting = setting_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
 
-    del model, tokenizer, pipe, generation_args, setting_output
-    gc.collect()
-    torch.cuda.empty_cache()
     print(setting)
     return str(setting)
 
+def _animation_message(sentence : str, character : str) -> list:
+    """Builds the chat message asking for a character's animation prompt."""
+    action_prompt = "Generate a simple and clear action prompt for an AI human motion generator.  The action should be appropriate for the character: " + character + " based on the context provided in this sentence: \"" + sentence + "\". If there is an appropriate action for the character, return only the action prompt without punctuation. If no clear action is suitable, return the word 'idle'." # and with the characters replaced with \"a person\""
+    return [
+        {"role": "user", "content" : action_prompt},
+    ]
+
+ANIMATION_GENERATION_ARGS = {
+        "max_new_tokens": 500,
+        "return_full_text": False,
+        "temperature": 0.1,
+        "do_sample": True,
+    }
+
 def get_animation_prompt(sentence : str, character : str, story : str):
     """
     Uses Microsoft Phi to decide acceptable animations to be generated for the story.
@@ -138,42 +210,30 @@ def get_animation_prompt(sentence : str, character : str, story : str):
     Returns:
         The string prompt for the background animation.
     """
-    torch.random.seed()
+    _reseed()
 
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
+    action_output = get_registry().generate(_animation_message(sentence, character), **ANIMATION_GENERATION_ARGS)
+    return _clean_output(action_output)
 
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
-
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+def get_animation_prompts(pairs : list, story : str, batch_size : int = 8) -> list:
+    """
+    Batched version of `get_animation_prompt`.
 
-    generation_args = {
-            "max_new_tokens": 500,
-            "return_full_text": False,
-            "temperature": 0.1,
-            "do_sample": True,
-        }
-    
-    action_prompt = "Generate a simple and clear action prompt for an AI human motion generator.  The action should be appropriate for the character: " + character + " based on the context provided in this sentence: \"" + sentence + "\". If there is an appropriate action for the character, return only the action prompt without punctuation. If no clear action is suitable, return the word 'idle'." # and with the characters replaced with \"a person\""
-    action_message = [
-        {"role": "user", "content" : action_prompt},
-    ]
+    Args:
+        pairs (list): (sentence, character) tuples that need an animation prompt
+        story (str): the entire story
+        batch_size (int): the number of prompts padded together in one forward pass
 
-    action_output = pipe(action_message, **generation_args)
-    action = action_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
+    Returns:
+        A list of animation prompts in the same order as `pairs`.
+    """
+    if not pairs:
+        return []
+    _reseed()
 
-    del model, tokenizer, pipe, generation_args, action_output
-    gc.collect()
-    torch.cuda.empty_cache()
-    return str(action)
+    messages = [_animation_message(sentence, character) for sentence, character in pairs]
+    outputs = get_registry().generate_batch(messages, batch_size=batch_size, **ANIMATION_GENERATION_ARGS)
+    return [_clean_output(output) for output in outputs]
 
 def get_floor_prompt(story : str) -> str:
     """
@@ -185,22 +245,7 @@ def get_floor_prompt(story : str) -> str:
     Returns:
         A string prompt for the image generator.
     """
-    torch.random.seed()
-
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
-
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
-
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    _reseed()
 
     generation_args = {
             "max_new_tokens": 77,
@@ -209,67 +254,78 @@ def get_floor_prompt(story : str) -> str:
             "do_sample": True,
         }
     
-    ground_prompt = "Create a 1 word prompt (such as 'grass' or 'gravel') for generating a floor texture based on the setting described in: \"" + story + "\". The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
+    prefix = story_context(story)
+    ground_prompt = prefix + "Create a 1 word prompt (such as 'grass' or 'gravel') for generating a floor texture based on the setting described in the story. The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
 
     ground_message = [
         {"role": "user", "content" : ground_prompt},
     ]
 
-    ground_output = pipe(ground_message, **generation_args)
+    ground_output = get_registry().generate(ground_message, prefix=prefix, **generation_args)
     ground = ground_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
 
-    del model, tokenizer, pipe, generation_args, ground_output
-    gc.collect()
-    torch.cuda.empty_cache()
     print(ground)
     return str(ground)
 
-def get_audio_prompt(sentence, story):
+def _audio_message(sentence : str, prefix : str) -> list:
+    """Builds the chat message asking for a sentence's music prompt."""
+    background_prompt = prefix + "What is a simple prompt that can be given to an AI audio generator in this story for this specific sentence: \"" + sentence + "\" You should return the prompt so that it can be read as a python string. It should describe the type or style of music that fits the sentence."
+    return [
+        {"role": "user", "content" : background_prompt},
+    ]
+
+AUDIO_GENERATION_ARGS = {
+        "max_new_tokens": 500,
+        "return_full_text": False,
+        "temperature": 0.1,
+        "do_sample": True,
+    }
+
+def get_audio_prompt(sentence, story, context=None):
     """
     Uses Microsoft Phi to decide acceptable objects to be generated for the story.
 
     Args:
         story (str): the entire story whose background objects will be interpreted
+        context (str): the `story_context` of the sentence's chunk, the whole story's by default
 
     Returns:
         The string prompt for the background image.
     """
-    torch.random.seed()
-
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
+    _reseed()
 
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-medium-4k-instruct")
+    prefix = context or story_context(story)
+    setting_output = get_registry().generate(_audio_message(sentence, prefix), prefix=prefix, **AUDIO_GENERATION_ARGS)
+    setting = _clean_output(setting_output)
 
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    print(setting)
+    return setting
 
-    generation_args = {
-            "max_new_tokens": 500,
-            "return_full_text": False,
-            "temperature": 0.1,
-            "do_sample": True,
-        }
-    background_prompt = "What is a simple prompt that can be given to an AI audio generator in this story: \"" + story + "\" for this specific sentence sentence: \"" + sentence + "\" You should return the prompt so that it can be read as a python string. It should describe the type or style of music that fits the sentence."
-    setting_message = [
-        {"role": "user", "content" : background_prompt},
-    ]
+def get_audio_prompts(sentences : list, story : str, batch_size : int = 8, context : str = None) -> list:
+    """
+    Batched version of `get_audio_prompt`. Every prompt starts with the same context, whose attention cache is
+    computed once and shared by all rows of each batch.
 
-    setting_output = pipe(setting_message, **generation_args)
-    setting = setting_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
+    Args:
+        sentences (list): the sentences of a chunk
+        story (str): the entire story
+        batch_size (int): the number of prompts padded together in one forward pass
+        context (str): the `story_context` of the chunk, built around `sentences` by default
 
-    del model, tokenizer, pipe, generation_args, setting_output
-    gc.collect()
-    torch.cuda.empty_cache()
-    print(setting)
-    return str(setting)
+    Returns:
+        A list of music prompts, one per sentence.
+    """
+    if not sentences:
+        return []
+    _reseed()
+
+    prefix = context or story_context(story, sentences)
+    messages = [_audio_message(sentence, prefix) for sentence in sentences]
+    outputs = get_registry().generate_batch(messages, batch_size=batch_size, prefix=prefix, **AUDIO_GENERATION_ARGS)
+    prompts = [_clean_output(output) for output in outputs]
+    for prompt in prompts:
+        print(prompt)
+    return prompts
 
 def get_ceiling_prompt(story : str) -> str:
     """
@@ -281,22 +337,7 @@ def get_ceiling_prompt(story : str) -> str:
     Returns:
         A string prompt for the image generator.
     """
-    torch.random.seed()
-
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
-
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
-
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    _reseed()
 
     generation_args = {
             "max_new_tokens": 77,
@@ -305,67 +346,56 @@ def get_ceiling_prompt(story : str) -> str:
             "do_sample": True,
         }
     
-    ceiling_prompt = "Create a prompt for generating a detailed sky image based on the setting described in: \"" + story + "\". The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
+    prefix = story_context(story)
+    ceiling_prompt = prefix + "Create a prompt for generating a detailed sky image based on the setting described in the story. The prompt should focus on the environment, capturing the mood and atmosphere without including characters or objects. Ensure the final prompt is concise and suitable for an image generator and less than 77 tokens."
 
     ceiling_message = [
         {"role": "user", "content" : ceiling_prompt},
     ]
 
-    ceiling_output = pipe(ceiling_message, **generation_args)
+    ceiling_output = get_registry().generate(ceiling_message, prefix=prefix, **generation_args)
     ceiling = ceiling_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
 
-    del model, tokenizer, pipe, generation_args, ceiling_output
-    gc.collect()
-    torch.cuda.empty_cache()
 
     return str(ceiling)
 
-def get_next_movement(current_sentence : str, current_character : str, story : str, character_positions : dict, animation_name : str) -> tuple:
+POSITION_GRAMMAR = TupleGrammar(min_size=2, max_size=3)
+POSITION_GENERATION_ARGS = {
+        "max_new_tokens": 24,
+        "return_full_text": False,
+        "do_sample": False,
+    }
+
+def get_next_movement(current_sentence : str, current_character : str, story : str, character_positions : dict, animation_name : str, context : str = None) -> tuple:
     """
-    Uses Microsoft Phi to decide acceptable character movement for the story.
+    Uses Microsoft Phi to decide acceptable character movement for the story. Generation is constrained to a
+    tuple of numbers and stops at its closing bracket.
 
     Args:
-        story (str): the entire story whose background objects will be interpreted
+        current_sentence (str): the sentence the character moves in
+        current_character (str): the name of the character
+        story (str): the entire story
+        character_positions (dict): the recent positions of every character
+        animation_name (str): the animation the character performs over the sentence
+        context (str): the `story_context` of the sentence's chunk, the whole story's by default
 
     Returns:
-        The string prompt for the background image.
-    """
-    torch.random.seed()
+        The (x, y, 0) position at the end of the sentence.
 
-    model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/Phi-3-mini-4k-instruct", 
-            device_map="cuda", 
-            torch_dtype="auto", 
-            trust_remote_code=True, 
-        )
-
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
-
-    pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-        )
+    Raises:
+        ValueError: the model did not return a tuple of numbers.
+    """
+    _reseed()
 
-    generation_args = {
-            "max_new_tokens": 500,
-            "return_full_text": False,
-            "temperature": 0.0,
-            "do_sample": False,
-        }
-    
-    position_prompt = "You must hypothesize the position that the character will move to by the end of the sentence. For context, the entire story is \"" + story + "\". The current character is: " + current_character + ". The current sentence is: \"" + current_sentence + "\" The name of the animation the character performs over this sentence is: " + animation_name + ". For more context, here are the previous vector coordinates of this character and the other characters in the story: " + "".join([name + ": " + "".join([str(p) + "," for p in positions]) for name, positions in character_positions.items()]) + ". Provide the new estimated Vector position for the character in a python tuple. It should only be the tuple, no other tokens. If you fail to provide a response that python can evaluate, the program will fail. Also ensure that different characters are not in the same position."
+    prefix = context or story_context(story)
+    position_prompt = prefix + "You must hypothesize the position that the character will move to by the end of the sentence. The current character is: " + current_character + ". The current sentence is: \"" + current_sentence + "\" The name of the animation the character performs over this sentence is: " + animation_name + ". For more context, here are the previous vector coordinates of this character and the other characters in the story: " + "".join([name + ": " + "".join([str(tuple(p)) + "," for p in positions]) for name, positions in character_positions.items()]) + ". Provide the new estimated position for the character as an (x, y, 0) tuple. It should only be the tuple, no other tokens. Also ensure that different characters are not in the same position."
     position_message = [
         {"role": "user", "content" : position_prompt},
     ]
 
-    position_output = pipe(position_message, **generation_args)
-    new_positon = position_output[0]['generated_text'].replace('```python\n', '').replace('\n```', '').strip()
-
-    del model, tokenizer, pipe, generation_args, position_output
-    gc.collect()
-    torch.cuda.empty_cache()
-    return eval(new_positon)
+    position_output = get_registry().generate(position_message, prefix=prefix, grammar=POSITION_GRAMMAR, **POSITION_GENERATION_ARGS)
+    position = parse_tuple(position_output[0]['generated_text'])
+    return (position[0], position[1], 0)
 
 if __name__ == "__main__":
     print(get_background_prompt("There was a boy named Aiden and girl named Musfira in a classroom. Aiden started dancing while Musfira jumped up and down. After, Aiden sat on the ground exhausted while Musfira spun around."))
@@ -0,0 +1,162 @@
+import math, re
+
+# AnimationHandler.create_box scales a 2 unit cube by this, so the floor spans -100..100 in Blender units
+BOX_SIZE = 100
+# the renderer multiplies every timeline position by this
+POSITION_MULTIPLIER = 30
+# how far (timeline units) characters are kept from the walls and from each other
+WALL_MARGIN = 0.5
+MIN_DISTANCE = 0.75
+# how many past positions of each character the LLM sees
+HISTORY_WINDOW = 4
+
+# (word stems, distance moved in timeline units over one sentence), the first match wins
+MOVEMENT_RULES = (
+    (("run", "ran", "sprint", "jog", "chase", "rush", "dash", "race", "flee", "fled"), 2.0),
+    (("walk", "stroll", "step", "march", "wander", "pace", "approach", "go ", "went", "move"), 1.0),
+    (("leap", "hop", "jump forward", "skip"), 0.75),
+    (("crawl", "creep", "sneak", "tiptoe"), 0.5),
+    (("sit", "sat", "stand", "stood", "idle", "still", "wait", "kneel", "knelt", "lie", "lay", "sleep", "slept",
+      "danc", "spin", "jump", "wave", "clap", "talk", "look", "eat", "ate", "drink", "drank", "laugh", "cry", "cried"), 0.0),
+)
+BACKWARD_WORDS = ("back", "backward", "backwards", "retreat")
+TURN_WORDS = {"left": math.pi / 2, "right": -math.pi / 2, "around": math.pi}
+AWAY_WORDS = ("away", "flee", "flees", "fled", "escape", "escapes")
+
+class PositionPlanner:
+    """
+    Decides where each character ends a sentence from its animation prompt and the positions so far.
+
+    A deterministic rule engine maps the prompt to a distance and a heading, then keeps the character inside
+    the box the renderer builds and away from the other characters. The LLM is only consulted, with a bounded
+    window of history, when `use_llm` is set and no rule matches the prompt.
+    """
+    def __init__(self, use_llm=False, history_window=HISTORY_WINDOW, min_distance=MIN_DISTANCE):
+        self.use_llm = use_llm
+        self.history_window = history_window
+        self.min_distance = min_distance
+        self.bound = BOX_SIZE / POSITION_MULTIPLIER - WALL_MARGIN
+
+    def configure(self, use_llm=None, history_window=None, min_distance=None):
+        """Changes the planner settings, arguments left as None keep their value."""
+        if use_llm is not None:
+            self.use_llm = use_llm
+        if history_window is not None:
+            self.history_window = history_window
+        if min_distance is not None:
+            self.min_distance = min_distance
+
+    def settings(self) -> dict:
+        """Returns the settings that change the planned positions."""
+        return {'use_llm': self.use_llm, 'history_window': self.history_window, 'min_distance': self.min_distance}
+
+    def plan(self, sentence : str, character : str, story : str, character_positions : dict, animation_prompt : str, context : str = None) -> tuple:
+        """
+        Plans where a character is at the end of a sentence.
+
+        Args:
+            sentence (str): the current sentence
+            character (str): the name of the character (lowercase)
+            story (str): the entire story, only used when the LLM is consulted
+            character_positions (dict): every character's positions so far
+            animation_prompt (str): the animation the character performs over the sentence
+            context (str): the `story_context` of the sentence's chunk for the LLM, the whole story's by default
+
+        Returns:
+            The (x, y, 0) end position in timeline units.
+        """
+        history = character_positions.get(character) or [(len(character_positions), 0, 0)]
+        start = _xy(history[-1])
+        others = [_xy(positions[-1]) for name, positions in character_positions.items() if name != character and positions]
+
+        distance = _movement_distance(animation_prompt)
+        if distance is None and self.use_llm:
+            target = self._ask_llm(sentence, character, story, character_positions, animation_prompt, context)
+        else:
+            heading = self._heading(animation_prompt, character, history, start, character_positions)
+            distance = distance or 0.0
+            target = (start[0] + math.cos(heading) * distance, start[1] + math.sin(heading) * distance)
+
+        if target is None:
+            target = start
+        target = self._avoid(self._clamp(target), others)
+        return (round(target[0], 3), round(target[1], 3), 0)
+
+    def _heading(self, animation_prompt : str, character : str, history : list, start : tuple, character_positions : dict) -> float:
+        words = re.findall(r"[a-z]+", animation_prompt.lower())
+
+        # towards or away from another character named in the prompt
+        for name, positions in character_positions.items():
+            if name != character and name in words and positions:
+                other = _xy(positions[-1])
+                heading = math.atan2(other[1] - start[1], other[0] - start[0])
+                return heading + math.pi if any(word in AWAY_WORDS for word in words) else heading
+
+        # keep walking the way the character last moved, or towards the middle of the box
+        if len(history) > 1 and _xy(history[-1]) != _xy(history[-2]):
+            previous = _xy(history[-2])
+            heading = math.atan2(start[1] - previous[1], start[0] - previous[0])
+        elif start != (0, 0):
+            heading = math.atan2(-start[1], -start[0])
+        else:
+            heading = math.pi / 2
+
+        if any(word in BACKWARD_WORDS for word in words):
+            heading += math.pi
+        for word in words:
+            heading += TURN_WORDS.get(word, 0)
+        return heading
+
+    def _clamp(self, position : tuple) -> tuple:
+        return tuple(max(-self.bound, min(self.bound, value)) for value in position)
+
+    def _avoid(self, position : tuple, others : list) -> tuple:
+        """Pushes the position away from every character closer than `min_distance`, staying in the box."""
+        for _ in range(8):
+            moved = False
+            for other in others:
+                dx, dy = position[0] - other[0], position[1] - other[1]
+                distance = math.hypot(dx, dy)
+                if distance >= self.min_distance:
+                    continue
+                if distance == 0:
+                    # push towards the middle of the box, where there is room
+                    dx, dy, distance = -other[0] or 1.0, -other[1], math.hypot(-other[0] or 1.0, -other[1])
+                scale = self.min_distance / distance
+                position = self._clamp((other[0] + dx * scale, other[1] + dy * scale))
+                moved = True
+            if not moved:
+                break
+        return position
+
+    def _ask_llm(self, sentence : str, character : str, story : str, character_positions : dict, animation_prompt : str, context : str = None):
+        from nlp.nlp_manager import get_next_movement
+        recent_positions = {name: positions[-self.history_window:] for name, positions in character_positions.items()}
+        try:
+            position = get_next_movement(sentence, character, story, recent_positions, animation_prompt, context=context)
+            return (float(position[0]), float(position[1]))
+        except Exception as e:
+            print(f"Ignoring the LLM position for {character}: {e}")
+            return None
+
+def _xy(position) -> tuple:
+    return (float(position[0]), float(position[1]))
+
+def _movement_distance(animation_prompt : str):
+    """Returns how far the prompt moves the character, or None if no rule matches it."""
+    prompt = " " + animation_prompt.lower() + " "
+    for stems, distance in MOVEMENT_RULES:
+        if any(" " + stem in prompt for stem in stems):
+            return distance
+    return None
+
+_planner = PositionPlanner()
+
+def get_position_planner() -> PositionPlanner:
+    """Returns the process-wide position planner."""
+    return _planner
+
+def configure_position_planner(**kwargs) -> PositionPlanner:
+    """Configures the process-wide position planner, see `PositionPlanner.configure`."""
+    _planner.configure(**kwargs)
+    return _planner
@@ -0,0 +1,176 @@
+import atexit, hashlib, json, os, threading, time
+
+DEFAULT_CACHE_DIR = os.path.join(os.getcwd(), "nlp", "prompt_cache")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+class PromptCache:
+    """
+    Content-addressed on-disk cache for LLM outputs.
+
+    Entries are keyed by a hash of the model id, the chat messages (prompt template plus input text)
+    and the generation arguments. The least recently used entries are evicted once the cache grows
+    past `max_bytes`. Lookups only mark the index dirty, it is written by `put`, `clear` and `flush`.
+
+    Sampled calls (`do_sample=True`) are cached like greedy ones, so a repeated prompt gets its first sample
+    back, also in another story when the prompt does not contain the story (e.g. the animation prompt of the
+    same sentence). Set `bypass` (`--no-prompt-cache`) to sample every prompt again.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, bypass=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, "index.json")
+
+    def make_key(self, model_id : str, messages, generation_args : dict) -> str:
+        """
+        Builds the cache key of a generate call.
+
+        Args:
+            model_id (str): the huggingface id of the model
+            messages (list): the chat messages given to the model
+            generation_args (dict): the generation arguments (temperature, do_sample, ...)
+
+        Returns:
+            The hex digest identifying the call.
+        """
+        payload = json.dumps({"model": model_id, "messages": messages, "args": generation_args}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key : str):
+        """
+        Looks up a cached output.
+
+        Args:
+            key (str): the key from `make_key`
+
+        Returns:
+            The cached output or None on a miss (always None when bypassed).
+        """
+        if self.bypass:
+            return None
+        with self._lock:
+            index = self._load_index()
+            path = self._entry_path(key)
+            if key not in index or not os.path.isfile(path):
+                self._dirty |= index.pop(key, None) is not None
+                self.misses += 1
+                return None
+            try:
+                with open(path, encoding='utf-8') as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                index.pop(key, None)
+                self._dirty = True
+                self.misses += 1
+                return None
+            index[key]["last_access"] = time.time()
+            self._dirty = True
+            self.hits += 1
+            return value
+
+    def put(self, key : str, value):
+        """
+        Stores an output and evicts old entries if the cache is over its size limit.
+
+        Args:
+            key (str): the key from `make_key`
+            value: the JSON serialisable output to store
+        """
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            data = json.dumps(value, ensure_ascii=False)
+            with open(self._entry_path(key), 'w', encoding='utf-8') as f:
+                f.write(data)
+            index = self._load_index()
+            index[key] = {"size": len(data.encode("utf-8")), "last_access": time.time()}
+            self._evict()
+            self._save_index()
+
+    def clear(self):
+        """Deletes every cached entry."""
+        with self._lock:
+            for key in list(self._load_index()):
+                self._remove(key)
+            self._save_index()
+
+    def flush(self):
+        """Writes the index if lookups changed it since it was last written."""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            index = self._load_index()
+            return {"hits": self.hits, "misses": self.misses, "entries": len(index), "bytes": sum(entry["size"] for entry in index.values())}
+
+    def _entry_path(self, key : str) -> str:
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _load_index(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def _evict(self):
+        index = self._load_index()
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]["size"]
+            self._remove(key)
+
+    def _remove(self, key : str):
+        self._load_index().pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+_cache = PromptCache()
+atexit.register(_cache.flush)
+
+def get_prompt_cache() -> PromptCache:
+    """Returns the process-wide prompt cache."""
+    return _cache
+
+def configure_prompt_cache(cache_dir=None, max_bytes=None, bypass=None):
+    """
+    Configures the process-wide prompt cache.
+
+    Args:
+        cache_dir (str): the directory the entries are stored in
+        max_bytes (int): the size limit before least recently used entries are evicted
+        bypass (bool): when True, cached outputs are ignored so every prompt is sampled fresh
+    """
+    with _cache._lock:
+        if cache_dir is not None and cache_dir != _cache.cache_dir:
+            _cache.flush()
+            _cache.cache_dir = cache_dir
+            _cache._index = None
+        if max_bytes is not None:
+            _cache.max_bytes = max_bytes
+        if bypass is not None:
+            _cache.bypass = bypass
@@ -0,0 +1,211 @@
+import ast, math, weakref
+
+WHITESPACE = " \t\n"
+DIGITS = "0123456789"
+# characters allowed inside a string of a generated list
+WORD_CHARACTERS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ -'")
+
+class TupleGrammar:
+    """
+    A tuple of numbers such as `(1.5, -2, 0)`, written as a deterministic automaton over characters so
+    generation can be masked to it one token at a time.
+
+    Args:
+        min_size (int): the fewest numbers in the tuple
+        max_size (int): the most numbers in the tuple
+    """
+    def __init__(self, min_size=2, max_size=3):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.name = f"tuple[{min_size},{max_size}]"
+        self.characters = set(WHITESPACE + DIGITS + "()-.,")
+
+    def start(self):
+        return ("start", 0)
+
+    def step(self, state, character : str):
+        """Returns the state after reading a character, or None if the character is not allowed."""
+        phase, count = state
+        if phase == "start":
+            if character in WHITESPACE:
+                return state
+            return ("open", 0) if character == "(" else None
+        if phase == "open":
+            if character in WHITESPACE:
+                return state
+            if character == "-":
+                return ("sign", count)
+            return self._first_digit(count, character)
+        if phase == "sign":
+            return self._first_digit(count, character)
+        if phase in ("int", "zero", "frac"):
+            # python rejects leading zeros such as 01, so nothing but a point follows a leading 0
+            if character in DIGITS and phase != "zero":
+                return state
+            if character == "." and phase in ("int", "zero"):
+                return ("dot", count)
+            # the number ended
+            return self.step(("after", count + 1), character)
+        if phase == "dot":
+            return ("frac", count) if character in DIGITS else None
+        if phase == "after":
+            if character in WHITESPACE:
+                return state
+            if character == "," and count < self.max_size:
+                return ("open", count)
+            return ("done", count) if character == ")" and count >= self.min_size else None
+        return None
+
+    def _first_digit(self, count : int, character : str):
+        if character == "0":
+            return ("zero", count)
+        return ("int", count) if character in DIGITS else None
+
+    def accepts(self, state) -> bool:
+        return state[0] == "done"
+
+class StringListGrammar:
+    """
+    A JSON list of short strings such as `["tree", "rock"]`.
+
+    Args:
+        max_items (int): the most strings in the list
+        max_length (int): the longest string
+    """
+    def __init__(self, max_items=12, max_length=32):
+        self.max_items = max_items
+        self.max_length = max_length
+        self.name = f"list[{max_items},{max_length}]"
+        self.characters = set(WHITESPACE + '[]",') | WORD_CHARACTERS
+
+    def start(self):
+        return ("start", 0, 0)
+
+    def step(self, state, character : str):
+        """Returns the state after reading a character, or None if the character is not allowed."""
+        phase, count, length = state
+        if phase == "start":
+            if character in WHITESPACE:
+                return state
+            return ("open", 0, 0) if character == "[" else None
+        if phase in ("open", "comma"):
+            if character in WHITESPACE:
+                return state
+            if character == '"' and count < self.max_items:
+                return ("string", count, 0)
+            return ("done", count, 0) if character == "]" and phase == "open" else None
+        if phase == "string":
+            if character == '"':
+                return ("after", count + 1, 0) if length else None
+            return ("string", count, length + 1) if character in WORD_CHARACTERS and length < self.max_length else None
+        if phase == "after":
+            if character in WHITESPACE:
+                return state
+            if character == ",":
+                return ("comma", count, 0)
+            return ("done", count, 0) if character == "]" else None
+        return None
+
+    def accepts(self, state) -> bool:
+        return state[0] == "done"
+
+def run(grammar, text : str, state=None):
+    """Feeds text to a grammar, returning the final state or None if the text leaves the grammar."""
+    state = grammar.start() if state is None else state
+    for character in text:
+        state = grammar.step(state, character)
+        if state is None:
+            return None
+    return state
+
+# tokenizer -> the text each token adds to the output
+_vocabularies = weakref.WeakKeyDictionary()
+
+def _vocabulary(tokenizer) -> dict:
+    if tokenizer not in _vocabularies:
+        strings = {}
+        for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+            # special and byte fallback tokens never appear in the grammars
+            if token is None or (token.startswith("<") and token.endswith(">")):
+                continue
+            strings[token_id] = token.replace("▁", " ").replace("Ġ", " ").replace("Ċ", "\n")
+        _vocabularies[tokenizer] = strings
+    return _vocabularies[tokenizer]
+
+class GrammarLogitsProcessor:
+    """
+    Masks every token that would take the output out of a grammar, and only allows the end of sequence once
+    the grammar is complete, so generation stops right at the closing bracket.
+
+    The tokens allowed in each grammar state are computed once and reused by every generation the
+    processor is used for, call `reset` before each one.
+
+    Args:
+        grammar: a grammar such as `TupleGrammar` or `StringListGrammar`
+        tokenizer: the model's tokenizer
+        eos_token_ids (list): the tokens that end generation
+    """
+    def __init__(self, grammar, tokenizer, eos_token_ids):
+        self.grammar = grammar
+        vocabulary = _vocabulary(tokenizer)
+        self.token_strings = vocabulary
+        self.candidates = [(token_id, string) for token_id, string in vocabulary.items() if string and set(string) <= grammar.characters]
+        self.eos_token_ids = [token_id for token_id in eos_token_ids if token_id is not None]
+        self.prompt_length = None
+        self._allowed = {}
+
+    def reset(self):
+        """Prepares the processor for a new generation, keeping the allowed tokens it computed."""
+        self.prompt_length = None
+
+    def allowed_tokens(self, state) -> list:
+        """Returns the tokens allowed after a state."""
+        if state not in self._allowed:
+            if state is None or self.grammar.accepts(state):
+                allowed = list(self.eos_token_ids)
+            else:
+                allowed = [token_id for token_id, string in self.candidates if run(self.grammar, string, state) is not None]
+            self._allowed[state] = allowed or list(self.eos_token_ids)
+        return self._allowed[state]
+
+    def __call__(self, input_ids, scores):
+        import torch
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1]
+        mask = torch.full_like(scores, float("-inf"))
+        for row, ids in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            text = "".join(self.token_strings.get(token_id, "") for token_id in ids)
+            mask[row, self.allowed_tokens(run(self.grammar, text))] = 0
+        return scores + mask
+
+def parse_tuple(text : str, min_size=2, max_size=3) -> tuple:
+    """
+    Safely parses a tuple of numbers.
+
+    Raises:
+        ValueError: the text is not a tuple of `min_size` to `max_size` finite numbers.
+    """
+    try:
+        value = ast.literal_eval(text.strip())
+    except (ValueError, SyntaxError) as e:
+        raise ValueError(f"not a tuple: {text!r}") from e
+    if not isinstance(value, (tuple, list)) or not min_size <= len(value) <= max_size:
+        raise ValueError(f"expected {min_size} to {max_size} numbers: {text!r}")
+    if not all(isinstance(number, (int, float)) and not isinstance(number, bool) and math.isfinite(number) for number in value):
+        raise ValueError(f"expected numbers: {text!r}")
+    return tuple(value)
+
+def parse_string_list(text : str) -> list:
+    """
+    Safely parses a list of strings.
+
+    Raises:
+        ValueError: the text is not a list of strings.
+    """
+    try:
+        value = ast.literal_eval(text.strip())
+    except (ValueError, SyntaxError) as e:
+        raise ValueError(f"not a list: {text!r}") from e
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"expected a list of strings: {text!r}")
+    return value
@@ -0,0 +1,73 @@
+from orchestration.profiling import span
+import gc, threading
+
+MODEL_ID = "facebook/bart-large-mnli"
+
+class ZeroShotClassifier:
+    """
+    Batched zero-shot classification with the scores memoised per (text, label).
+
+    A story classifies every sentence and every proper noun up front in a few batched pipeline calls,
+    and a name that appears many times is only classified once.
+    """
+    def __init__(self, model_id=MODEL_ID, device=None, batch_size=16):
+        # device None picks cuda when it is available
+        self.model_id = model_id
+        self.device = device
+        self.batch_size = batch_size
+        self.classifier = None
+        self.scores = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads the classification pipeline if it is not already loaded."""
+        if self.classifier is None:
+            import torch
+            from transformers import pipeline
+            device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+            with span("load " + self.model_id, "model"):
+                self.classifier = pipeline("zero-shot-classification", device=device, model=self.model_id)
+        return self.classifier
+
+    def unload(self):
+        """Releases the pipeline and frees its memory, the memoised scores are kept."""
+        with self._lock:
+            if self.classifier is None:
+                return
+            import torch
+            self.classifier = None
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def is_loaded(self) -> bool:
+        """Returns whether the pipeline is currently resident."""
+        return self.classifier is not None
+
+    def classify(self, texts : list, label : str) -> dict:
+        """
+        Scores how well each text matches a label.
+
+        Args:
+            texts (list): the texts to classify, duplicates are classified once
+            label (str): the candidate label, e.g. "physical action"
+
+        Returns:
+            A dictionary of text -> score between 0 and 1.
+        """
+        with self._lock:
+            missing = [text for text in dict.fromkeys(texts) if (text, label) not in self.scores]
+            if missing:
+                classifier = self.load()
+                with span("zero-shot classify", "generate", texts=len(missing)):
+                    outputs = classifier(missing, [label], batch_size=self.batch_size)
+                if isinstance(outputs, dict):
+                    outputs = [outputs]
+                for text, output in zip(missing, outputs):
+                    self.scores[(text, label)] = output["scores"][0]
+            return {text: self.scores[(text, label)] for text in texts}
+
+_classifier = ZeroShotClassifier()
+
+def get_zero_shot_classifier() -> ZeroShotClassifier:
+    """Returns the process-wide zero-shot classifier."""
+    return _classifier
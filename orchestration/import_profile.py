@@ -0,0 +1,64 @@
+"""
+Reports how long the lightweight entry points take to import, so the ML stack stays out of them.
+
+Usage: python -m orchestration.import_profile [--budget SECONDS] [--top N] [modules...]
+"""
+import argparse, os, subprocess, sys
+
+# modules that have to start without importing torch, transformers, spacy or diffusers
+ENTRY_MODULES = ("marta", "rendering.start_render", "rendering.timeline", "orchestration.scheduler", "orchestration.manifest")
+HEAVY_MODULES = ("torch", "transformers", "diffusers", "spacy", "scipy", "gtts", "meshgpt_pytorch")
+DEFAULT_BUDGET = 1.0
+
+def profile_import(module : str, cwd=None) -> dict:
+    """
+    Imports a module in a fresh interpreter with `-X importtime`.
+
+    Args:
+        module (str): the dotted module name
+        cwd (str): the directory the interpreter runs in, the repository root by default
+
+    Returns:
+        A dict with the total import time in seconds, the (seconds, module) of every import and the heavy modules pulled in.
+    """
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, capture_output=True, text=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1e6, name.strip()))
+
+    total = next((seconds for seconds, name in reversed(imports) if name == module), sum(seconds for seconds, name in imports if not name.startswith(" ")))
+    heavy = sorted({name.strip() for _, name in imports if name.strip().split(".")[0] in HEAVY_MODULES and "." not in name.strip()})
+    error = result.stderr.strip().splitlines()[-1] if result.returncode else ""
+    return {'module': module, 'seconds': total, 'imports': imports, 'heavy': heavy, 'error': error}
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Profiles the import time of MARTA's entry points.")
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_MODULES), help="the modules to profile")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="the slowest acceptable import in seconds")
+    parser.add_argument("--top", type=int, default=5, help="how many of the slowest imports to list per module")
+    args = parser.parse_args(argv)
+
+    over_budget = False
+    for module in args.modules:
+        report = profile_import(module)
+        if report['error']:
+            print(f"{module}: failed to import ({report['error']})")
+            over_budget = True
+            continue
+        status = "ok" if report['seconds'] <= args.budget and not report['heavy'] else "SLOW"
+        over_budget |= status != "ok"
+        print(f"{module}: {report['seconds']:.3f}s [{status}]")
+        if report['heavy']:
+            print("  imports heavy modules: " + ", ".join(report['heavy']))
+        for seconds, name in sorted(report['imports'], reverse=True)[1:args.top + 1]:
+            print(f"  {seconds:8.3f}s  {name.strip()}")
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
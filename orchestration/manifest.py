@@ -0,0 +1,103 @@
+import hashlib, json, os, threading
+
+class Manifest:
+    """
+    Records every completed artifact of a story in `output/<story>/manifest.json` so an interrupted run
+    can skip finished work.
+
+    An entry stores the parameters that produced it, its (JSON) output and the content hash of every file
+    it wrote. It is only reused when the parameters match and every file still exists unchanged.
+    """
+    def __init__(self, story_name : str, root_path=None):
+        root_path = root_path or os.getcwd()
+        self.path = os.path.join(root_path, "output", story_name, "manifest.json")
+        self._lock = threading.RLock()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def lookup(self, key : str, params):
+        """
+        Finds a completed artifact.
+
+        Args:
+            key (str): the name of the artifact, e.g. "texture:floor_image_path"
+            params: the JSON serialisable parameters that produce the artifact
+
+        Returns:
+            (found, output): whether a valid entry exists and its recorded output.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None or entry["params"] != _normalise(params):
+            return False, None
+        for path, digest in entry["files"].items():
+            if not os.path.isfile(path) or file_hash(path) != digest:
+                return False, None
+        return True, entry["output"]
+
+    def record(self, key : str, params, output, files=()):
+        """
+        Records a completed artifact and saves the manifest.
+
+        Args:
+            key (str): the name of the artifact
+            params: the JSON serialisable parameters that produced it
+            output: the JSON serialisable result of the stage
+            files (list): the paths of the files the stage wrote
+
+        Returns:
+            The output as it will be read back from the manifest.
+        """
+        entry = {"params": _normalise(params), "output": _normalise(output), "files": {path: file_hash(path) for path in files if path}}
+        with self._lock:
+            self.entries[key] = entry
+            self._save()
+        return entry["output"]
+
+    def cached(self, key : str, params, produce, files=lambda output: ()):
+        """
+        Returns the recorded output of an artifact, or produces and records it.
+
+        Args:
+            key (str): the name of the artifact
+            params: the JSON serialisable parameters that produce it
+            produce (callable): called without arguments to produce the output
+            files (callable): returns the file paths written for an output
+
+        Returns:
+            The output of the artifact.
+        """
+        found, output = self.lookup(key, params)
+        if found:
+            print(f"Skipping {key}, already completed")
+            return output
+        output = produce()
+        return self.record(key, params, output, files(output))
+
+    def clear(self):
+        """Forgets every recorded artifact."""
+        with self._lock:
+            self.entries = {}
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
+
+def file_hash(path : str) -> str:
+    """Returns the sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _normalise(value):
+    """Round trips a value through JSON so tuples and lists compare equal."""
+    return json.loads(json.dumps(value, ensure_ascii=False))
@@ -0,0 +1,140 @@
+"""
+Timing and memory spans for a MARTA run, written as a Chrome trace (open it in chrome://tracing or Perfetto).
+
+Only the standard library is used, so the same spans work inside Blender's Python.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import json, os, sys, threading, time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class Profiler:
+    """
+    Records named spans with their wall time, the peak RSS of this process (and of its finished child processes,
+    e.g. Blender or the MoMask worker) and, when torch is already loaded, the GPU memory.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets every recorded span, e.g. at the start of a new story."""
+        with self._lock:
+            self.events = []
+            # timestamps are wall clock microseconds, so traces of different processes line up when merged
+            self._origin = time.time() - time.perf_counter()
+
+    @contextmanager
+    def span(self, name : str, category : str = "marta", **args):
+        """
+        Records the code inside the `with` block as one span.
+
+        Args:
+            name (str): the name shown in the trace
+            category (str): groups spans, e.g. "model", "stage" or "subprocess"
+            args: extra values stored with the span
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), category, **args)
+
+    def record(self, name : str, start : float, end : float, category : str = "marta", **args):
+        """
+        Records a span from two `time.perf_counter` readings, for work that starts and ends in different callbacks.
+
+        Args:
+            name (str): the name shown in the trace
+            start (float): when the work started
+            end (float): when the work ended
+            category (str): groups spans, e.g. "model", "stage" or "subprocess"
+            args: extra values stored with the span
+        """
+        args.update(_memory())
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round((self._origin + start) * 1e6), 'dur': round((end - start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with self._lock:
+            self.events.append(event)
+
+    def profiled(self, name : str = None, category : str = "marta"):
+        """Decorator that records every call of a function as a span, named after the function by default."""
+        def decorator(function):
+            span_name = name or function.__qualname__
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, category):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> dict:
+        """Returns the call count and total seconds of every span name, slowest first."""
+        totals = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += event['dur'] / 1e6
+        return dict(sorted(totals.items(), key=lambda item: item[1]['seconds'], reverse=True))
+
+    def merge(self, trace_path : str):
+        """Adds the spans of another trace, e.g. the one Blender wrote while rendering."""
+        try:
+            with open(trace_path, encoding='utf-8') as f:
+                events = json.load(f)['traceEvents']
+        except (OSError, ValueError, KeyError):
+            return
+        with self._lock:
+            self.events.extend(events)
+
+    def write(self, path : str) -> str:
+        """
+        Writes the recorded spans as a Chrome trace.
+
+        Returns:
+            The path to the trace.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms', 'otherData': {'summary': None}}
+        trace['otherData']['summary'] = self.summary()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, indent=1)
+        return path
+
+def _memory() -> dict:
+    """Returns the memory high-water marks in MB that are available without importing anything heavy."""
+    memory = {}
+    if resource is not None:
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        scale = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+        memory['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if children:
+            memory['peak_child_rss_mb'] = round(children * scale, 1)
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        memory['gpu_allocated_mb'] = round(torch.cuda.memory_allocated() / (1024 * 1024), 1)
+        memory['gpu_peak_mb'] = round(torch.cuda.max_memory_allocated() / (1024 * 1024), 1)
+    return memory
+
+_profiler = Profiler()
+
+def get_profiler() -> Profiler:
+    """Returns the process-wide profiler."""
+    return _profiler
+
+def span(name : str, category : str = "marta", **args):
+    """Records a span with the process-wide profiler, see `Profiler.span`."""
+    return _profiler.span(name, category, **args)
+
+def profiled(name : str = None, category : str = "marta"):
+    """Records every call of a function with the process-wide profiler, see `Profiler.profiled`."""
+    return _profiler.profiled(name, category)
@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from orchestration.profiling import span
+import os, sys, time
+
+# lanes a stage can run in
+IO_LANE = "io"
+CPU_LANE = "cpu"
+GPU_LANE = "gpu"
+
+class Stage:
+    """
+    A node of the pipeline graph.
+
+    Args:
+        name (str): the unique name of the stage, dependents receive its result as a keyword argument of this name
+        function (callable): called with the results of the dependencies as keyword arguments
+        dependencies (list): the names of the stages that must finish first
+        lane (str): IO_LANE for network/disk bound work, CPU_LANE for python work, GPU_LANE for model inference
+        gpu_memory (int): the GPU memory in MB the stage needs while it runs (GPU_LANE only)
+        models (list): the names of the `GpuModel`s the stage uses, they are never unloaded to make room while it runs
+    """
+    def __init__(self, name : str, function, dependencies=(), lane=CPU_LANE, gpu_memory=0, models=()):
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.lane = lane
+        self.gpu_memory = gpu_memory
+        self.models = list(models)
+
+class GpuModel:
+    """
+    A model that stays on the GPU after the stage that used it finished.
+
+    Args:
+        memory (int): the GPU memory in MB it holds while loaded
+        is_loaded (callable): returns whether it is loaded
+        unload (callable): frees its memory, the next stage that uses it loads it again
+    """
+    def __init__(self, memory : int, is_loaded, unload):
+        self.memory = memory
+        self.is_loaded = is_loaded
+        self.unload = unload
+
+class StageGraph:
+    """
+    A DAG of pipeline stages that runs every stage as soon as its dependencies are done.
+
+    IO and CPU stages run on thread pools. GPU stages run on their own lane and only start while the
+    sum of the `gpu_memory` of the running GPU stages fits in the memory budget. The models are
+    resident in this process (see the model registries), so GPU stages are threads that share them
+    rather than separate processes that would each load their own copy.
+
+    Resident models keep their memory after their stage finished, so before a GPU stage starts the
+    memory actually free on the GPU is checked too. Idle `gpu_models` are only unloaded for a stage that
+    passed every other check, so a stage that ends up waiting never evicts a model.
+    """
+    def __init__(self, gpu_memory_budget=None, io_workers=8, cpu_workers=None, gpu_workers=2, gpu_models=None):
+        self.stages = {}
+        self.gpu_memory_budget = gpu_memory_budget
+        # name -> GpuModel
+        self.gpu_models = gpu_models or {}
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.gpu_workers = gpu_workers
+        self.timings = {}
+
+    def add(self, name : str, function, dependencies=(), lane=CPU_LANE, gpu_memory=0, models=()) -> str:
+        """
+        Adds a stage to the graph, see `Stage`.
+
+        Returns:
+            The name of the stage.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' already exists")
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = Stage(name, function, dependencies, lane, gpu_memory, models)
+        return name
+
+    def run(self) -> dict:
+        """
+        Runs every stage.
+
+        Returns:
+            A dictionary of stage name -> result.
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        gpu_in_use = 0
+        pools = {
+            IO_LANE: ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="marta-io"),
+            CPU_LANE: ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="marta-cpu"),
+            GPU_LANE: ThreadPoolExecutor(max_workers=self.gpu_workers, thread_name_prefix="marta-gpu"),
+        }
+        try:
+            while pending or running:
+                gpu_free = _FreeMemory()
+                for name, stage in list(pending.items()):
+                    if any(dependency not in results for dependency in stage.dependencies):
+                        continue
+                    if stage.lane == GPU_LANE and not self._reserve(stage, gpu_in_use, running, gpu_free):
+                        continue
+                    del pending[name]
+                    if stage.lane == GPU_LANE:
+                        gpu_in_use += stage.gpu_memory
+                    arguments = {dependency: results[dependency] for dependency in stage.dependencies}
+                    running[pools[stage.lane].submit(self._call, stage, arguments)] = stage
+
+                if not running:
+                    raise RuntimeError("Stages " + ", ".join(pending) + " can never run")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if stage.lane == GPU_LANE:
+                        gpu_in_use -= stage.gpu_memory
+                    results[stage.name] = future.result()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+        return results
+
+    def _reserve(self, stage : Stage, gpu_in_use : int, running : dict, gpu_free) -> bool:
+        """
+        Decides whether a GPU stage starts now, cheapest checks first. Idle models are unloaded only once the
+        stage is certain to start.
+
+        Args:
+            gpu_in_use (int): the summed `gpu_memory` of the running GPU stages
+            running (dict): future -> stage of every running stage
+            gpu_free (_FreeMemory): the free GPU memory of the current scheduling pass
+
+        Returns:
+            Whether the stage starts, its memory is then reserved in `gpu_free`.
+        """
+        gpu_running = [other for other in running.values() if other.lane == GPU_LANE]
+        if len(gpu_running) >= self.gpu_workers:
+            return False
+        if self.gpu_memory_budget is not None and gpu_running and gpu_in_use + stage.gpu_memory > self.gpu_memory_budget:
+            return False
+        # the stage's own models count towards its gpu_memory, when they are already loaded it needs less
+        needed = stage.gpu_memory - sum(self.gpu_models[name].memory for name in stage.models
+                                        if name in self.gpu_models and self.gpu_models[name].is_loaded())
+        free = gpu_free.get()
+        if free is not None and free < needed:
+            in_use = set(stage.models).union(*(other.models for other in gpu_running))
+            idle = [(model.memory, name) for name, model in self.gpu_models.items() if name not in in_use and model.is_loaded()]
+            # a stage that does not fit even after unloading every idle model still runs, but alone
+            if gpu_running and free + sum(memory for memory, _ in idle) < needed:
+                return False
+            self._make_room(stage, needed, idle, gpu_free)
+        gpu_free.reserved += max(needed, 0)
+        return True
+
+    def _make_room(self, stage : Stage, needed : int, idle : list, gpu_free):
+        """Unloads idle resident models, largest first, until the GPU has the memory the stage needs."""
+        for _, name in sorted(idle, reverse=True):
+            free = gpu_free.get()
+            if free >= needed:
+                return
+            print(f"Unloading idle {name} to make room for {stage.name} ({free} MB free, {needed} MB needed)")
+            self.gpu_models[name].unload()
+            gpu_free.refresh()
+
+    def _call(self, stage : Stage, arguments : dict):
+        start = time.perf_counter()
+        print(f"[{stage.lane}] Starting {stage.name}")
+        with span(stage.name, "stage", lane=stage.lane):
+            result = stage.function(**arguments)
+        self.timings[stage.name] = time.perf_counter() - start
+        print(f"[{stage.lane}] Finished {stage.name} in {self.timings[stage.name]:.1f}s")
+        return result
+
+class _FreeMemory:
+    """
+    The GPU memory free during one scheduling pass. It is read once, on the first GPU stage that needs it, and
+    the stages started earlier in the pass are subtracted as they have not allocated their memory yet.
+    """
+    def __init__(self):
+        self.reserved = 0
+        self._free = None
+        self._read = False
+
+    def get(self):
+        """Returns the free memory in MB left for the next stage, or None when it cannot be measured."""
+        if not self._read:
+            self._free = free_gpu_memory()
+            self._read = True
+        return None if self._free is None else self._free - self.reserved
+
+    def refresh(self):
+        """Reads the free memory again on the next `get`, e.g. after a model was unloaded."""
+        self._read = False
+
+def free_gpu_memory():
+    """
+    Returns the memory in MB free on the first GPU, or None when torch is not loaded yet (then no model is either)
+    or there is no GPU.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info(0)
+    return int(free / (1024 * 1024))
+
+def detect_gpu_memory_budget(fraction=0.9):
+    """
+    Returns the GPU memory budget in MB, `fraction` of the first GPU's memory, or None without a GPU.
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+    return int(torch.cuda.get_device_properties(0).total_memory / (1024 * 1024) * fraction)
@@ -0,0 +1,39 @@
+"""The camera cut rules `AnimationHandler.bake_cameras` applies, kept free of bpy."""
+
+# the cameras are chosen from the character positions every CAMERA_SAMPLE_STEP frames,
+# and never cut again within CAMERA_SWITCH_FRAMES of the last cut
+CAMERA_SAMPLE_STEP = 5
+CAMERA_SWITCH_FRAMES = 10
+
+def sample_frames(last_frame : int, step : int = CAMERA_SAMPLE_STEP) -> list:
+    """Returns the frames the cameras are chosen at: every `step` frames from 1, and always the last frame."""
+    last_frame = max(int(last_frame), 1)
+    frames = list(range(1, last_frame + 1, step))
+    if frames[-1] != last_frame:
+        frames.append(last_frame)
+    return frames
+
+class CameraCuts:
+    """
+    Follows the closest camera from one sampled frame to the next, cutting to a new camera only more than
+    `switch_frames` after the previous cut so the view never flickers between two cameras.
+    """
+    def __init__(self, switch_frames : int = CAMERA_SWITCH_FRAMES):
+        self.switch_frames = switch_frames
+        self.camera = None
+        self.last_cut = 0
+
+    def update(self, frame : int, closest_camera) -> bool:
+        """
+        Reads the closest camera at a sampled frame.
+
+        Returns:
+            Whether the view cuts to `closest_camera` at this frame, `camera` is then the new camera.
+        """
+        if closest_camera is None or closest_camera == self.camera:
+            return False
+        if self.camera is not None and frame - self.last_cut <= self.switch_frames:
+            return False
+        self.camera = closest_camera
+        self.last_cut = frame
+        return True
@@ -1,8 +1,165 @@
-import subprocess, os, torch, gc
+from rendering.motion_cache import get_motion_cache
+from orchestration.profiling import span
+import subprocess, os, sys, json, threading, atexit
+
+# the dataset and checkpoints gen_t2m.py loads by default, the worker is started with them
+MOMASK_DATASET = "t2m"
+MOMASK_MODEL = "t2m_nlayer8_nhead6_ld384_ff1024_cdp0.1_rvq6ns"
+MOMASK_RES_MODEL = "tres_nlayer8_ld384_ff1024_rvq6ns_cdp0.2_b64"
+MOMASK_DIR = os.path.join(os.getcwd(), "momask-codes")
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "momask_worker.py")
+
+class MomaskWorker:
+    """
+    Client for the long-lived MoMask process in `momask_worker.py`.
+
+    The worker loads the MoMask checkpoints once and runs with momask-codes as its own working
+    directory, so this process never has to change directory.
+    """
+    def __init__(self, momask_dir=MOMASK_DIR, gpu_id=0, dataset_name=MOMASK_DATASET, name=MOMASK_MODEL, res_name=MOMASK_RES_MODEL):
+        self.momask_dir = momask_dir
+        self.gpu_id = gpu_id
+        self.dataset_name = dataset_name
+        self.name = name
+        self.res_name = res_name
+        self.process = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def checkpoint(self) -> str:
+        """The checkpoints the worker generates with, motions are cached per checkpoint."""
+        return "/".join((self.dataset_name, self.name, self.res_name))
+
+    def start(self):
+        """Starts the worker and waits until its models are loaded."""
+        if self.process is not None and self.process.poll() is None:
+            return
+        print("Starting MoMask worker...")
+        with span("start momask worker", "subprocess"):
+            command = [sys.executable, WORKER_SCRIPT, "--gpu_id", str(self.gpu_id), "--dataset_name", self.dataset_name,
+                       "--name", self.name, "--res_name", self.res_name]
+            self.process = subprocess.Popen(command, cwd=self.momask_dir,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+            if not self._read().get("ready"):
+                raise RuntimeError("MoMask worker failed to start")
+
+    def generate(self, prompts : list, lengths : list) -> list:
+        """
+        Generates one motion per prompt.
+
+        Args:
+            prompts (list): the text prompts
+            lengths (list): the length of each motion in frames
+
+        Returns:
+            The absolute path of each generated bvh, in input order.
+        """
+        with self._lock:
+            self.start()
+            self._next_id += 1
+            with span("momask generate", "subprocess", motions=len(prompts)):
+                self.process.stdin.write(json.dumps({"id": self._next_id, "prompts": prompts, "lengths": lengths}) + "\n")
+                self.process.stdin.flush()
+                response = self._read()
+        if not response.get("ok"):
+            raise RuntimeError("MoMask worker failed:\n" + response.get("error", ""))
+        return response["paths"]
+
+    def is_running(self) -> bool:
+        """Returns whether the worker process, and with it the MoMask models, is alive."""
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        """Asks the worker to exit, the next request starts it again."""
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                return
+            try:
+                self.process.stdin.write(json.dumps({"command": "shutdown"}) + "\n")
+                self.process.stdin.close()
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process = None
+
+    def _read(self) -> dict:
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"MoMask worker exited with code {self.process.wait()}")
+        return json.loads(line)
+
+_worker = None
+
+def get_worker() -> MomaskWorker:
+    """Returns the process-wide MoMask worker, it is started on the first request."""
+    global _worker
+    if _worker is None:
+        _worker = MomaskWorker()
+        atexit.register(_worker.close)
+    return _worker
+
+IDLE_PROMPT = "a person standing still"
+# the most motions sent to the worker in one forward pass
+MAX_BATCH_SIZE = 32
+
+def generate_motions(requests : list) -> dict:
+    """Generates every requested motion, reusing cached ones and batching the rest into as few MoMask passes as possible.
+
+    Args:
+        requests (list): (prompt, length in frames) tuples, duplicates are generated once
+
+    Returns:
+        (dict) (prompt, length) -> path of the bvh in the motion cache
+    """
+    cache = get_motion_cache()
+    checkpoint = get_worker().checkpoint
+    keys = {}
+    for prompt, length in requests:
+        keys[(prompt, int(length))] = cache.make_key(prompt, length, checkpoint)
+
+    cached_paths, missing = {}, {}
+    for request, key in keys.items():
+        if key in cached_paths or key in missing:
+            continue
+        cached_path = cache.get(key)
+        if cached_path is not None:
+            cached_paths[key] = cached_path
+        else:
+            missing[key] = request
+    if cached_paths:
+        print(f"Reusing {len(cached_paths)} cached animations")
+
+    batch_requests = list(missing.items())
+    for start in range(0, len(batch_requests), MAX_BATCH_SIZE):
+        batch = batch_requests[start:start + MAX_BATCH_SIZE]
+        print(f"Generating {len(batch)} animations...")
+        og_paths = get_worker().generate([prompt for _, (prompt, _) in batch], [length for _, (_, length) in batch])
+        for (key, (prompt, length)), og_path in zip(batch, og_paths):
+            cached_paths[key] = cache.put(key, {".bvh": og_path}, prompt=prompt, length=length, checkpoint=checkpoint)[".bvh"]
+
+    return {request: cached_paths[key] for request, key in keys.items()}
+
+def motion_filename(prompt : str, length : int) -> str:
+    """The story file name of a motion, the length keeps clips of one prompt with different lengths apart."""
+    return f"{prompt}_{int(length)}"
+
+def link_motion(cached_path : str, story_name : str, filename : str) -> str:
+    """Places a cached motion in the story's animation folder.
+
+    Args:
+        cached_path (str): the bvh path returned by `generate_motions`
+        story_name (str): the name of the story
+        filename (str): the file name (without extension) used in the story folder
+
+    Returns:
+        (str) The path to the animation in the story folder
+    """
+    new_path = os.path.join(os.getcwd(), "rendering", "animations", story_name, filename + ".bvh")
+    return get_motion_cache().link(cached_path, new_path)
 
 def create_animation(prompt, length = 5, story_name=str):
     """Genreates an animation from a given prompt and length\n
-    !!! Automatically naviages to the momask-codes directory !!!\n
     Args:
         prompt (str): The prompt for the animation
         length (int): The length of the animation in seconds
@@ -10,30 +167,11 @@ def create_animation(prompt, length = 5, story_name=str):
     Returns:
         (str) The new path to the generated animation
     """
-    print("Generating animation...")
-
-    length *= 32
-    os.chdir("momask-codes")
-    subprocess.call(["python", "gen_t2m.py", "--gpu_id", "0", "--ext", prompt, "--text_prompt", "\""+ prompt +"\"", "--motion_length", str(length)], shell=True)
-    os.chdir("..")
-
-    og_path = os.path.join(os.getcwd(), "momask-codes", "generation", prompt, "animations", "0", "sample0_repeat0_len" + str(length) + ".mp4") 
-    new_path = new_path = os.path.join(os.getcwd(), "rendering", "animations", story_name, prompt + ".mp4") 
-    os.replace(og_path, new_path)
-    
-    og_path = os.path.join(os.getcwd(), "momask-codes", "generation", prompt, "animations", "0", "sample0_repeat0_len" + str(length) + ".bvh") 
-    new_path = os.path.join(os.getcwd(), "rendering", "animations", story_name, prompt + ".bvh") 
-    os.replace(og_path, new_path)
-
-   
-
-    torch.cuda.empty_cache()
-    gc.collect()
-    return new_path
+    cached_path = generate_motions([(prompt, length * 32)])[(prompt, length * 32)]
+    return link_motion(cached_path, story_name, motion_filename(prompt, length * 32))
 
 def create_idle(length = 5, index = 0, story_name = str):
     """Genreates an idle animatoin animation from a given length\n
-    !!! Automatically naviages to the momask-codes directory !!!\n
     Args:
         length (int): The length of the animation in seconds
         index (int): The index of this animation (so it doesnt do multiple times)
@@ -42,27 +180,8 @@ def create_idle(length = 5, index = 0, story_name = str):
     Returns:
         (str) The new path to the generated animation
     """
-    print("Generating animation...")
-    prompt = "a person standing still"
-    length *= 32
-    os.chdir("momask-codes")
-    subprocess.call(["python", "gen_t2m.py", "--gpu_id", "0", "--ext", prompt, "--text_prompt", "\""+ prompt +"\"", "--motion_length", str(length)], shell=True)
-    os.chdir("..")
-
-    og_path = os.path.join(os.getcwd(), "momask-codes", "generation", prompt, "animations", "0", "sample0_repeat0_len" + str(length) + ".mp4") 
-    new_path = new_path = os.path.join(os.getcwd(), "rendering", "animations", story_name, prompt + str(index) + ".mp4") 
-    os.replace(og_path, new_path)
-    
-    og_path = os.path.join(os.getcwd(), "momask-codes", "generation", prompt, "animations", "0", "sample0_repeat0_len" + str(length) + ".bvh") 
-    new_path = os.path.join(os.getcwd(), "rendering", "animations", story_name, prompt + str(index) + ".bvh") 
-    os.replace(og_path, new_path)
-
-   
-
-    torch.cuda.empty_cache()
-    gc.collect()
-    return new_path
+    cached_path = generate_motions([(IDLE_PROMPT, length * 32)])[(IDLE_PROMPT, length * 32)]
+    return link_motion(cached_path, story_name, IDLE_PROMPT + str(index))
 
 if __name__ == "__main__":
     create_animation("A man dances", story_name="Aiden and Musfira")
-
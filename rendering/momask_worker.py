@@ -0,0 +1,136 @@
+"""
+Long-lived MoMask generation worker.
+
+Started by `rendering.momask_utils.MomaskWorker` with the momask-codes directory as its working directory.
+The models are loaded once, then the worker answers one JSON request per line on stdin with one JSON
+response per line on stdout:
+
+    request:  {"id": 3, "prompts": ["a person walks"], "lengths": [64]}
+    response: {"id": 3, "ok": true, "paths": ["/abs/momask-codes/generation/marta/3/0.bvh"]}
+
+Anything MoMask prints is redirected to stderr so it cannot corrupt the protocol.
+"""
+import sys, os, json, argparse, traceback
+
+PROTOCOL_OUT = sys.stdout
+sys.stdout = sys.stderr
+sys.path.insert(0, os.getcwd())
+
+class MomaskModels:
+    """The MoMask models loaded the same way gen_t2m.py loads them."""
+    def __init__(self, gpu_id=0, dataset_name="t2m", name=None, res_name=None, seed=10107):
+        import torch
+        import numpy as np
+        from os.path import join as pjoin
+        from options.eval_option import EvalT2MOptions
+        from utils.get_opt import get_opt
+        from utils.fixseed import fixseed
+        from visualization.joints2bvh import Joint2BVHConvertor
+        from gen_t2m import load_vq_model, load_trans_model, load_res_model
+
+        sys.argv = ["gen_t2m.py", "--gpu_id", str(gpu_id), "--dataset_name", dataset_name, "--seed", str(seed)]
+        # without a name gen_t2m.py's default checkpoint is loaded
+        if name:
+            sys.argv += ["--name", name]
+        if res_name:
+            sys.argv += ["--res_name", res_name]
+        opt = EvalT2MOptions().parse()
+        fixseed(opt.seed)
+        opt.device = torch.device("cpu" if opt.gpu_id == -1 else "cuda:" + str(opt.gpu_id))
+        dim_pose = 251 if opt.dataset_name == 'kit' else 263
+
+        root_dir = pjoin(opt.checkpoints_dir, opt.dataset_name, opt.name)
+        model_opt = get_opt(pjoin(root_dir, 'opt.txt'), device=opt.device)
+
+        vq_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'opt.txt'), device=opt.device)
+        vq_opt.dim_pose = dim_pose
+        vq_model, vq_opt = load_vq_model(vq_opt)
+
+        model_opt.num_tokens = vq_opt.nb_code
+        model_opt.num_quantizers = vq_opt.num_quantizers
+        model_opt.code_dim = vq_opt.code_dim
+
+        res_opt = get_opt(pjoin(opt.checkpoints_dir, opt.dataset_name, opt.res_name, 'opt.txt'), device=opt.device)
+        res_model = load_res_model(res_opt, vq_opt, opt)
+        t2m_transformer = load_trans_model(model_opt, opt, 'latest.tar')
+
+        for model in (t2m_transformer, vq_model, res_model):
+            model.eval()
+            model.to(opt.device)
+
+        meta_dir = pjoin(opt.checkpoints_dir, opt.dataset_name, model_opt.vq_name, 'meta')
+        self.mean = np.load(pjoin(meta_dir, 'mean.npy'))
+        self.std = np.load(pjoin(meta_dir, 'std.npy'))
+        self.opt = opt
+        self.vq_model = vq_model
+        self.res_model = res_model
+        self.t2m_transformer = t2m_transformer
+        self.converter = Joint2BVHConvertor()
+        self.torch = torch
+
+    def generate(self, prompts : list, lengths : list, output_dir : str) -> list:
+        """
+        Generates one motion per prompt in a single batched pass.
+
+        Args:
+            prompts (list): the text prompts
+            lengths (list): the motion length of each prompt in frames
+            output_dir (str): the directory the bvh files are written to
+
+        Returns:
+            The absolute bvh path of each prompt, in input order.
+        """
+        from utils.motion_process import recover_from_ric
+        torch, opt = self.torch, self.opt
+
+        os.makedirs(output_dir, exist_ok=True)
+        token_lens = (torch.LongTensor([int(length) for length in lengths]) // 4).to(opt.device).long()
+        m_length = token_lens * 4
+
+        with torch.no_grad():
+            mids = self.t2m_transformer.generate(prompts, token_lens, timesteps=opt.time_steps, cond_scale=opt.cond_scale,
+                                                 temperature=opt.temperature, topk_filter_thres=opt.topkr, gsample=opt.gumbel_sample)
+            mids = self.res_model.generate(mids, prompts, token_lens, temperature=1, cond_scale=5)
+            pred_motions = self.vq_model.forward_decoder(mids).detach().cpu().numpy()
+        data = pred_motions * self.std + self.mean
+
+        paths = []
+        for k, joint_data in enumerate(data):
+            joint_data = joint_data[:m_length[k]]
+            joint = recover_from_ric(torch.from_numpy(joint_data).float(), 22).numpy()
+            bvh_path = os.path.abspath(os.path.join(output_dir, f"{k}.bvh"))
+            self.converter.convert(joint, filename=bvh_path, iterations=100, foot_ik=False)
+            paths.append(bvh_path)
+        torch.cuda.empty_cache()
+        return paths
+
+def respond(message : dict):
+    PROTOCOL_OUT.write(json.dumps(message) + "\n")
+    PROTOCOL_OUT.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves MoMask generation requests over stdin/stdout.")
+    parser.add_argument("--gpu_id", type=int, default=0)
+    parser.add_argument("--dataset_name", default="t2m")
+    parser.add_argument("--name", default=None, help="the text to motion checkpoint")
+    parser.add_argument("--res_name", default=None, help="the residual transformer checkpoint")
+    args = parser.parse_args()
+
+    models = MomaskModels(gpu_id=args.gpu_id, dataset_name=args.dataset_name, name=args.name, res_name=args.res_name)
+    respond({"ready": True})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if request.get("command") == "shutdown":
+            break
+        try:
+            output_dir = os.path.join("generation", "marta", str(request["id"]))
+            paths = models.generate(request["prompts"], request["lengths"], output_dir)
+            respond({"id": request["id"], "ok": True, "paths": paths})
+        except Exception:
+            respond({"id": request.get("id"), "ok": False, "error": traceback.format_exc()})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import hashlib, json, os, shutil, threading, time
+
+DEFAULT_CACHE_DIR = os.path.join(os.getcwd(), "rendering", "animations", "cache")
+DEFAULT_MAX_ENTRIES = 512
+
+class MotionCache:
+    """
+    Stores MoMask outputs once per (prompt, motion length, checkpoint).
+
+    Cached files live in `cache_dir` and are indexed in `index.json`. Callers get a hardlink (or a copy
+    where hardlinks are unsupported) in their story folder, so evicting an entry never breaks a story.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, "index.json")
+
+    def make_key(self, prompt : str, motion_length : int, checkpoint : str) -> str:
+        """
+        Builds the cache key of a motion.
+
+        Args:
+            prompt (str): the text prompt given to MoMask, exactly as given since its text encoder sees the casing
+            motion_length (int): the length of the motion in frames
+            checkpoint (str): the MoMask checkpoint that generated the motion
+
+        Returns:
+            The hex digest identifying the motion.
+        """
+        payload = json.dumps([prompt, int(motion_length), checkpoint])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key : str, extension : str = ".bvh"):
+        """
+        Looks up a cached motion file.
+
+        Args:
+            key (str): the key from `make_key`
+            extension (str): the file type to look up (".bvh" or ".mp4")
+
+        Returns:
+            The path to the cached file or None on a miss.
+        """
+        with self._lock:
+            index = self._load_index()
+            path = self._entry_path(key, extension)
+            if key not in index or not os.path.isfile(path):
+                self.misses += 1
+                return None
+            index[key]["last_access"] = time.time()
+            self._save_index()
+            self.hits += 1
+            return path
+
+    def put(self, key : str, files : dict, **info) -> dict:
+        """
+        Moves freshly generated files into the cache.
+
+        Args:
+            key (str): the key from `make_key`
+            files (dict): extension -> path of the generated files, e.g. {".bvh": ".../sample0.bvh"}
+            info: extra metadata stored in the index (prompt, length, checkpoint)
+
+        Returns:
+            extension -> cached path for every stored file.
+        """
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            stored = {}
+            for extension, path in files.items():
+                if not os.path.isfile(path):
+                    continue
+                stored[extension] = self._entry_path(key, extension)
+                os.replace(path, stored[extension])
+            index = self._load_index()
+            index[key] = dict(info, extensions=sorted(stored), last_access=time.time())
+            self._evict()
+            self._save_index()
+            return stored
+
+    def link(self, cached_path : str, destination : str) -> str:
+        """
+        Places a cached file at `destination` as a hardlink, falling back to a copy.
+
+        Returns:
+            The destination path.
+        """
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(cached_path, destination)
+        except OSError:
+            shutil.copyfile(cached_path, destination)
+        return destination
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the number of cached motions."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._load_index())}
+
+    def _entry_path(self, key : str, extension : str) -> str:
+        return os.path.join(self.cache_dir, key + extension)
+
+    def _load_index(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def _evict(self):
+        index = self._load_index()
+        oldest = sorted(index, key=lambda k: index[k]["last_access"])
+        for key in oldest[:max(len(index) - self.max_entries, 0)]:
+            for extension in index.pop(key).get("extensions", []):
+                try:
+                    os.remove(self._entry_path(key, extension))
+                except OSError:
+                    pass
+
+_cache = MotionCache()
+
+def get_motion_cache() -> MotionCache:
+    """Returns the process-wide motion cache."""
+    return _cache
@@ -1,9 +1,21 @@
 import bpy
 from mathutils import Vector, Matrix
-import os, math, json, sys
+import argparse, hashlib, os, math, json, sys, time
+
+# blender runs this script from the repository root
+sys.path.append(os.getcwd())
+from orchestration.profiling import get_profiler, profiled
+from rendering.camera_cuts import CAMERA_SAMPLE_STEP, CAMERA_SWITCH_FRAMES, CameraCuts, sample_frames
+
+# the bones the cameras and the box are placed from, found once per rig by name, per rig type
+# the first bone whose lowercase name contains one of the substrings is used
+BONE_PATTERNS = {
+    "default": {"head": ("head",), "hips": ("hip", "pelvis", "hips"), "foot": ("foot",)},
+    "mixamo": {"head": ("mixamorig:head",), "hips": ("mixamorig:hips",), "foot": ("mixamorig:leftfoot", "mixamorig:rightfoot")},
+}
 
 class AnimationHandler:
-    def __init__(self, root_path, characters_data, actions_list,textures, last_frame, audio_frames, background_characters, render_path, render_quality, blender_output_path):
+    def __init__(self, root_path, characters_data, actions_list,textures, last_frame, audio_frames, background_characters, render_path, render_quality, blender_output_path, background_score="", rig_types=None, bone_patterns=None, action_library_path=""):
         self.root_path = root_path
         self.characters_data = characters_data
         self.actions_list = actions_list
@@ -13,7 +25,6 @@ class AnimationHandler:
         self.scene_cameras=[]
         self.char_cameras=[]
         self.smoothing_factor = 0.2
-        self.closest_camera=None
         self.textures=textures
         self.max_height=0
         self.last_frame = last_frame
@@ -24,6 +35,19 @@ class AnimationHandler:
         self.render_path = render_path
         self.render_quality = render_quality
         self.blender_output_path = blender_output_path
+        self.background_score = background_score
+        # character -> rig type, a character without one uses its own name as the type
+        self.rig_types = rig_types or {}
+        self.bone_patterns = dict(BONE_PATTERNS, **(bone_patterns or {}))
+        # character -> {"head", "hips", "foot"} -> bone name
+        self.bone_index = {}
+        # a .blend the retargeted actions are kept in between runs, none when empty
+        self.action_library_path = action_library_path
+        # library key -> (source action, retargeted action), NLA strip name -> retargeted action
+        self.library_actions = {}
+        self.retargeted_actions = {}
+        self.library_changed = False
+        self._file_digests = {}
         
     def clear_scene(self):
         """Delete all objects from the scene"""
@@ -54,6 +78,7 @@ class AnimationHandler:
         bpy.app.handlers.frame_change_pre.clear()
         bpy.app.handlers.frame_change_post.clear()
 
+    @profiled("blender retarget", "blender")
     def retarget_rokoko(self, source_armature : bpy.types.Object, target_armature: bpy.types.Object):
         """
         Retargets an animation to an armature
@@ -83,6 +108,7 @@ class AnimationHandler:
 
         print(source_armature.name + " " + str(source_armature.location))
 
+    @profiled("blender import rig", "blender")
     def load_rig(self, filepath: str, name: str, posX: int) -> bpy.types.Object:
         """
         Loads an animation rig from an FBX file
@@ -115,6 +141,29 @@ class AnimationHandler:
         print(f"\nLoaded {name}")
         return rig
     
+    def index_bones(self, character_name : str, rig : bpy.types.Object):
+        """
+        Finds the head, hips and foot bones of a rig once, so the per-frame camera code never scans bones.
+
+        Args:
+            character_name: the name of the character
+            rig: the character's armature
+        """
+        rig_type = self.rig_types.get(character_name, character_name)
+        patterns = self.bone_patterns.get(rig_type, self.bone_patterns["default"])
+        bones = {}
+        for key, substrings in patterns.items():
+            bone = next((bone for bone in rig.pose.bones if any(substring in bone.name.lower() for substring in substrings)), None)
+            if bone is None:
+                raise ValueError(f"No {key} bone ({', '.join(substrings)}) found in armature {rig.name}")
+            bones[key] = bone.name
+        self.bone_index[character_name] = bones
+
+    def bone(self, armature : bpy.types.Object, character_name : str, key : str) -> bpy.types.PoseBone:
+        """Returns a character's indexed "head", "hips" or "foot" pose bone."""
+        return armature.pose.bones[self.bone_index[character_name][key]]
+
+    @profiled("blender import bvh", "blender")
     def load_animation(self, filepath: str, name: str) -> bpy.types.Object:
         """
         Load a rig from an BVH file
@@ -137,13 +186,92 @@ class AnimationHandler:
         print(f"\nloaded {filepath}")
         return rig
 
-    def push_action_to_nla(self, armature: bpy.types.Object, action_name : str, end_frame : int):
+    def action_key(self, character_name : str, filepath : str) -> str:
+        """Names a BVH retargeted to a character's rig type, by the content of the file so renamed clips still match."""
+        if filepath not in self._file_digests:
+            with open(filepath, 'rb') as f:
+                self._file_digests[filepath] = hashlib.sha1(f.read()).hexdigest()[:16]
+        rig_type = self.rig_types.get(character_name, character_name)
+        # action names are limited to 63 characters
+        return f"{rig_type[:32]}_{self._file_digests[filepath]}"
+
+    def library_action(self, character_name : str, filepath : str) -> tuple:
+        """
+        Returns a BVH animation retargeted to the current target armature. Each BVH is imported and retargeted once
+        per rig type, and every later use of it shares the same actions.
+
+        Args:
+            character_name: the name of the character, which decides the rig type
+            filepath: the path to the BVH file, or 'idle'
+
+        Returns:
+            The source action, which times the NLA strip, and the retargeted action it plays.
+        """
+        if filepath == 'idle':
+            filepath = os.path.join(self.root_path, 'rendering', 'animations', 'idle.bvh')
+        key = self.action_key(character_name, filepath)
+        if key in self.library_actions:
+            return self.library_actions[key]
+
+        names = (f"{key}_source", f"{key}_retarget")
+        if not all(name in bpy.data.actions for name in names):
+            self.load_library_actions(names)
+        if all(name in bpy.data.actions for name in names):
+            print(f"\nreusing {filepath}")
+        else:
+            action_armature = self.load_animation(filepath=filepath, name=f"{key}_rig")
+            self.retarget_rokoko(self.target_armature, action_armature)
+            action_armature.hide_set(True)
+            source_action = action_armature.animation_data.action
+            retargeted_action = bpy.data.actions.get(source_action.name + " Retarget")
+            if retargeted_action is None:
+                raise ValueError(f"Retargeting {filepath} produced no action")
+            source_action.name, retargeted_action.name = names
+            self.library_changed = True
+
+        self.library_actions[key] = tuple(bpy.data.actions[name] for name in names)
+        return self.library_actions[key]
+
+    def load_library_actions(self, names : tuple):
+        """Appends actions from the action library, if it holds them."""
+        if not self.action_library_path or not os.path.isfile(self.action_library_path):
+            return
+        with bpy.data.libraries.load(self.action_library_path, link=False) as (data_from, data_to):
+            data_to.actions = [name for name in names if name in data_from.actions]
+
+    @profiled("blender save action library", "blender")
+    def save_action_library(self):
+        """
+        Adds this build's retargeted actions to the action library, so later runs skip importing and retargeting them.
+        The library is shared by every story, so the actions it already holds are written back too.
+        """
+        if not self.action_library_path or not self.library_changed:
+            return
+        actions = {action for pair in self.library_actions.values() for action in pair}
+        kept = []
+        if os.path.isfile(self.action_library_path):
+            names = {action.name for action in actions}
+            with bpy.data.libraries.load(self.action_library_path, link=False) as (data_from, data_to):
+                data_to.actions = [name for name in data_from.actions if name not in names]
+            kept = [action for action in data_to.actions if action is not None]
+        os.makedirs(os.path.dirname(os.path.abspath(self.action_library_path)), exist_ok=True)
+        # written next to the library and moved over it, so a failed write never loses the clips of other stories
+        tmp_path = os.path.splitext(self.action_library_path)[0] + ".tmp.blend"
+        bpy.data.libraries.write(tmp_path, actions | set(kept), fake_user=True)
+        os.replace(tmp_path, self.action_library_path)
+        # the other stories' clips are not part of this scene
+        for action in kept:
+            bpy.data.actions.remove(action)
+        print(f"\nSaved {len(actions) + len(kept)} actions to {self.action_library_path}")
+
+    def push_action_to_nla(self, armature: bpy.types.Object, action_name : str, end_frame : int, strip_name : str = None):
         """
         Push down action to NLA
         
         Args:   
             armature (bpy.types.Object): the armature that the action is on
             action_name (str): the name of the action
+            strip_name (str): the name of the strip, the action name by default
         
         Returns:
             nla_strip.frame_end (int): the end frame of the animation
@@ -162,9 +290,9 @@ class AnimationHandler:
         # Create or find the NLA track
         nla_tracks = armature.animation_data.nla_tracks
         nla_track = nla_tracks.new()
-        nla_track.name = action_name
+        nla_track.name = strip_name or action_name
 
-        nla_strip = nla_track.strips.new(name=action_name , start=0, action=action)
+        nla_strip = nla_track.strips.new(name=strip_name or action_name , start=0, action=action)
 
         nla_strip.extrapolation = 'NOTHING'
         nla_strip.use_auto_blend = False
@@ -259,7 +387,7 @@ class AnimationHandler:
             # Update the scene
             bpy.context.view_layer.update()
             
-            strip.action = bpy.data.actions.get(strip.name + " Retarget")
+            strip.action = self.retargeted_actions[strip.name]
             for curve in strip.action.fcurves:
                 for key in curve.keyframe_points:        
                     key.interpolation='LINEAR'
@@ -344,19 +472,9 @@ class AnimationHandler:
         return current_loc.lerp(target_loc, self.smoothing_factor)
 
     def direction_find(self, camera_dict):
-        target_bone_names = ['hip', 'pelvis', 'hips']
         character_name = camera_dict['char_name']
         armature = bpy.data.objects[f'{character_name}_rig']
-        
-        hips_bone = None
-        for bone in armature.pose.bones:
-            if any(target_bone_name in bone.name.lower() for target_bone_name in target_bone_names):
-                hips_bone = bone
-                break
-        
-        if hips_bone is None:
-            raise ValueError(f"No bone named 'hip' or 'pelvis' found in armature {character_name}_rig")
-    
+        hips_bone = self.bone(armature, character_name, "hips")
 
         current_location = armature.matrix_world @ hips_bone.head
 
@@ -379,18 +497,8 @@ class AnimationHandler:
                 raise ValueError("No armature found for character")
             
             target_armature = target_armature.evaluated_get(dpgraph)
-            
-            target_bone_name = "head"        
-            for bone in target_armature.pose.bones:
-                if target_bone_name in bone.name.lower():
-                    head_bone = target_armature.pose.bones.get(f'{bone.name}')
-                    break
-
-            target_bone_name = "foot"        
-            for bone in target_armature.pose.bones:
-                if target_bone_name in bone.name.lower():
-                    foot_bone = target_armature.pose.bones.get(f'{bone.name}')
-                    break
+            head_bone = self.bone(target_armature, character_name, "head")
+            foot_bone = self.bone(target_armature, character_name, "foot")
 
             head_bone_world_location =target_armature.matrix_world @ head_bone.head
             
@@ -407,14 +515,8 @@ class AnimationHandler:
 
             if camera_char and target_armature:
                 # Get the location of the hips bone
-                target_bone_names = ['hips', 'pelvis','hip']
+                hips_bone = self.bone(target_armature, character_name, "hips")
 
-                hips_bone = None
-                for bone in self.target_armature.pose.bones:
-                    if any(target_bone_name in bone.name.lower() for target_bone_name in target_bone_names):
-                        hips_bone = bone
-                        break
-    
                 if hips_bone:
 
                     # Calculate the location of the hips bone in world space
@@ -441,47 +543,13 @@ class AnimationHandler:
             else:
                 print("Camera or target armature not found")
 
-    def frame_change_handler(self, scene, dpgraph):
-        """Frame change handler to follow the character with the camera"""
-        self.camera_follow_character(scene, dpgraph)
-        current_frame = scene.frame_current
-        active_camera = None
-        active_character_count = 0
-
-        for character_name, actions in zip(self.characters_data, self.actions_list):
-        # Check if any action matches the current frame for the character
-    
-            for action_name, data in actions.items():
-                start_frame = data[0][0]
-                end_frame = data[0][1]
-                
-                if start_frame <= current_frame and current_frame <= end_frame:
-                    if action_name.lower() != 'idle': 
-                        active_camera = f"{character_name}"    
-                        active_character_count += 1
-                    break
-        self.update_closest_camera_rotation()
-        #if active_character_count != 1:
-            # Use scene camera
-            #self.update_closest_camera_rotation()
-        #else:
-           # char_camera=bpy.data.objects.get(f'{active_camera}_camera')
-            #marker = scene.timeline_markers.new(name=char_camera.name, frame=current_frame)
-            #marker.camera = char_camera
-           
     def create_scene_cameras(self):
         avg_hip_bone = Vector((0,0,0))
         n = 0
 
         for character_name in self.characters_data:
             armature=bpy.data.objects.get(f'{character_name}_rig')
-            target_bone_names = ['hip', 'pelvis', 'hips']
-            hip_bone = None
-            for bone in armature.pose.bones:
-                if any(target_bone_name in bone.name.lower() for target_bone_name in target_bone_names):
-                    hip_bone = bone
-                    break
-            
+            hip_bone = self.bone(armature, character_name, "hips")
             hip_bone_world_location = armature.matrix_world @ hip_bone.head
             avg_hip_bone+=hip_bone_world_location
             n += 1
@@ -508,31 +576,24 @@ class AnimationHandler:
 
         print("\nCreated scene cameras")
           
-    def update_closest_camera_rotation(self):
+    def closest_scene_camera(self):
+        """
+        Finds the scene camera best aligned with the direction the characters face at the current frame.
+
+        Returns:
+            The camera and the average head location it should look at.
+        """
         avg_hip_bone = Vector((0, 0, 0))
         avg_head_bone_world_location = Vector((0, 0, 0))
         n = 0
-        target_bone_names = ['hip', 'pelvis', 'hips']
         
         # Calculate average head and hip positions
         for character in self.characters_data:
             character_name = character
             armature = bpy.data.objects.get(f'{character_name}_rig')
 
-            target_bone_name = "head"        
-            for bone in armature.pose.bones:
-                if target_bone_name in bone.name.lower():
-                    head_bone = armature.pose.bones.get(f'{bone.name}')
-                    break
-
-            head_bone_world_location = armature.matrix_world @ head_bone.head
-            
-            hip_bone = None
-            for bone in armature.pose.bones:
-                if any(target_bone_name in bone.name.lower() for target_bone_name in target_bone_names):
-                    hip_bone = bone
-                    break
-            
+            head_bone_world_location = armature.matrix_world @ self.bone(armature, character_name, "head").head
+            hip_bone = self.bone(armature, character_name, "hips")
             hip_bone_world_location = armature.matrix_world @ hip_bone.head
             avg_head_bone_world_location += head_bone_world_location
             avg_hip_bone += hip_bone_world_location
@@ -562,34 +623,60 @@ class AnimationHandler:
                 best_alignment = alignment
                 closest_camera = cam
 
-        if closest_camera:
-            current_frame = bpy.context.scene.frame_current
-            
-            # Define the threshold for switching cameras (e.g., 10 frames)
-            frame_threshold = 10
-            
-            # Check if the closest camera is different and the frame gap is greater than the threshold
-            if closest_camera != self.closest_camera and (self.closest_camera is None or abs(current_frame - self.last_camera_switch_frame) > frame_threshold):
+        return closest_camera, avg_head_bone_world_location
+
+    def aim_camera(self, camera : bpy.types.Object, target : Vector, frame : int):
+        """Rotates a camera to look at the target and keyframes the rotation."""
+        rot_quat = (target - camera.location).to_track_quat('-Z', 'Y')
+        # stay compatible with the previous key, so the interpolation never spins the camera around
+        camera.rotation_euler = rot_quat.to_euler('XYZ', camera.rotation_euler)
+        camera.keyframe_insert(data_path="rotation_euler", frame=frame)
+
+    @profiled("blender bake cameras", "blender")
+    def bake_cameras(self, step : int = CAMERA_SAMPLE_STEP):
+        """
+        Chooses the scene camera over the whole timeline before rendering and bakes the cuts as timeline markers
+        and the camera motion as keyframes, so the render itself runs no Python per frame.
+
+        The characters are evaluated every `step` frames; a cut only happens more than `CAMERA_SWITCH_FRAMES`
+        after the previous one.
+
+        Args:
+            step (int): how many frames apart the characters are sampled
+        """
+        scene = bpy.context.scene
+        scene.timeline_markers.clear()
+        cuts = CameraCuts(CAMERA_SWITCH_FRAMES)
+
+        for frame in sample_frames(self.last_frame, step):
+            scene.frame_set(frame)
+            closest_camera, target = self.closest_scene_camera()
+            if cuts.update(frame, closest_camera):
                 # Create a new marker for the closest camera
-                marker = bpy.context.scene.timeline_markers.new(name=closest_camera.name, frame=current_frame)
+                marker = scene.timeline_markers.new(name=closest_camera.name, frame=frame)
                 marker.camera = closest_camera
+            if closest_camera is not None and closest_camera == cuts.camera:
+                self.aim_camera(closest_camera, target, frame)
 
-                # Rotate the closest camera to face the head bone
-                direction = avg_head_bone_world_location - closest_camera.location
-                rot_quat = direction.to_track_quat('-Z', 'Y')
-                closest_camera.rotation_euler = rot_quat.to_euler()
+            if self.char_cameras:
+                self.camera_follow_character(scene, bpy.context.evaluated_depsgraph_get())
+                for camera_data in self.char_cameras:
+                    camera_data['camera'].keyframe_insert(data_path="location", frame=frame)
+                    camera_data['camera'].keyframe_insert(data_path="rotation_euler", frame=frame)
 
-                # Update the last switch frame and the closest camera
-                self.last_camera_switch_frame = current_frame
-                self.closest_camera = closest_camera
-            elif closest_camera == self.closest_camera:
-                # If the closest camera hasn't changed, still update its rotation
-                direction = avg_head_bone_world_location - closest_camera.location
-                rot_quat = direction.to_track_quat('-Z', 'Y')
-                closest_camera.rotation_euler = rot_quat.to_euler()
+        if scene.camera is None and scene.timeline_markers:
+            # the markers switch the camera during the render, this is only the one the file opens with
+            scene.camera = min(scene.timeline_markers, key=lambda marker: marker.frame).camera
+        print(f"\nBaked {len(scene.timeline_markers)} camera cuts")
 
-    def render_animation(self, render_quality:str):
-        """Render the animation to an MP4 file"""
+    def configure_render(self, render_quality : str, audio : bool = True):
+        """
+        Sets the output format, resolution and frame range of the render.
+
+        Args:
+            render_quality (str): low, med, high or best
+            audio (bool): mux the sequencer audio into the video, off for the parts of a distributed render
+        """
         if render_quality == "low":
             constant_rate = "HIGH"
             res_x = 720
@@ -620,7 +707,7 @@ class AnimationHandler:
         scene.render.filepath = self.render_path
         scene.render.engine = 'BLENDER_EEVEE'
 
-        scene.render.ffmpeg.audio_codec = 'AAC'
+        scene.render.ffmpeg.audio_codec = 'AAC' if audio else 'NONE'
         scene.render.ffmpeg.audio_bitrate = 192 
         scene.render.ffmpeg.audio_channels = 'STEREO'
         scene.render.ffmpeg.audio_mixrate = 48000
@@ -631,8 +718,13 @@ class AnimationHandler:
         scene.frame_start = 1
         scene.frame_end = int(self.last_frame)
 
-        # Render the animation
-        bpy.ops.render.render('INVOKE_DEFAULT', animation=True)
+    @profiled("blender start render", "blender")
+    def render_animation(self, render_quality:str):
+        """Render the animation to an MP4 file"""
+        self.configure_render(render_quality)
+
+        # Render the animation, blocking until the last frame is written
+        bpy.ops.render.render('EXEC_DEFAULT', animation=True)
 
     def initial_place_characters(self):
         for character in self.loaded_rigs.values():
@@ -640,6 +732,7 @@ class AnimationHandler:
 
 
 
+    @profiled("blender create box", "blender")
     def create_box(self, Size=100):
         """Create a box around the character to absorb light"""
         
@@ -651,18 +744,8 @@ class AnimationHandler:
         for character in self.characters_data:
             character_name=character
             armature=bpy.data.objects.get(f'{character_name}_rig')
-            
-            target_bone_name = "head"        
-            for bone in armature.pose.bones:
-                if target_bone_name in bone.name.lower():
-                    head_bone = armature.pose.bones.get(f'{bone.name}')
-                    break
-
-            target_bone_name = "foot"        
-            for bone in armature.pose.bones:
-                if target_bone_name in bone.name.lower():
-                    foot_bone = armature.pose.bones.get(f'{bone.name}')
-                    break
+            head_bone = self.bone(armature, character_name, "head")
+            foot_bone = self.bone(armature, character_name, "foot")
 
             head_bone_world_location =armature.matrix_world @ head_bone.head
             
@@ -686,6 +769,7 @@ class AnimationHandler:
 
         print("\nCreated box")
 
+    @profiled("blender textures", "blender")
     def set_box_properties(self, walls_texture_path, floor_texture_path, ceiling_texture_path,
                         walls_mapping_scale=(3, 4, 1), floor_mapping_scale=(100, 100, 100), ceiling_mapping_scale=(1, 1, 1),
                         walls_mapping_rotation=(0, 0, 1.57), floor_mapping_rotation=(0, 0, 0), ceiling_mapping_rotation=(0, 0, 0),
@@ -847,6 +931,7 @@ class AnimationHandler:
 
         return light_object
 
+    @profiled("blender audio", "blender")
     def add_audio(self):
         """Adds audio strips to the sequencer based on the audio frames."""
         scene = bpy.data.scenes[0]
@@ -857,10 +942,15 @@ class AnimationHandler:
 
         sequence_editor = scene.sequence_editor
 
+        # a continuous score replaces the per-sentence background clips with one strip
+        if self.background_score:
+            sequence_editor.sequences.new_sound(name="background_score", filepath=self.background_score, channel=1, frame_start=1)
+
         # Add audio strips
         for frame, audio_paths in self.audio_frames:
             if not audio_paths: continue
-            sequence_editor.sequences.new_sound(name=os.path.basename(audio_paths[0].split()[-2]), filepath=audio_paths[0], channel=1, frame_start=frame)
+            if audio_paths[0]:
+                sequence_editor.sequences.new_sound(name=os.path.basename(audio_paths[0].split()[-2]), filepath=audio_paths[0], channel=1, frame_start=frame)
             sequence_editor.sequences.new_sound(name=os.path.basename(audio_paths[1].split()[-2]), filepath=audio_paths[1], channel=2, frame_start=frame)
 
     def face_closest_character(self, armature) -> float: 
@@ -915,6 +1005,7 @@ class AnimationHandler:
                 min_distance = distance
         return closest_armature
 
+    @profiled("blender save", "blender")
     def save_as_file(self):
         """Saves the .blend file if the user has accepted the option"""
         if self.blender_output_path:
@@ -922,20 +1013,29 @@ class AnimationHandler:
                 os.remove(self.blender_output_path)
             bpy.ops.wm.save_as_mainfile(filepath=self.blender_output_path)
 
-    def on_render_complete(scene, depsgraph, context):
-        print("\nRender Saved\n")
-        print("*" * 14)
-        print("\nMARTA COMPLETE\n")
-        print("*" * 14)
-        
-        bpy.ops.wm.quit_blender()
-    
-
-
-    def run(self):
+    def track_render_frames(self):
+        """Records every rendered frame as a span. This adds Python to every frame, so it is only done with --profile-frames."""
+        frame_start = {}
+        def render_pre(scene, *args):
+            frame_start[scene.frame_current] = time.perf_counter()
+        def render_post(scene, *args):
+            start = frame_start.pop(scene.frame_current, None)
+            if start is not None:
+                get_profiler().record("blender render frame", start, time.perf_counter(), "blender", frame=scene.frame_current)
+        bpy.app.handlers.render_pre.append(render_pre)
+        bpy.app.handlers.render_post.append(render_post)
+
+    def write_profile(self):
+        """Writes the spans recorded in Blender next to the render, marta.py merges them into the story's trace."""
+        get_profiler().write(os.path.join(os.path.dirname(self.render_path), "render_profile.json"))
+
+    @profiled("blender build scene", "blender")
+    def build(self):
         self.clear_scene()
-        bpy.app.handlers.render_complete.append(self.on_render_complete)
         self.loaded_rigs = {}
+        self.library_actions = {}
+        self.retargeted_actions = {}
+        self.library_changed = False
         i = 0
         for character_name, actions_dict in zip(self.characters_data, self.actions_list):
             # set the path for getting characters
@@ -946,6 +1046,7 @@ class AnimationHandler:
             if character_name not in self.loaded_rigs.keys():
                 self.target_armature = self.load_rig(target_fbx_path, f'{character_name}_rig', posX=len(self.loaded_rigs))
                 self.loaded_rigs[character_name] = self.target_armature
+                self.index_bones(character_name, self.target_armature)
             else:
                 self.target_armature = self.loaded_rigs[character_name]
             self.rig_matrix_world = self.target_armature.matrix_world.copy()
@@ -956,10 +1057,10 @@ class AnimationHandler:
                 # set the name for the rig
                 start_frame, end_frame = data[0][0], data[0][1]
                 rig_name = character_name + '_' + f"({start_frame}, {end_frame})_rig"
-                action_armature = self.load_animation(filepath=action_path, name=rig_name)
-                self.retarget_rokoko(self.target_armature, action_armature)
-                action_armature.hide_set(True)
-                self.push_action_to_nla(armature=self.target_armature, action_name=f"{rig_name}_action", end_frame=end_frame)
+                # repeated clips (idle above all) share the actions of their first import
+                source_action, retargeted_action = self.library_action(character_name, action_path)
+                self.retargeted_actions[f"{rig_name}_action"] = retargeted_action
+                self.push_action_to_nla(armature=self.target_armature, action_name=source_action.name, end_frame=end_frame, strip_name=f"{rig_name}_action")
             
         
             # Organize the sequences and positions
@@ -992,25 +1093,57 @@ class AnimationHandler:
         self.create_light()
         bpy.app.handlers.frame_change_pre.clear()
         bpy.app.handlers.frame_change_post.clear()
-
-        bpy.app.handlers.frame_change_post.append(lambda scene, dpgraph: self.frame_change_handler(scene, dpgraph))
         bpy.context.scene.frame_end = int(self.end_frame_anim)
-       
+
+        # the camera cuts are baked, the render needs no frame change handler
+        self.bake_cameras()
         bpy.context.scene.frame_current = 0
         bpy.context.view_layer.update()
 
+        self.save_action_library()
         self.add_audio()
         self.save_as_file()
+
+    def build_only(self, blend_path : str, audio_path : str):
+        """
+        Builds the scene for a distributed render without rendering it: the .blend the render workers open is saved to
+        `blend_path` with the video only output settings, and the sequencer audio is mixed down to `audio_path`.
+        """
+        self.build()
+        self.configure_render(self.render_quality, audio=False)
+        with get_profiler().span("blender audio mixdown", "blender"):
+            bpy.ops.sound.mixdown(filepath=audio_path, check_existing=False, container='WAV', codec='PCM', mixrate=48000, accuracy=1024)
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
+        self.write_profile()
+
+    def run(self, profile_frames : bool = False):
+        if profile_frames:
+            self.track_render_frames()
+        self.build()
+        self.write_profile()
         self.render_animation(self.render_quality)
+        self.write_profile()
+        print("\nRender Saved\n")
+        print("*" * 14)
+        print("\nMARTA COMPLETE\n")
+        print("*" * 14)
         
         
         
 def main():
     # set animation path
     root_path = os.path.join(os.getcwd())
-    
+
+    # the arguments after blender's own `--`
+    parser = argparse.ArgumentParser(prog="blender -P rendering/renderer.py --")
+    parser.add_argument("frame_data", help="the path to the frame data JSON")
+    parser.add_argument("--build-only", metavar="BLEND", help="only build the scene and save it here, for a distributed render")
+    parser.add_argument("--audio", help="with --build-only, where the mixed down audio is written")
+    parser.add_argument("--profile-frames", action="store_true", help="record every rendered frame as a profiling span")
+    args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[-1:])
+
     # open the data file
-    f = open(sys.argv[-1])
+    f = open(args.frame_data)
     frame_data = json.load(f)
     audio_frames = []
     characters_data = []
@@ -1053,9 +1186,18 @@ def main():
     render_path = frame_data['render_output']
     render_quality = frame_data['render_quality']
     blender_output_path = frame_data['blender_output']
+    background_score = frame_data.get('background_score', "")
+    # optional {character: rig type} and {rig type: {bone: [name substrings]}}
+    rig_types = frame_data.get('rig_types', {})
+    bone_patterns = frame_data.get('bone_patterns', {})
+    # optional .blend that keeps the retargeted animations for later renders
+    action_library_path = frame_data.get('action_library', "")
     # run the program
-    animation_handler = AnimationHandler(root_path, characters_data, actions_list, textures, last_frame, audio_frames, background_characters, render_path, render_quality, blender_output_path)
-    animation_handler.run()
+    animation_handler = AnimationHandler(root_path, characters_data, actions_list, textures, last_frame, audio_frames, background_characters, render_path, render_quality, blender_output_path, background_score, rig_types, bone_patterns, action_library_path)
+    if args.build_only:
+        animation_handler.build_only(args.build_only, args.audio or os.path.splitext(args.build_only)[0] + ".wav")
+    else:
+        animation_handler.run(args.profile_frames)
  
 main()
 
@@ -1,12 +1,172 @@
-import subprocess, os
+import subprocess, os, re, sys, glob, threading
+from concurrent.futures import ThreadPoolExecutor
 
+# lets `python rendering/start_render.py` import the rest of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from orchestration.profiling import span
+from rendering.timeline import load_timeline
+
+BLENDER = 'blender'
+FFMPEG = 'ffmpeg'
 BLENDER_SCRIPT = 'rendering/renderer.py'
+# a distributed render without a number of workers starts one per this many cores
+CORES_PER_WORKER = 4
 
-def render(frame_data_path):
-    """Activates the rendering script in blender"""
-    subprocess.call(["blender", "-P", BLENDER_SCRIPT, "--", frame_data_path])
+# the frame numbers in Blender's background render output, printed while a frame renders
+PROGRESS_PATTERN = re.compile(r"^Fra:(\d+)\b")
+# printed once a frame is written, to a video ("Append frame 12") or as an image ("Saved: '...'")
+SAVED_PATTERN = re.compile(r"^(?:Append frame (\d+)|Saved: )")
 
-if __name__ == "__main__":
-    story_name = input("What is the name of the story you want to render? ")
-    render(os.path.join(os.getcwd(), "output", story_name, story_name.replace(" ", "_") + "_frame_data.json"))
+def print_progress(done : int, total : int):
+    """The default progress callback, prints one line per rendered frame."""
+    print(f"Rendered {done} / {total} frames", flush=True)
+
+class RenderProgress:
+    """
+    Counts the frames Blender finished rendering, across any number of processes, and calls
+    `callback(done, total)` whenever another frame is finished. A frame is finished once it is written or
+    once the process that rendered it starts its next frame.
+    """
+    def __init__(self, total : int, callback=print_progress):
+        self.total = total
+        self.callback = callback
+        self.frames = set()
+        # source -> the frame that process is rendering
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def feed(self, line : str, source=None) -> bool:
+        """
+        Reads a line of Blender's output.
+
+        Args:
+            line (str): the line
+            source: identifies the Blender process that printed the line, e.g. its pid
+
+        Returns:
+            True if it was a progress line, which need not be echoed.
+        """
+        started = PROGRESS_PATTERN.match(line)
+        saved = SAVED_PATTERN.match(line)
+        if not started and not saved:
+            return False
+        with self._lock:
+            rendering = self._rendering.get(source)
+            if started:
+                self._rendering[source] = int(started.group(1))
+                finished = rendering if rendering != self._rendering[source] else None
+            else:
+                finished = int(saved.group(1)) if saved.group(1) else rendering
+            if finished is None or finished in self.frames:
+                return bool(started)
+            self.frames.add(finished)
+            done = len(self.frames)
+        if self.callback:
+            self.callback(done, self.total)
+        return bool(started)
+
+def run_blender(command : list, progress : RenderProgress = None) -> int:
+    """
+    Runs Blender, passing its output to `progress` and echoing everything but the progress lines.
+
+    Returns:
+        Blender's exit code.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, errors='replace')
+    for line in process.stdout:
+        if progress is None or not progress.feed(line, process.pid):
+            print(line, end="", flush=True)
+    return process.wait()
+
+def render(frame_data_path : str, progress=print_progress, profile_frames : bool = False) -> int:
+    """
+    Renders a story in a headless Blender.
+
+    Args:
+        frame_data_path (str): the path to the frame data JSON
+        progress: called with the number of rendered frames and the total after every frame, None to echo Blender's own output
+        profile_frames (bool): record every frame as a profiling span, which runs Python on every frame
+
+    Returns:
+        Blender's exit code, non-zero when the render script failed.
+    """
+    total = int(load_timeline(frame_data_path)['end_frame'])
+    with span("blender render", "subprocess"):
+        # without --python-exit-code an exception in the script still exits with 0
+        command = [BLENDER, "-b", "--python-exit-code", "1", "-P", BLENDER_SCRIPT, "--", frame_data_path]
+        return run_blender(command + ["--profile-frames"] if profile_frames else command, RenderProgress(total, progress) if progress else None)
 
+def frame_ranges(start : int, end : int, workers : int) -> list:
+    """Splits the frames from `start` to `end` (inclusive) into at most `workers` contiguous (start, end) ranges."""
+    frames = end - start + 1
+    workers = max(1, min(workers, frames))
+    bounds = [start + frames * i // workers for i in range(workers + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(workers)]
+
+def render_distributed(frame_data_path : str, workers : int = None, progress=print_progress) -> int:
+    """
+    Renders a story with several headless Blender processes. The scene is built once and saved as a .blend, each
+    worker renders a disjoint frame range of it to a video segment, and ffmpeg joins the segments and muxes in the
+    audio mixed down while building.
+
+    Args:
+        frame_data_path (str): the path to the frame data JSON
+        workers (int): how many Blender processes render at once, one per `CORES_PER_WORKER` cores by default
+        progress: called with the number of rendered frames and the total, see `render`
+
+    Returns:
+        The exit code, 0 once the video is written.
+    """
+    timeline = load_timeline(frame_data_path)
+    render_output = timeline['render_output']
+    workers = workers or max(1, (os.cpu_count() or 1) // CORES_PER_WORKER)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    parts_path = os.path.splitext(render_output)[0] + "_parts"
+    os.makedirs(parts_path, exist_ok=True)
+    for path in glob.glob(os.path.join(parts_path, "part_*")):
+        os.remove(path)
+    blend_path = os.path.join(parts_path, "scene.blend")
+    audio_path = os.path.join(parts_path, "audio.wav")
+
+    with span("blender build", "subprocess"):
+        code = run_blender([BLENDER, "-b", "--python-exit-code", "1", "-P", BLENDER_SCRIPT, "--", frame_data_path, "--build-only", blend_path, "--audio", audio_path])
+    if code or not os.path.isfile(blend_path):
+        print(f"Building the scene failed ({code})")
+        return code or 1
+
+    ranges = frame_ranges(1, int(timeline['end_frame']), workers)
+    tracker = RenderProgress(int(timeline['end_frame']), progress) if progress else None
+    # -o, -s and -e have to come before -a, blender applies its arguments in order
+    commands = [[BLENDER, "-b", blend_path, "-o", os.path.join(parts_path, f"part_{i:03d}_"), "-s", str(start), "-e", str(end), "-t", str(threads), "-a"]
+                for i, (start, end) in enumerate(ranges)]
+    with span("blender render workers", "subprocess", workers=len(ranges)), ThreadPoolExecutor(len(commands)) as pool:
+        codes = list(pool.map(lambda command: run_blender(command, tracker), commands))
+    for (start, end), code in zip(ranges, codes):
+        if code:
+            print(f"Rendering frames {start} to {end} failed ({code})")
+            return code
+
+    # blender appends the frame range to the name of each segment
+    parts = [sorted(glob.glob(os.path.join(parts_path, f"part_{i:03d}_*"))) for i in range(len(ranges))]
+    if not all(parts):
+        print("A render worker wrote no video")
+        return 1
+    parts = [matches[0] for matches in parts]
+    list_path = os.path.join(parts_path, "parts.txt")
+    with open(list_path, 'w', encoding='utf-8') as f:
+        f.writelines(f"file '{os.path.abspath(part)}'\n" for part in parts)
+
+    with span("ffmpeg concat", "subprocess"):
+        return subprocess.call([FFMPEG, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-i", audio_path,
+                                "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-shortest", render_output])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        frame_data_path = sys.argv[1]
+    else:
+        story_name = input("What is the name of the story you want to render? ")
+        frame_data_path = os.path.join(os.getcwd(), "output", story_name, story_name.replace(" ", "_") + "_frame_data.json")
+    if len(sys.argv) > 2:
+        sys.exit(render_distributed(frame_data_path, int(sys.argv[2])))
+    sys.exit(render(frame_data_path))
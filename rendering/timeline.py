@@ -0,0 +1,117 @@
+import json, os
+
+RENDER_QUALITIES = ("low", "med", "high", "best")
+REQUIRED_KEYS = ("render_quality", "render_output", "blender_output", "end_frame")
+
+def load_timeline(frame_data_path : str) -> dict:
+    """Reads a frame data JSON file."""
+    with open(frame_data_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def validate_timeline(frame_data_path : str, check_files : bool = True) -> list:
+    """
+    Checks that a frame data file can be rendered, without importing any of the generation stack.
+
+    Args:
+        frame_data_path (str): the path to the frame data JSON
+        check_files (bool): also check that every referenced texture, audio clip and animation exists
+
+    Returns:
+        A list of problems, empty when the timeline is valid.
+    """
+    try:
+        timeline = load_timeline(frame_data_path)
+    except (OSError, ValueError) as e:
+        return [f"cannot read {frame_data_path}: {e}"]
+
+    errors = [f"missing key '{key}'" for key in REQUIRED_KEYS if key not in timeline]
+    if timeline.get('render_quality') not in RENDER_QUALITIES:
+        errors.append(f"render_quality must be one of {', '.join(RENDER_QUALITIES)}")
+
+    files = [value for key, value in timeline.items() if key.endswith('path')]
+    if timeline.get('background_score'):
+        files.append(timeline['background_score'])
+
+    frames = sorted(int(key) for key in timeline if key.isdigit())
+    if not frames:
+        errors.append("the timeline has no frames")
+    end_frame = timeline.get('end_frame')
+    if frames and isinstance(end_frame, int) and end_frame <= frames[-1]:
+        errors.append(f"end_frame {end_frame} is not after the last sequence ({frames[-1]})")
+
+    for frame in frames:
+        sequence = timeline[str(frame)]
+        for path in sequence.get('audio_paths', []):
+            if path:
+                files.append(path)
+        for character, data in sequence.get('characters', {}).items():
+            position = data.get('sequence_end_position')
+            if not isinstance(position, (list, tuple)) or len(position) != 3:
+                errors.append(f"frame {frame}: '{character}' needs a 3D sequence_end_position")
+            if not data.get('animation'):
+                errors.append(f"frame {frame}: '{character}' has no animation")
+            else:
+                files.append(data['animation'])
+
+    if check_files:
+        errors.extend(f"missing file {path}" for path in dict.fromkeys(files) if not os.path.isfile(path))
+    return errors
+
+class TimelineJournal:
+    """
+    Appends a story's timeline to a JSON lines file as it is generated, so a long story never holds its
+    whole timeline in memory and the sections written so far can already be rendered.
+
+    Each line either sets top-level frame data keys ({"set": {...}}) or adds one sequence
+    ({"frame": start, "end": end, "sequence": {...}}). Later lines override earlier ones.
+    """
+    def __init__(self, path : str, fresh : bool = True):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fresh:
+            open(path, 'w', encoding='utf-8').close()
+
+    def set(self, **values):
+        """Sets top-level frame data keys, e.g. the textures or the render settings."""
+        self._append({'set': values})
+
+    def add_sequence(self, frame : int, end : int, sequence : dict):
+        """Adds the sequence that starts at `frame` and lasts until `end`."""
+        self._append({'frame': frame, 'end': end, 'sequence': sequence})
+
+    def _append(self, line : dict):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+def assemble_timeline(journal_path : str, frame_data_path : str) -> str:
+    """
+    Writes the frame data JSON the renderer reads from a timeline journal. The journal is streamed
+    line by line into a temporary file, so this also works on a journal that is still being written.
+
+    Args:
+        journal_path (str): the path to the timeline journal (.jsonl)
+        frame_data_path (str): where the frame data JSON is written
+
+    Returns:
+        The path to the frame data.
+    """
+    settings = {}
+    end_frame = 1
+    tmp_path = frame_data_path + ".tmp"
+    with open(journal_path, encoding='utf-8') as journal, open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write("{\n")
+        for line in journal:
+            if not line.endswith("\n"):
+                # a line that is still being written
+                break
+            entry = json.loads(line)
+            if 'set' in entry:
+                settings.update(entry['set'])
+            else:
+                f.write(f"    {json.dumps(str(entry['frame']))}: {json.dumps(entry['sequence'], ensure_ascii=False)},\n")
+                end_frame = max(end_frame, entry['end'])
+        settings['end_frame'] = end_frame
+        f.write(",\n".join(f"    {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)}" for key, value in settings.items()))
+        f.write("\n}\n")
+    os.replace(tmp_path, frame_data_path)
+    return frame_data_path
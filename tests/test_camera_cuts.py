@@ -0,0 +1,22 @@
+from rendering.camera_cuts import CameraCuts, sample_frames
+
+def test_sampled_frames_include_the_last_frame():
+    assert sample_frames(12, 5) == [1, 6, 11, 12]
+    assert sample_frames(11, 5) == [1, 6, 11]
+    assert sample_frames(0, 5) == [1]
+
+def test_first_camera_is_cut_to_immediately():
+    cuts = CameraCuts(10)
+    assert not cuts.update(1, None)
+    assert cuts.update(6, "front")
+    assert cuts.camera == "front" and cuts.last_cut == 6
+
+def test_no_cut_within_the_switch_frames():
+    cuts = CameraCuts(10)
+    samples = [(1, "front"), (6, "side"), (11, "side"), (16, "side"), (21, "front"), (26, "front")]
+    assert [frame for frame, camera in samples if cuts.update(frame, camera)] == [1, 16]
+    assert cuts.camera == "side"
+
+def test_same_camera_is_never_cut_to_again():
+    cuts = CameraCuts(10)
+    assert [cuts.update(frame, "front") for frame in (1, 20, 40)] == [True, False, False]
@@ -0,0 +1,38 @@
+from orchestration.manifest import Manifest
+
+def test_recorded_artifact_is_found_with_the_same_params(tmp_path):
+    manifest = Manifest("story", str(tmp_path))
+    manifest.record("texture:floor", {"prompt": "grass", "size": (512, 512)}, "floor.png")
+    assert manifest.lookup("texture:floor", {"prompt": "grass", "size": [512, 512]}) == (True, "floor.png")
+    assert manifest.lookup("texture:floor", {"prompt": "gravel", "size": [512, 512]}) == (False, None)
+    assert manifest.lookup("texture:ceiling", {"prompt": "grass"}) == (False, None)
+
+def test_resumes_from_the_saved_manifest(tmp_path):
+    Manifest("story", str(tmp_path)).record("analysis", "story text", {"characters": ["aiden"]})
+    assert (tmp_path / "output" / "story" / "manifest.json").is_file()
+    assert Manifest("story", str(tmp_path)).lookup("analysis", "story text") == (True, {"characters": ["aiden"]})
+
+def test_changed_or_missing_files_invalidate_the_entry(tmp_path):
+    image = tmp_path / "floor.png"
+    image.write_bytes(b"grass")
+    manifest = Manifest("story", str(tmp_path))
+    manifest.record("texture:floor", "grass", str(image), [str(image)])
+    assert manifest.lookup("texture:floor", "grass")[0]
+    image.write_bytes(b"gravel")
+    assert not manifest.lookup("texture:floor", "grass")[0]
+    manifest.record("texture:floor", "grass", str(image), [str(image)])
+    image.unlink()
+    assert not manifest.lookup("texture:floor", "grass")[0]
+
+def test_cached_only_produces_once(tmp_path):
+    produced = []
+    produce = lambda: produced.append(1) or ["tree", "rock"]
+    assert Manifest("story", str(tmp_path)).cached("objects", "story text", produce) == ["tree", "rock"]
+    assert Manifest("story", str(tmp_path)).cached("objects", "story text", produce) == ["tree", "rock"]
+    assert len(produced) == 1
+
+def test_clear_forgets_everything(tmp_path):
+    manifest = Manifest("story", str(tmp_path))
+    manifest.record("analysis", "story text", "plan")
+    manifest.clear()
+    assert Manifest("story", str(tmp_path)).lookup("analysis", "story text") == (False, None)
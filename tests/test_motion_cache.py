@@ -0,0 +1,54 @@
+import os
+from rendering.motion_cache import MotionCache
+
+def _generated(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+def test_key_keeps_the_exact_prompt(tmp_path):
+    cache = MotionCache(str(tmp_path / "cache"))
+    key = cache.make_key("A person waves", 64, "t2m")
+    assert key == cache.make_key("A person waves", 64, "t2m")
+    assert key != cache.make_key("a person waves", 64, "t2m")
+    assert key != cache.make_key("A person waves", 96, "t2m")
+    assert key != cache.make_key("A person waves", 64, "kit")
+
+def test_put_moves_the_files_into_the_cache(tmp_path):
+    cache = MotionCache(str(tmp_path / "cache"))
+    generated = _generated(tmp_path, "sample.bvh", "motion")
+    stored = cache.put("key", {".bvh": generated, ".mp4": str(tmp_path / "missing.mp4")}, prompt="a person waves")
+    assert list(stored) == [".bvh"]
+    assert not os.path.exists(generated)
+    assert cache.get("key") == stored[".bvh"]
+    assert cache.get("key", ".mp4") is None
+    assert cache.get("other") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1}
+
+def test_index_survives_a_new_cache_object(tmp_path):
+    MotionCache(str(tmp_path / "cache")).put("key", {".bvh": _generated(tmp_path, "sample.bvh", "motion")})
+    assert MotionCache(str(tmp_path / "cache")).get("key") is not None
+
+def test_least_recently_used_motions_are_evicted(tmp_path, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr("rendering.motion_cache.time.time", lambda: next(clock))
+    cache = MotionCache(str(tmp_path / "cache"), max_entries=2)
+    for key in ("first", "second"):
+        cache.put(key, {".bvh": _generated(tmp_path, key + ".bvh", key)})
+    cache.get("first")
+    cache.put("third", {".bvh": _generated(tmp_path, "third.bvh", "third")})
+    assert cache.get("second") is None
+    assert not os.path.exists(os.path.join(str(tmp_path / "cache"), "second.bvh"))
+    assert cache.get("first") is not None and cache.get("third") is not None
+
+def test_link_survives_eviction_and_replaces_the_destination(tmp_path):
+    cache = MotionCache(str(tmp_path / "cache"), max_entries=1)
+    first = cache.put("first", {".bvh": _generated(tmp_path, "first.bvh", "first")})[".bvh"]
+    destination = str(tmp_path / "story" / "clip.bvh")
+    cache.link(first, destination)
+    cache.put("second", {".bvh": _generated(tmp_path, "second.bvh", "second")})
+    with open(destination) as f:
+        assert f.read() == "first"
+    cache.link(cache.get("second"), destination)
+    with open(destination) as f:
+        assert f.read() == "second"
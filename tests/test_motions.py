@@ -0,0 +1,73 @@
+import io
+import marta
+from nlp.position_planner import PositionPlanner
+from rendering import momask_utils
+from rendering.motion_cache import MotionCache
+
+def test_same_prompt_with_different_lengths_gets_separate_clips(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(marta, "get_position_planner", lambda: PositionPlanner())
+    monkeypatch.setattr(marta, "generate_motions", lambda requests: {request: str(cache_dir / f"{request[1]}.bvh") for request in requests})
+    for length in (2, 5):
+        (cache_dir / f"{length * 32}.bvh").write_text(str(length))
+
+    pending_motions, short, long = [], {}, {}
+    positions = {}
+    marta.set_generated_animation("", short, positions, "He waves.", "aiden", 2, "story", pending_motions, "a person waves")
+    marta.set_generated_animation("", long, positions, "He waves again.", "aiden", 5, "story", pending_motions, "a person waves")
+    marta.resolve_motions(pending_motions, "story")
+
+    assert short['aiden']['animation'] != long['aiden']['animation']
+    with open(short['aiden']['animation']) as f:
+        assert f.read() == "2"
+    with open(long['aiden']['animation']) as f:
+        assert f.read() == "5"
+
+class FakeWorker:
+    """Writes one bvh per prompt instead of running MoMask."""
+    def __init__(self, directory, checkpoint):
+        self.directory = directory
+        self.checkpoint = checkpoint
+        self.calls = 0
+
+    def generate(self, prompts, lengths):
+        self.calls += 1
+        paths = []
+        for i, (prompt, length) in enumerate(zip(prompts, lengths)):
+            path = self.directory / f"{self.calls}_{i}.bvh"
+            path.write_text(f"{self.checkpoint} {prompt} {length}")
+            paths.append(str(path))
+        return paths
+
+def test_motions_are_cached_per_worker_checkpoint(tmp_path, monkeypatch):
+    cache = MotionCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(momask_utils, "get_motion_cache", lambda: cache)
+    worker = FakeWorker(tmp_path, "t2m/first/res")
+    monkeypatch.setattr(momask_utils, "get_worker", lambda: worker)
+
+    first = momask_utils.generate_motions([("a person waves", 64)])
+    assert momask_utils.generate_motions([("a person waves", 64)]) == first
+    assert worker.calls == 1
+
+    worker.checkpoint = "t2m/second/res"
+    second = momask_utils.generate_motions([("a person waves", 64)])
+    assert worker.calls == 2
+    with open(second[("a person waves", 64)]) as f:
+        assert f.read().startswith("t2m/second/res")
+
+def test_worker_is_started_with_the_checkpoint_it_reports(monkeypatch):
+    commands = []
+    class FakeProcess:
+        def __init__(self, command, **kwargs):
+            commands.append(command)
+            self.stdout = io.StringIO('{"ready": true}\n')
+    monkeypatch.setattr(momask_utils.subprocess, "Popen", FakeProcess)
+
+    worker = momask_utils.MomaskWorker(name="t2m_other", res_name="tres_other")
+    worker.start()
+    command = commands[0]
+    assert worker.checkpoint == "/".join((command[command.index("--dataset_name") + 1], command[command.index("--name") + 1],
+                                          command[command.index("--res_name") + 1]))
+    assert worker.checkpoint == "t2m/t2m_other/tres_other"
@@ -0,0 +1,54 @@
+import pytest
+import marta
+from audio.audio_generation import MusicGenSession, TOKENS_PER_SECOND
+from orchestration.manifest import Manifest
+
+def _fake_batch(tmp_path, calls):
+    def generate_audio_batch(prompts, lengths, story_name, indices):
+        calls.append(list(indices))
+        paths = []
+        for index, prompt in zip(indices, prompts):
+            path = tmp_path / f"background{index}.wav"
+            path.write_text(prompt)
+            paths.append(str(path))
+        return paths
+    return generate_audio_batch
+
+def test_sentence_music_is_generated_in_one_batch_and_resumed(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(marta, "generate_audio_batch", _fake_batch(tmp_path, calls))
+    plans = [{'index': i, 'sequence_length': 2 + i} for i in range(3)]
+    prompts = {'audio': ["calm", "tense", "happy"]}
+
+    music = marta.generate_music("story", plans, prompts, Manifest("story", str(tmp_path)), None)
+    assert calls == [[0, 1, 2]]
+    assert music['clips'] == [str(tmp_path / f"background{i}.wav") for i in range(3)]
+
+    # only the sentence whose prompt changed is generated again
+    prompts['audio'][1] = "sad"
+    resumed = marta.generate_music("story", plans, prompts, Manifest("story", str(tmp_path)), None)
+    assert calls == [[0, 1, 2], [1]]
+    assert resumed['clips'] == music['clips']
+
+class FakeInputs(dict):
+    def to(self, device):
+        return self
+
+class FakeMusicGen:
+    """Returns one channel per prompt whose samples are the sample index."""
+    def __init__(self, torch):
+        self.torch = torch
+        self.max_new_tokens = []
+
+    def generate(self, max_new_tokens, **inputs):
+        self.max_new_tokens.append(max_new_tokens)
+        return self.torch.arange(max_new_tokens * 10, dtype=self.torch.float32).repeat(len(inputs['text']), 1, 1)
+
+def test_batch_is_padded_to_its_longest_clip_and_trimmed_back():
+    torch = pytest.importorskip("torch")
+    session = MusicGenSession(device="cpu")
+    session.model = FakeMusicGen(torch)
+    session.processor = lambda text, **kwargs: FakeInputs(text=text)
+    clips = session.generate(["calm", "tense", "happy"], [1, 2, 0.5], batch_size=2)
+    assert session.model.max_new_tokens == [round(2 * TOKENS_PER_SECOND), round(0.5 * TOKENS_PER_SECOND)]
+    assert [len(clip) for clip in clips] == [round(TOKENS_PER_SECOND) * 10, round(2 * TOKENS_PER_SECOND) * 10, round(0.5 * TOKENS_PER_SECOND) * 10]
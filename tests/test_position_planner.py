@@ -0,0 +1,56 @@
+import math
+import pytest
+from nlp.position_planner import PositionPlanner
+
+def plan(planner, character, positions, prompt):
+    return planner.plan("", character, "", positions, prompt)
+
+def test_planned_character_is_not_a_target_for_its_own_name():
+    positions = {'david': [(0, 0, 0)], 'goliath': [(0, 3, 0)]}
+    assert plan(PositionPlanner(), 'david', positions, "david walks towards goliath") == (0.0, 1.0, 0)
+
+def test_moves_away_from_a_named_character():
+    positions = {'goliath': [(0, 3, 0)], 'david': [(0, 0, 0)]}
+    assert plan(PositionPlanner(), 'david', positions, "david runs away from goliath") == (0.0, -2.0, 0)
+
+def test_still_prompts_keep_the_position():
+    positions = {'aiden': [(1, 1, 0)]}
+    assert plan(PositionPlanner(), 'aiden', positions, "a person sits on the ground") == (1.0, 1.0, 0)
+
+@pytest.mark.parametrize("prompt, distance", [("a person runs", 2.0), ("a person walks", 1.0), ("a person crawls", 0.5)])
+def test_distance_follows_the_movement(prompt, distance):
+    positions = {'aiden': [(0, 0, 0)]}
+    x, y, _ = plan(PositionPlanner(), 'aiden', positions, prompt)
+    assert math.hypot(x, y) == pytest.approx(distance)
+
+def test_keeps_walking_the_way_it_last_moved():
+    positions = {'aiden': [(0, 0, 0), (1, 0, 0)]}
+    assert plan(PositionPlanner(), 'aiden', positions, "a person walks") == (2.0, 0.0, 0)
+    assert plan(PositionPlanner(), 'aiden', positions, "a person walks backwards") == (0.0, 0.0, 0)
+
+def test_stays_inside_the_box():
+    planner = PositionPlanner()
+    positions = {'aiden': [(planner.bound - 1, 0, 0), (planner.bound, 0, 0)]}
+    x, y, _ = plan(planner, 'aiden', positions, "a person runs")
+    assert x == round(planner.bound, 3) and y == 0
+
+def test_keeps_its_distance_from_other_characters():
+    planner = PositionPlanner(min_distance=0.75)
+    positions = {'aiden': [(0, 0, 0)], 'musfira': [(1, 0, 0)]}
+    # walking straight at musfira would end on top of her
+    x, y, _ = plan(planner, 'aiden', positions, "aiden walks to musfira")
+    assert math.hypot(x - 1, y) >= 0.75 - 1e-3
+
+def test_llm_is_only_asked_when_no_rule_matches(monkeypatch):
+    planner = PositionPlanner(use_llm=True)
+    asked = []
+    monkeypatch.setattr(planner, "_ask_llm", lambda *args: asked.append(args[-2]) or (1.0, 2.0))
+    positions = {'aiden': [(0, 0, 0)]}
+    assert plan(planner, 'aiden', positions, "a person walks") == (0.0, 1.0, 0)
+    assert plan(planner, 'aiden', positions, "a person juggles") == (1.0, 2.0, 0)
+    assert asked == ["a person juggles"]
+
+def test_failed_llm_answer_keeps_the_position(monkeypatch):
+    planner = PositionPlanner(use_llm=True)
+    monkeypatch.setattr(planner, "_ask_llm", lambda *args: None)
+    assert plan(planner, 'aiden', {'aiden': [(1, 1, 0)]}, "a person juggles") == (1.0, 1.0, 0)
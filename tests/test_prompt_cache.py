@@ -0,0 +1,65 @@
+import json, os
+from nlp.prompt_cache import PromptCache
+
+MESSAGES = [{"role": "user", "content": "Here is a story"}]
+
+def _read_index(cache):
+    with open(cache.index_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def test_key_depends_on_model_messages_and_arguments(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    key = cache.make_key("phi", MESSAGES, {"do_sample": False})
+    assert key == cache.make_key("phi", [dict(MESSAGES[0])], {"do_sample": False})
+    assert key != cache.make_key("phi-2", MESSAGES, {"do_sample": False})
+    assert key != cache.make_key("phi", [{"role": "user", "content": "Another story"}], {"do_sample": False})
+    assert key != cache.make_key("phi", MESSAGES, {"do_sample": True})
+
+def test_put_then_get(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    key = cache.make_key("phi", MESSAGES, {})
+    assert cache.get(key) is None
+    cache.put(key, [{"generated_text": "a forest"}])
+    assert cache.get(key) == [{"generated_text": "a forest"}]
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_entries_survive_a_new_cache_object(tmp_path):
+    key = PromptCache(str(tmp_path)).make_key("phi", MESSAGES, {})
+    PromptCache(str(tmp_path)).put(key, "a forest")
+    assert PromptCache(str(tmp_path)).get(key) == "a forest"
+
+def test_bypass_ignores_cached_outputs(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    cache.put("key", "a forest")
+    cache.bypass = True
+    assert cache.get("key") is None
+
+def test_hits_do_not_rewrite_the_index_until_flushed(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    cache.put("key", "a forest")
+    written = _read_index(cache)["key"]["last_access"]
+    modified = os.stat(cache.index_path).st_mtime_ns
+    cache.get("key")
+    assert os.stat(cache.index_path).st_mtime_ns == modified
+    cache.flush()
+    assert _read_index(cache)["key"]["last_access"] > written
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    value = "x" * 10
+    # every entry is 12 bytes as JSON, two fit
+    cache = PromptCache(str(tmp_path), max_bytes=24)
+    cache.put("first", value)
+    cache.put("second", value)
+    cache.get("first")
+    cache.put("third", value)
+    assert cache.get("second") is None
+    assert cache.get("first") == value
+    assert cache.get("third") == value
+    assert not os.path.exists(os.path.join(str(tmp_path), "second.json"))
+
+def test_missing_entry_file_is_a_miss(tmp_path):
+    cache = PromptCache(str(tmp_path))
+    cache.put("key", "a forest")
+    os.remove(os.path.join(str(tmp_path), "key.json"))
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,44 @@
+from rendering.start_render import RenderProgress, frame_ranges
+
+def _progress():
+    reported = []
+    return RenderProgress(3, lambda done, total: reported.append((done, total))), reported
+
+def test_frame_counts_once_it_is_written():
+    progress, reported = _progress()
+    assert progress.feed("Fra:1 Mem:10.00M | Rendering 1 / 64 samples")
+    assert progress.feed("Fra:1 Mem:10.00M | Rendering 64 / 64 samples")
+    assert reported == []
+    assert not progress.feed("Append frame 1")
+    assert reported == [(1, 3)]
+
+def test_frame_counts_once_the_next_frame_starts():
+    progress, reported = _progress()
+    progress.feed("Fra:1 Mem:10.00M")
+    progress.feed("Fra:2 Mem:10.00M")
+    assert reported == [(1, 3)]
+    assert not progress.feed("Saved: '/tmp/0002.png'")
+    assert reported == [(1, 3), (2, 3)]
+    progress.feed("Fra:3 Mem:10.00M")
+    assert reported == [(1, 3), (2, 3)]
+
+def test_workers_are_tracked_separately():
+    progress, reported = _progress()
+    progress.feed("Fra:1 Mem:10.00M", source=1)
+    progress.feed("Fra:3 Mem:10.00M", source=2)
+    assert reported == []
+    progress.feed("Append frame 3", source=2)
+    progress.feed("Fra:2 Mem:10.00M", source=1)
+    assert progress.frames == {1, 3}
+
+def test_other_lines_are_not_progress():
+    progress, reported = _progress()
+    assert not progress.feed("Blender 4.1.0")
+    assert not progress.feed("Saved: '/tmp/0001.png'")
+    assert reported == []
+
+def test_frame_ranges_cover_every_frame_once():
+    ranges = frame_ranges(1, 10, 3)
+    assert ranges == [(1, 3), (4, 6), (7, 10)]
+    assert frame_ranges(1, 2, 8) == [(1, 1), (2, 2)]
+    assert frame_ranges(5, 5, 0) == [(5, 5)]
@@ -0,0 +1,115 @@
+import threading, time
+import pytest
+from orchestration import scheduler
+from orchestration.scheduler import StageGraph, GpuModel, GPU_LANE, IO_LANE
+
+class Tracker:
+    """Stage functions that record the order they run in and how many run at once."""
+    def __init__(self):
+        self.events = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def stage(self, name, result=None, duration=0.05):
+        def run(**arguments):
+            with self._lock:
+                self.events.append("start " + name)
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(duration)
+            with self._lock:
+                self.active -= 1
+                self.events.append("end " + name)
+            return result if result is not None else arguments
+        return run
+
+def _model(tracker, name, memory, loaded=True):
+    state = {'loaded': loaded}
+    def unload():
+        tracker.events.append("unload " + name)
+        state['loaded'] = False
+    return GpuModel(memory, lambda: state['loaded'], unload)
+
+def test_dependencies_run_first_and_get_the_results():
+    tracker = Tracker()
+    graph = StageGraph()
+    graph.add("analysis", tracker.stage("analysis", result="plan"), lane=IO_LANE)
+    graph.add("music", tracker.stage("music"), ["analysis"])
+    results = graph.run()
+    assert tracker.events.index("end analysis") < tracker.events.index("start music")
+    assert results["music"] == {"analysis": "plan"}
+
+def test_unknown_dependency_is_rejected():
+    graph = StageGraph()
+    with pytest.raises(ValueError):
+        graph.add("music", lambda: None, ["analysis"])
+
+def test_gpu_stages_over_budget_run_one_after_another(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: None)
+    tracker = Tracker()
+    graph = StageGraph(gpu_memory_budget=10000)
+    graph.add("textures", tracker.stage("textures"), lane=GPU_LANE, gpu_memory=6000)
+    graph.add("music", tracker.stage("music"), lane=GPU_LANE, gpu_memory=6000)
+    graph.run()
+    assert tracker.max_active == 1
+
+def test_gpu_stages_within_budget_run_together(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: None)
+    tracker = Tracker()
+    graph = StageGraph(gpu_memory_budget=10000)
+    graph.add("textures", tracker.stage("textures", duration=0.2), lane=GPU_LANE, gpu_memory=4000)
+    graph.add("music", tracker.stage("music", duration=0.2), lane=GPU_LANE, gpu_memory=4000)
+    graph.run()
+    assert tracker.max_active == 2
+
+def test_free_memory_is_read_once_per_pass(monkeypatch):
+    reads = []
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: reads.append(1) or 100000)
+    tracker = Tracker()
+    graph = StageGraph()
+    graph.add("textures", tracker.stage("textures"), lane=GPU_LANE, gpu_memory=4000)
+    graph.add("music", tracker.stage("music"), lane=GPU_LANE, gpu_memory=4000)
+    graph.run()
+    assert len(reads) == 1
+
+def test_stages_started_in_the_same_pass_reserve_free_memory(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: 5000)
+    tracker = Tracker()
+    graph = StageGraph()
+    graph.add("textures", tracker.stage("textures"), lane=GPU_LANE, gpu_memory=4000)
+    graph.add("music", tracker.stage("music"), lane=GPU_LANE, gpu_memory=4000)
+    graph.run()
+    assert tracker.max_active == 1
+
+def test_waiting_stage_does_not_unload_models(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: 1000)
+    tracker = Tracker()
+    llm = _model(tracker, "llm", 8000)
+    graph = StageGraph(gpu_memory_budget=10000, gpu_models={"llm": llm})
+    graph.add("music", tracker.stage("music", duration=0.1), lane=GPU_LANE, gpu_memory=1000)
+    # over the budget while music runs, so it waits and must not evict anything until it starts
+    graph.add("textures", tracker.stage("textures"), lane=GPU_LANE, gpu_memory=9500)
+    graph.run()
+    assert tracker.events.index("end music") < tracker.events.index("unload llm") < tracker.events.index("start textures")
+
+def test_stage_that_cannot_fit_beside_running_ones_does_not_unload_models(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: 1000)
+    tracker = Tracker()
+    graph = StageGraph(gpu_models={"llm": _model(tracker, "llm", 2000)})
+    graph.add("music", tracker.stage("music", duration=0.1), lane=GPU_LANE, gpu_memory=1000)
+    # unloading the llm is not enough while music runs, so it is only unloaded once textures runs alone
+    graph.add("textures", tracker.stage("textures"), lane=GPU_LANE, gpu_memory=5000)
+    graph.run()
+    assert tracker.events.index("end music") < tracker.events.index("unload llm") < tracker.events.index("start textures")
+
+def test_models_of_running_stages_are_not_unloaded(monkeypatch):
+    monkeypatch.setattr(scheduler, "free_gpu_memory", lambda: 0)
+    tracker = Tracker()
+    models = {"llm": _model(tracker, "llm", 8000), "stable": _model(tracker, "stable", 4000)}
+    graph = StageGraph(gpu_models=models)
+    graph.add("prompts", tracker.stage("prompts", duration=0.2), lane=GPU_LANE, gpu_memory=8000, models=["llm"])
+    graph.add("music", tracker.stage("music"), lane=GPU_LANE, gpu_memory=3000)
+    graph.run()
+    assert tracker.events.index("unload stable") < tracker.events.index("start music") < tracker.events.index("end prompts")
+    assert "unload llm" not in tracker.events
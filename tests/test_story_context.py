@@ -0,0 +1,48 @@
+import pytest
+from nlp import nlp_manager
+from nlp.llm_registry import get_registry
+from nlp.nlp_manager import fit_story, story_context
+
+STORY = " ".join(f"Sentence number {i} happens here." for i in range(100))
+
+@pytest.fixture
+def token_counts(monkeypatch):
+    """Counts words instead of tokens and records every text the tokenizer is asked about."""
+    counted = []
+    monkeypatch.setattr(get_registry(), "count_tokens", lambda text: counted.append(text) or len(text.split()))
+    nlp_manager._count_tokens.cache_clear()
+    yield counted
+    nlp_manager._count_tokens.cache_clear()
+
+def _tokens(text):
+    """The words of the kept sentences plus one per sentence, as `fit_story` counts them."""
+    words = [word for word in text.split() if word != "..."]
+    return len(words) + sum(word.endswith(".") for word in words)
+
+def test_short_story_is_kept_without_tokenizing(token_counts):
+    assert fit_story("A cat sat. A dog ran.", max_tokens=100) == "A cat sat. A dog ran."
+    assert token_counts == []
+
+def test_story_within_the_budget_is_kept(token_counts):
+    assert fit_story(STORY, max_tokens=1000) == STORY
+
+def test_long_story_keeps_the_opening_and_the_focus(token_counts):
+    focus = "Sentence number 70 happens here."
+    fitted = fit_story(STORY, max_tokens=60, focus=[focus])
+    assert fitted.startswith("Sentence number 0 happens here.")
+    assert focus in fitted
+    assert " ... " in fitted
+    assert "Sentence number 40 happens here." not in fitted
+    assert _tokens(fitted) <= 60
+
+def test_sentences_are_tokenized_once_per_story(token_counts):
+    fit_story(STORY, max_tokens=60, focus=["Sentence number 10 happens here."])
+    fit_story(STORY, max_tokens=60, focus=["Sentence number 90 happens here."])
+    assert len(token_counts) == 100
+
+def test_story_context_is_the_same_for_every_prompt_of_a_chunk(token_counts):
+    chunk = ["Sentence number 50 happens here.", "Sentence number 51 happens here."]
+    context = story_context(STORY, chunk)
+    assert context.startswith("Here is a story: \"") and context.endswith("\"\n\n")
+    assert all(sentence in context for sentence in chunk)
+    assert story_context(STORY, chunk) == context
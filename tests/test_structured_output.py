@@ -0,0 +1,72 @@
+import pytest
+from nlp.structured_output import (TupleGrammar, StringListGrammar, GrammarLogitsProcessor, run, parse_tuple,
+                                   parse_string_list)
+
+def accepts(grammar, text):
+    state = run(grammar, text)
+    return state is not None and grammar.accepts(state)
+
+@pytest.mark.parametrize("text", ["(1, 2)", "(1.5, -2, 0)", " ( 0.25 ,-0 )", "(0, 10)", "(-0.5,100.75,3)"])
+def test_tuple_grammar_accepts_numbers(text):
+    assert accepts(TupleGrammar(), text)
+    assert 2 <= len(parse_tuple(text)) <= 3
+
+@pytest.mark.parametrize("text", ["(01, 2)", "(-01,1)", "(00.5,1)", "(1, 007)"])
+def test_tuple_grammar_rejects_leading_zeros(text):
+    assert run(TupleGrammar(), text) is None
+
+def test_parse_tuple_rejects_leading_zeros():
+    with pytest.raises(ValueError):
+        parse_tuple("(01, 2)")
+
+@pytest.mark.parametrize("text", ["(1)", "(1, 2, 3, 4)", "(1., 2)", "(.5, 2)", "(1, 2", "[1, 2]", "(a, 2)", "(1,, 2)"])
+def test_tuple_grammar_rejects_other_shapes(text):
+    assert not accepts(TupleGrammar(), text)
+
+def test_tuple_grammar_stops_at_the_closing_bracket():
+    grammar = TupleGrammar()
+    assert grammar.accepts(run(grammar, "(1, 2)"))
+    assert grammar.step(run(grammar, "(1, 2)"), " ") is None
+
+def test_string_list_grammar():
+    grammar = StringListGrammar(max_items=2, max_length=5)
+    assert accepts(grammar, '["tree", "rock"]')
+    assert accepts(grammar, '[]')
+    assert not accepts(grammar, '["tree", "rock", "bush"]')
+    assert not accepts(grammar, '["boulder"]')
+    assert not accepts(grammar, '[""]')
+    assert not accepts(grammar, '["tree",]')
+    assert parse_string_list('["tree", "rock"]') == ["tree", "rock"]
+
+@pytest.mark.parametrize("text", ["[1, 2]", "['tree', 3]", "tree", "{'tree'}"])
+def test_parse_string_list_rejects_other_values(text):
+    with pytest.raises(ValueError):
+        parse_string_list(text)
+
+@pytest.mark.parametrize("text", ["(1, float('inf'))", "(True, 2)", "__import__('os')", "(1, 2, 3, 4)"])
+def test_parse_tuple_rejects_other_values(text):
+    with pytest.raises(ValueError):
+        parse_tuple(text)
+
+class FakeTokenizer:
+    """A tokenizer whose vocabulary is a handful of sentencepiece tokens."""
+    tokens = ["<s>", "</s>", "(", "▁(", "0", "1", "01", "2", ",", ",▁", ")", "▁)", ".", "-", "abc"]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[i] for i in ids]
+
+def test_processor_only_allows_tokens_that_stay_in_the_grammar():
+    tokenizer = FakeTokenizer()
+    processor = GrammarLogitsProcessor(TupleGrammar(), tokenizer, [1])
+    grammar = processor.grammar
+    allowed = lambda text: {tokenizer.tokens[token_id] for token_id in processor.allowed_tokens(run(grammar, text))}
+    assert allowed("") == {"(", "▁("}
+    assert "01" not in allowed("(")
+    assert allowed("(0") == {".", ",", ",▁"}
+    assert allowed("(1, 2") >= {")", "▁)", "0", "1", "01"}
+    # the end of sequence is only allowed once the tuple is closed
+    assert allowed("(1, 2)") == {"</s>"}
+    assert "</s>" not in allowed("(1, 2")
@@ -0,0 +1,47 @@
+from rendering.timeline import TimelineJournal, assemble_timeline, load_timeline
+
+SEQUENCE = {'characters': {'aiden': {'animation': 'walk.bvh', 'sequence_end_position': [0, 1, 0]}}, 'audio_paths': []}
+
+def _journal(tmp_path, fresh=True):
+    return TimelineJournal(str(tmp_path / "story" / "timeline.jsonl"), fresh=fresh)
+
+def test_assembled_timeline_has_the_settings_and_every_sequence(tmp_path):
+    journal = _journal(tmp_path)
+    journal.set(render_quality="low", render_output="story.mp4")
+    journal.add_sequence(1, 65, SEQUENCE)
+    journal.add_sequence(65, 129, SEQUENCE)
+    timeline = load_timeline(assemble_timeline(journal.path, str(tmp_path / "frame_data.json")))
+    assert timeline['render_quality'] == "low"
+    assert timeline['1'] == SEQUENCE and timeline['65'] == SEQUENCE
+    assert timeline['end_frame'] == 129
+
+def test_later_lines_override_earlier_ones(tmp_path):
+    journal = _journal(tmp_path)
+    journal.set(render_quality="low")
+    journal.add_sequence(1, 65, {'characters': {}})
+    journal.set(render_quality="high")
+    journal.add_sequence(1, 65, SEQUENCE)
+    timeline = load_timeline(assemble_timeline(journal.path, str(tmp_path / "frame_data.json")))
+    assert timeline['render_quality'] == "high"
+    assert timeline['1'] == SEQUENCE
+
+def test_line_still_being_written_is_skipped(tmp_path):
+    journal = _journal(tmp_path)
+    journal.add_sequence(1, 65, SEQUENCE)
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"frame": 65, "end": 1')
+    timeline = load_timeline(assemble_timeline(journal.path, str(tmp_path / "frame_data.json")))
+    assert '65' not in timeline
+    assert timeline['end_frame'] == 65
+
+def test_resumed_journal_keeps_its_lines(tmp_path):
+    _journal(tmp_path).add_sequence(1, 65, SEQUENCE)
+    journal = _journal(tmp_path, fresh=False)
+    journal.add_sequence(65, 129, SEQUENCE)
+    timeline = load_timeline(assemble_timeline(journal.path, str(tmp_path / "frame_data.json")))
+    assert '1' in timeline and '65' in timeline
+    assert '1' not in load_timeline(assemble_timeline(_journal(tmp_path).path, str(tmp_path / "frame_data.json")))
+
+def test_empty_journal_still_assembles(tmp_path):
+    journal = _journal(tmp_path)
+    assert load_timeline(assemble_timeline(journal.path, str(tmp_path / "frame_data.json"))) == {'end_frame': 1}
@@ -0,0 +1,54 @@
+import json
+import pytest
+import marta
+from orchestration.import_profile import ENTRY_MODULES, profile_import
+from rendering.timeline import TimelineJournal, validate_timeline
+
+def _frame_data(tmp_path, **changes):
+    animation = tmp_path / "walk.bvh"
+    animation.write_text("")
+    timeline = {
+        "render_quality": "low",
+        "render_output": str(tmp_path / "story.mp4"),
+        "blender_output": "",
+        "end_frame": 65,
+        "1": {"characters": {"aiden": {"animation": str(animation), "sequence_end_position": [0, 1, 0]}}, "audio_paths": []},
+    }
+    timeline.update(changes)
+    path = tmp_path / "frame_data.json"
+    path.write_text(json.dumps(timeline))
+    return str(path)
+
+def test_valid_timeline(tmp_path):
+    assert validate_timeline(_frame_data(tmp_path)) == []
+
+def test_timeline_problems_are_reported(tmp_path):
+    errors = validate_timeline(_frame_data(tmp_path, render_quality="ultra", end_frame=1, setting_image_path=str(tmp_path / "missing.png")))
+    assert any("render_quality" in error for error in errors)
+    assert any("end_frame" in error for error in errors)
+    assert any("missing.png" in error for error in errors)
+    assert not any("missing.png" in error for error in validate_timeline(_frame_data(tmp_path, setting_image_path="missing.png"), check_files=False))
+
+def test_character_without_an_animation_is_reported(tmp_path):
+    sequence = {"characters": {"aiden": {"animation": None, "sequence_end_position": [0, 1]}}}
+    errors = validate_timeline(_frame_data(tmp_path, **{"1": sequence}), check_files=False)
+    assert len(errors) == 2
+
+def test_unreadable_timeline(tmp_path):
+    assert validate_timeline(str(tmp_path / "missing.json"))
+
+def test_validate_command(tmp_path):
+    assert marta.main(["validate", _frame_data(tmp_path)]) == 0
+    assert marta.main(["validate", _frame_data(tmp_path, end_frame=1)]) == 1
+
+def test_validate_command_reads_a_journal(tmp_path):
+    journal = TimelineJournal(str(tmp_path / "story" / "timeline.jsonl"))
+    journal.set(render_quality="low", render_output="story.mp4", blender_output="")
+    journal.add_sequence(1, 65, {"characters": {"aiden": {"animation": "walk.bvh", "sequence_end_position": [0, 1, 0]}}})
+    assert marta.main(["validate", journal.path, "--skip-file-check"]) == 0
+
+@pytest.mark.parametrize("module", ENTRY_MODULES)
+def test_entry_points_do_not_import_the_ml_stack(module):
+    report = profile_import(module)
+    assert report['error'] == ""
+    assert report['heavy'] == []
@@ -0,0 +1,37 @@
+from nlp.zero_shot import ZeroShotClassifier
+
+class FakePipeline:
+    """Scores a text by its length and records every batch it is given."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts, labels, batch_size):
+        self.calls.append((list(texts), labels))
+        outputs = [{'labels': labels, 'scores': [len(text) / 100]} for text in texts]
+        # the pipeline returns a bare dict for a single text
+        return outputs[0] if len(outputs) == 1 else outputs
+
+def _classifier():
+    classifier = ZeroShotClassifier()
+    classifier.classifier = FakePipeline()
+    return classifier
+
+def test_texts_are_classified_in_one_batch_once_each():
+    classifier = _classifier()
+    scores = classifier.classify(["He ran.", "She sat down.", "He ran."], "physical action")
+    assert scores == {"He ran.": 0.07, "She sat down.": 0.13}
+    assert classifier.classifier.calls == [(["He ran.", "She sat down."], ["physical action"])]
+
+def test_scores_are_memoised_per_label():
+    classifier = _classifier()
+    classifier.classify(["He ran."], "physical action")
+    classifier.classify(["He ran.", "Aiden"], "physical action")
+    classifier.classify(["Aiden"], "person")
+    assert classifier.classifier.calls == [(["He ran."], ["physical action"]), (["Aiden"], ["physical action"]), (["Aiden"], ["person"])]
+
+def test_nothing_is_loaded_when_every_score_is_memoised():
+    classifier = _classifier()
+    classifier.classify(["He ran."], "physical action")
+    classifier.classifier = None
+    assert classifier.classify(["He ran."], "physical action") == {"He ran.": 0.07}
+    assert not classifier.is_loaded()
@@ -2,30 +2,124 @@
 # Code taken from https://huggingface.co/stabilityai/stable-diffusion-2-1 #
 ###########################################################################
 
-import torch, os, gc
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+from orchestration.profiling import span
+import os, gc, hashlib, shutil
 
-def generate_image(prompt, path, height = 512, width = 512, story_name=str):
+MODEL_ID = 'stabilityai/stable-diffusion-2-1'
+IMAGE_CACHE_DIR = os.path.join(os.getcwd(), "texture_generation", "image_cache")
+
+class TexturePipeline:
+    """
+    Stable Diffusion pipeline that is loaded once and reused for every texture of a run.
+
+    Generated images are cached on disk by prompt, seed and size, so rerendering a story skips
+    texture generation entirely.
+    """
+    def __init__(self, model_id=MODEL_ID, cache_dir=IMAGE_CACHE_DIR):
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.pipe = None
+
+    def load(self):
+        """Loads the diffusion pipeline if it is not already loaded."""
+        if self.pipe is None:
+            import torch
+            from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+            with span("load " + self.model_id, "model"):
+                pipe = StableDiffusionPipeline.from_pretrained(self.model_id, torch_dtype=torch.float16)
+                pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+                pipe = pipe.to("cuda")
+                pipe.enable_attention_slicing()
+                pipe.enable_model_cpu_offload()
+                self.pipe = pipe
+            torch.cuda.empty_cache()
+        return self.pipe
+
+    def unload(self):
+        """Releases the pipeline and frees its memory."""
+        import torch
+        self.pipe = None
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def is_loaded(self) -> bool:
+        """Returns whether the pipeline is currently resident."""
+        return self.pipe is not None
+
+    def cache_path(self, prompt : str, seed : int, height : int, width : int) -> str:
+        """Returns where the image for these settings is cached."""
+        key = hashlib.sha256(f"{self.model_id}|{prompt}|{seed}|{height}x{width}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".png")
+
+    def generate(self, requests : list) -> list:
+        """
+        Generates several images, batching the ones that share a size.
+
+        Args:
+            requests (list): dicts with a `prompt`, `path` and optional `height`, `width` (default 512) and `seed`
+
+        Returns:
+            The saved path of each request, in input order.
+        """
+        groups = {}
+        for request in requests:
+            height, width = request.get('height', 512), request.get('width', 512)
+            seed = request.get('seed')
+            if seed is None:
+                seed = default_seed(request['prompt'])
+            cached_path = self.cache_path(request['prompt'], seed, height, width)
+            if os.path.isfile(cached_path):
+                print(f"Reusing cached image for \"{request['prompt']}\"")
+                _place(cached_path, request['path'])
+            else:
+                groups.setdefault((height, width), []).append((request, seed, cached_path))
+
+        for (height, width), group in groups.items():
+            import torch
+            pipe = self.load()
+            generators = [torch.Generator(device="cpu").manual_seed(seed) for _, seed, _ in group]
+            with span("stable diffusion generate", "generate", images=len(group), size=f"{width}x{height}"):
+                images = pipe([request['prompt'] for request, _, _ in group], height=height, width=width, generator=generators).images
+            for (request, _, cached_path), image in zip(group, images):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                image.save(cached_path)
+                _place(cached_path, request['path'])
+            torch.cuda.empty_cache()
+
+        return [request['path'] for request in requests]
+
+def default_seed(prompt : str) -> int:
+    """Derives a stable seed from the prompt so the same prompt reuses its cached image."""
+    return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+
+def _place(cached_path : str, path : str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.copyfile(cached_path, path)
+
+_texture_pipeline = TexturePipeline()
+
+def get_texture_pipeline() -> TexturePipeline:
+    """Returns the process-wide texture pipeline."""
+    return _texture_pipeline
+
+def generate_images(requests : list) -> list:
+    """
+    Generates several images with the shared pipeline, see `TexturePipeline.generate`.
+
+    Returns:
+        The paths to the saved images (png)
+    """
+    return _texture_pipeline.generate(requests)
+
+def generate_image(prompt, path, height = 512, width = 512, story_name=str, seed=None):
     """
     Generates an image using stable-diffusion 2.1 based off a prompt
 
     Args:
         prompt (str): the prompt the model uses to generate the image
+        seed (int): the seed of the generation, derived from the prompt if not given
 
     Returns:
         The path to the saved image (png)
     """
-    pipe = StableDiffusionPipeline.from_pretrained('stabilityai/stable-diffusion-2-1', torch_dtype=torch.float16)
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-    pipe = pipe.to("cuda")
-    pipe.enable_attention_slicing() 
-    pipe.enable_model_cpu_offload()
-    torch.cuda.empty_cache()
-    created_directory = os.path.join(os.getcwd(), "texture_generation", "generated_images", story_name)
-    if not os.path.isdir(created_directory):
-        os.mkdir(created_directory)
-    image = pipe(prompt, height=height, width=width).images[0]
-    image.save(path)
-    torch.cuda.empty_cache()
-    gc.collect()
-    return path
+    return generate_images([{'prompt': prompt, 'path': path, 'height': height, 'width': width, 'seed': seed}])[0]